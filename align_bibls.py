@@ -0,0 +1,274 @@
+"""
+Per-ad alignment of predicted and ground truth BIBL entries.
+
+compare_tags pools all values of a tag across a file into sets, which hides
+repeated values and mixes entries of different ads. Here the ads of a model
+output are first aligned with the ground truth ads, then the BIBL entries
+within each pair of ads are aligned by an optimal assignment on their
+similarity, and inner tags are only compared within aligned BIBL pairs:
+
+- a BIBL counts as correct if its text equals the aligned ground truth BIBL,
+- an inner tag value counts as correct if it occurs under the same tag in the
+  aligned ground truth BIBL, with multiplicity, so a repeated 'FORMAT: 8vò'
+  has to be found twice.
+
+Similarities are q-gram Dice coefficients (see fuzzy_match.qgrams). The BIBL
+similarity matrices are computed for the ads in parallel and cached by content,
+in memory and optionally in a JSON Lines file, so re-evaluating after adding a
+model only computes the matrices of the new model.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from convert_inline_to_standoff import iter_ads
+from fuzzy_match import qgrams
+
+# ads and BIBL entries less similar than this are not aligned
+MIN_AD_SIMILARITY = 0.5
+MIN_BIBL_SIMILARITY = 0.3
+
+
+class Ad:
+    """ the de-tagged text of an ad and its BIBL entries as (text, Counter of (tag, value)). """
+
+    def __init__(self, text: str, bibls: List[Tuple[str, Counter]]):
+        self.text = text
+        self.bibls = bibls
+
+
+def load_ads(path: str) -> List[Ad]:
+    """ reads an inline annotated file, one ad per line; inner tags belong to the
+    innermost BIBL containing them. """
+    ads = []
+    with open(path, 'r', encoding='utf-8') as file:
+        for _, text, spans in iter_ads(file):
+            bibl_spans = [span for span in spans if span.tag == "BIBL"]
+            inner = [Counter() for _ in bibl_spans]
+            for span in spans:
+                if span.tag == "BIBL":
+                    continue
+                containing = [b for b, bibl in enumerate(bibl_spans)
+                              if bibl.start <= span.start and span.end <= bibl.end]
+                if containing:
+                    innermost = min(containing, key=lambda b: bibl_spans[b].end - bibl_spans[b].start)
+                    inner[innermost][(span.tag, span.text)] += 1
+            ads.append(Ad(text, [(bibl.text, tags) for bibl, tags in zip(bibl_spans, inner)]))
+    return ads
+
+
+def dice(a: Counter, b: Counter) -> float:
+    total = sum(a.values()) + sum(b.values())
+    return 2 * sum((a & b).values()) / total if total else 1.0
+
+
+def containment(part: Counter, whole: Counter) -> float:
+    """ share of the q-grams of part that occur in whole. """
+    total = sum(part.values())
+    return sum((part & whole).values()) / total if total else 0.0
+
+
+def similarity_matrix(gold_texts: Sequence[str], predicted_texts: Sequence[str]) -> List[List[float]]:
+    predicted_grams = [qgrams(text) for text in predicted_texts]
+    return [[dice(gold_grams, grams) for grams in predicted_grams]
+            for gold_grams in (qgrams(text) for text in gold_texts)]
+
+
+def optimal_assignment(matrix: Sequence[Sequence[float]]) -> List[Tuple[int, int]]:
+    """
+    Rows and columns paired one-to-one with the maximal total similarity
+    (Hungarian algorithm, O(n^3)). Rectangular matrices leave the surplus
+    rows or columns unpaired.
+    """
+    rows = len(matrix)
+    columns = len(matrix[0]) if rows else 0
+    if not rows or not columns:
+        return []
+    transposed = rows > columns
+    if transposed:
+        matrix = [list(column) for column in zip(*matrix)]
+        rows, columns = columns, rows
+
+    # minimize the cost -similarity; u, v are the potentials, way the augmenting paths
+    infinity = float("inf")
+    u, v = [0.0] * (rows + 1), [0.0] * (columns + 1)
+    match = [0] * (columns + 1)
+    way = [0] * (columns + 1)
+    for row in range(1, rows + 1):
+        match[0] = row
+        column = 0
+        min_value = [infinity] * (columns + 1)
+        used = [False] * (columns + 1)
+        while True:
+            used[column] = True
+            current_row, delta, next_column = match[column], infinity, 0
+            for j in range(1, columns + 1):
+                if not used[j]:
+                    reduced = -matrix[current_row - 1][j - 1] - u[current_row] - v[j]
+                    if reduced < min_value[j]:
+                        min_value[j], way[j] = reduced, column
+                    if min_value[j] < delta:
+                        delta, next_column = min_value[j], j
+            for j in range(columns + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    min_value[j] -= delta
+            column = next_column
+            if match[column] == 0:
+                break
+        while column:
+            previous = way[column]
+            match[column] = match[previous]
+            column = previous
+
+    pairs = [(match[j] - 1, j - 1) for j in range(1, columns + 1) if match[j]]
+    if transposed:
+        pairs = [(j, i) for i, j in pairs]
+    return sorted(pairs)
+
+
+class SimilarityCache:
+    """
+    BIBL similarity matrices keyed by a hash of the compared texts.
+
+    Args:
+        path: JSON Lines file the cache is loaded from and appended to,
+            None for an in-memory cache
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.matrices: Dict[str, List[List[float]]] = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # an interrupted write leaves a truncated last line
+                        continue
+                    self.matrices[entry["key"]] = entry["matrix"]
+
+    @staticmethod
+    def key(gold_texts: Sequence[str], predicted_texts: Sequence[str]) -> str:
+        text = json.dumps([list(gold_texts), list(predicted_texts)], ensure_ascii=False)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[List[float]]]:
+        return self.matrices.get(key)
+
+    def put_many(self, entries: Dict[str, List[List[float]]]):
+        self.matrices.update(entries)
+        if self.path and entries:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                for key, matrix in entries.items():
+                    f.write(json.dumps({"key": key, "matrix": matrix}) + "\n")
+
+
+def _similarity_matrix_job(texts):
+    return similarity_matrix(*texts)
+
+
+def align_ads(gold_ads: Sequence[Ad], predicted_ads: Sequence[Ad]) -> List[Tuple[int, int]]:
+    """ pairs each ground truth ad with the model output line containing most of its text.
+    Lines without BIBL entries, e.g. run statistics, are not considered. """
+    candidates = [p for p, ad in enumerate(predicted_ads) if ad.bibls]
+    gold_grams = [qgrams(ad.text) for ad in gold_ads]
+    predicted_grams = [qgrams(predicted_ads[p].text) for p in candidates]
+    matrix = [[containment(gold, predicted) for predicted in predicted_grams] for gold in gold_grams]
+    return [(g, candidates[c]) for g, c in optimal_assignment(matrix) if matrix[g][c] >= MIN_AD_SIMILARITY]
+
+
+def count_aligned(gold: Ad, predicted: Ad, matrix: List[List[float]]) -> Dict[str, List[int]]:
+    """ [correct, ground truth, predicted] counts per tag for a pair of aligned ads. """
+    counts: Dict[str, List[int]] = {}
+
+    def add(tag, correct, gold_count, predicted_count):
+        entry = counts.setdefault(tag, [0, 0, 0])
+        entry[0] += correct
+        entry[1] += gold_count
+        entry[2] += predicted_count
+
+    for _, tags in gold.bibls:
+        add("BIBL", 0, 1, 0)
+        for (tag, _), count in tags.items():
+            add(tag, 0, count, 0)
+    for _, tags in predicted.bibls:
+        add("BIBL", 0, 0, 1)
+        for (tag, _), count in tags.items():
+            add(tag, 0, 0, count)
+
+    for g, p in optimal_assignment(matrix):
+        if matrix[g][p] < MIN_BIBL_SIMILARITY:
+            continue
+        (gold_text, gold_tags), (predicted_text, predicted_tags) = gold.bibls[g], predicted.bibls[p]
+        add("BIBL", int(gold_text == predicted_text), 0, 0)
+        for (tag, _), count in (gold_tags & predicted_tags).items():
+            add(tag, count, 0, 0)
+    return counts
+
+
+def align_models(
+    gold_ads: Sequence[Ad],
+    predicted_ads_by_model: Dict[str, Sequence[Ad]],
+    cache: Optional[SimilarityCache] = None,
+    workers: int = 1
+) -> Dict[str, Dict[Tuple[str, int], Dict[str, List[int]]]]:
+    """
+    Aligns the ads and BIBL entries of several model outputs with the ground truth.
+
+    Args:
+        gold_ads: Ground truth ads, see load_ads
+        predicted_ads_by_model: Ads of each model output
+        cache: Cache for the BIBL similarity matrices
+        workers: Number of processes for computing uncached matrices
+
+    Returns:
+        For each model, the counts of count_aligned per ad, keyed by ("gold", index)
+        for ground truth ads and ("extra", line) for unaligned model output lines
+    """
+    cache = cache if cache is not None else SimilarityCache()
+    alignments = {model: align_ads(gold_ads, ads) for model, ads in predicted_ads_by_model.items()}
+
+    def texts(model, g, p):
+        return ([text for text, _ in gold_ads[g].bibls],
+                [text for text, _ in predicted_ads_by_model[model][p].bibls])
+
+    missing = {}
+    for model, pairs in alignments.items():
+        for g, p in pairs:
+            gold_texts, predicted_texts = texts(model, g, p)
+            key = SimilarityCache.key(gold_texts, predicted_texts)
+            if cache.get(key) is None:
+                missing[key] = (gold_texts, predicted_texts)
+    if workers > 1 and len(missing) > 1:
+        with multiprocessing.Pool(min(workers, len(missing))) as pool:
+            matrices = pool.map(_similarity_matrix_job, list(missing.values()), chunksize=8)
+    else:
+        matrices = [_similarity_matrix_job(pair) for pair in missing.values()]
+    cache.put_many(dict(zip(missing, matrices)))
+
+    result = {}
+    for model, pairs in alignments.items():
+        predicted_ads = predicted_ads_by_model[model]
+        model_counts = {}
+        for g, p in pairs:
+            matrix = cache.get(SimilarityCache.key(*texts(model, g, p)))
+            model_counts[("gold", g)] = count_aligned(gold_ads[g], predicted_ads[p], matrix)
+        aligned_gold = {g for g, _ in pairs}
+        aligned_predicted = {p for _, p in pairs}
+        empty = Ad("", [])
+        for g, ad in enumerate(gold_ads):
+            if g not in aligned_gold:
+                model_counts[("gold", g)] = count_aligned(ad, empty, [])
+        for p, ad in enumerate(predicted_ads):
+            if p not in aligned_predicted and ad.bibls:
+                model_counts[("extra", p)] = count_aligned(empty, ad, [])
+        result[model] = model_counts
+    return result
@@ -0,0 +1,283 @@
+"""
+Annotation of the ads with an LLM, packing several ads into one request.
+
+LLM_NER_annotation_prompt.md is long compared to a single ad, so sending one
+ad per request spends most tokens and latency on repeating the prompt. This
+runner sends pack_size ads per request, each in its own <ITEM n="k">, splits
+the response at the ITEM boundaries and validates every item with
+evaluate_tsv.analyze_annotations. Ads whose item is missing, malformed or does
+not contain the ad text are resubmitted individually with the plain prompt;
+these answers are validated the same way and retried if they fail.
+
+The output is a TSV file with the ad id and the annotation (<ITEM>...</ITEM>)
+in the first two columns, like all_bib_items_annotated.tsv, so it can be
+checked with evaluate_tsv.py. The rows are written as soon as a pack and all
+packs before it are complete, so the output keeps the input order and a
+re-run writes the same rows in the same order (incorrect_tags.txt and the
+corrections refer to the faulty rows by their position).
+
+Usage:
+    python annotate_ads.py ads.tsv annotated.tsv --pack-size 8 --concurrency 4
+    python annotate_ads.py tests_llm_requests/test_set_small.txt /tmp/annotated.tsv --stub
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from align_bibls import containment
+from evaluate_tsv import analyze_annotations
+from fuzzy_match import qgrams
+from llm_retry import RequestFailed, with_retries
+
+# the stub client of the correction script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", "correction_of_results"))
+from stub_client import StubClient  # noqa: E402
+
+PROMPT_PATH = "LLM_NER_annotation_prompt.md"
+MODEL = "llama3.3:70b"
+
+PACKING_INSTRUCTIONS = """
+---
+
+## Multiple Snippets per Request
+
+The input below contains {count} snippets, each wrapped in <ITEM n="...">...</ITEM>.
+Annotate every snippet separately following the rules above. Return exactly one
+<ITEM n="...">...</ITEM> per snippet with the same n, in the same order, and nothing else.
+"""
+
+_PACKED_ITEM_RE = re.compile(r'<ITEM\s+n="(\d+)"\s*>(.*?)</ITEM>', re.DOTALL)
+_ITEM_RE = re.compile(r"<ITEM>.*</ITEM>", re.DOTALL)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+# share of the ad's q-grams that must occur in the de-tagged item,
+# to catch items that were swapped or merged with another ad
+MIN_TEXT_COVERAGE = 0.8
+
+
+def load_prompt(path=PROMPT_PATH):
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def load_ads(input_path):
+    """
+    Reads (id, text) pairs from a TSV file with a header, id and text in the
+    first two columns, or from a text file with one ad per line (the line
+    number is the id).
+    """
+    with open(input_path, "r", encoding="utf-8", newline="") as f:
+        if input_path.endswith(".tsv"):
+            reader = csv.reader(f, delimiter="\t")
+            next(reader)
+            return [(row[0], row[1]) for row in reader if len(row) > 1]
+        return [(str(number), line.strip()) for number, line in enumerate(f, start=1) if line.strip()]
+
+
+def pack_request(prompt, texts):
+    """ the request text for several ads, numbered from 1. """
+    items = "\n".join(f'<ITEM n="{n}">{text}</ITEM>' for n, text in enumerate(texts, start=1))
+    return f"{prompt}{PACKING_INSTRUCTIONS.format(count=len(texts))}\n### INPUT ###\n{items}"
+
+
+def single_request(prompt, text):
+    return f"{prompt}\n\n### INPUT ###\n{text}"
+
+
+def split_items(response_text):
+    """ the annotations of a packed response by item number, as <ITEM>...</ITEM>. """
+    items = {}
+    for match in _PACKED_ITEM_RE.finditer(response_text):
+        items.setdefault(int(match.group(1)), f"<ITEM>{match.group(2).strip()}</ITEM>")
+    return items
+
+
+def single_item(response_text):
+    """ the <ITEM> of a single ad response; the whole response if there is none. """
+    match = _ITEM_RE.search(response_text)
+    return match.group(0) if match else response_text.strip()
+
+
+class InvalidItem(ValueError):
+    """ the annotation of an ad is malformed or does not contain the ad text. """
+
+
+def is_valid_item(xml, text):
+    """ well-formed, without overlapping tags, and containing the ad text. """
+    analysis = analyze_annotations(xml)
+    if not analysis["xml_well_formed"] or analysis["has_overlapping_tags"]:
+        return False
+    return containment(qgrams(" ".join(text.split())), qgrams(" ".join(_TAG_RE.sub("", xml).split()))) \
+        >= MIN_TEXT_COVERAGE
+
+
+class AnnotationStats:
+    """ counters for the throughput report. """
+
+    def __init__(self):
+        self.requests = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.resubmitted = 0
+        self.failed = 0
+
+    def add_usage(self, raw):
+        usage = raw.get("usage") or {}
+        self.requests += 1
+        self.input_tokens += usage.get("input_tokens") or 0
+        self.output_tokens += usage.get("output_tokens") or 0
+
+
+async def send(client, model, request_text, semaphore, stats, retries=5, validate=None, label=None):
+    """
+    Sends one request with retries and exponential backoff (see llm_retry.py)
+    and returns the response text, or validate(response text) if given; a
+    response failing the validation is retried like an error.
+    """
+    async def attempt():
+        async with semaphore:
+            response, duration = await asyncio.to_thread(client.prompt, model, request_text)
+        raw = response.to_dict()
+        stats.add_usage(raw)
+        metrics.observe_response(model, duration, raw)
+        return validate(response.text) if validate else response.text
+
+    return await with_retries(attempt, model, retries, label=label)
+
+
+async def annotate_pack(client, model, prompt, pack, semaphore, stats, retries=5):
+    """
+    Annotates a pack of (id, text) ads with one request and resubmits the
+    ads without a valid item individually. Returns (id, annotation or None).
+    """
+    items = {}
+    if len(pack) > 1:
+        try:
+            items = split_items(await send(client, model, pack_request(prompt, [text for _, text in pack]),
+                                           semaphore, stats, retries))
+        except RequestFailed as e:
+            print(f"Pack starting at ad {pack[0][0]} failed: {e}")
+
+    results = []
+    for n, (ad_id, text) in enumerate(pack, start=1):
+        xml = items.get(n)
+        if xml is None or not is_valid_item(xml, text):
+            if len(pack) > 1:
+                stats.resubmitted += 1
+
+            def validate(response_text, text=text):
+                item = single_item(response_text)
+                if not is_valid_item(item, text):
+                    raise InvalidItem("malformed annotation or ad text missing")
+                return item
+
+            try:
+                xml = await send(client, model, single_request(prompt, text), semaphore, stats, retries,
+                                 validate=validate, label=f"Ad {ad_id}")
+            except RequestFailed as e:
+                print(f"Ad {ad_id} failed: {e}")
+                stats.failed += 1
+                xml = None
+        results.append((ad_id, xml))
+    return results
+
+
+async def run_annotation(client, ads, output_path, pack_size=8, concurrency=4, retries=5, prompt=None,
+                         model=MODEL):
+    """
+    Annotates all ads and writes the packs to the TSV output in input order,
+    each as soon as it and the packs before it are done. Ads that fail after
+    all retries are left out and listed at the end.
+    """
+    prompt = prompt if prompt is not None else load_prompt()
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    stats = AnnotationStats()
+    packs = [ads[i:i + pack_size] for i in range(0, len(ads), pack_size)]
+
+    async def numbered(number, pack):
+        return number, await annotate_pack(client, model, prompt, pack, semaphore, stats, retries)
+
+    failed = []
+    # completed packs waiting for an earlier one, by pack number
+    done_packs = {}
+    next_pack = 0
+    start = time.monotonic()
+    with metrics.timer("annotate") as stage, open(output_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["id", "annotation"])
+        for pack_done in asyncio.as_completed([numbered(number, pack) for number, pack in enumerate(packs)]):
+            number, results = await pack_done
+            done_packs[number] = results
+            while next_pack in done_packs:
+                for ad_id, xml in done_packs.pop(next_pack):
+                    if xml is None:
+                        failed.append(ad_id)
+                    else:
+                        # one ad per row
+                        writer.writerow([ad_id, " ".join(xml.split())])
+                next_pack += 1
+            f.flush()
+        stage.items = len(ads)
+    elapsed = time.monotonic() - start
+
+    done = len(ads) - len(failed)
+    metrics.count("ads_resubmitted", stats.resubmitted)
+    metrics.count("ads_failed", len(failed))
+    print(f"Annotated {done} of {len(ads)} ads in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.2f} ads/s) "
+          f"with pack size {pack_size}: {stats.requests} requests, {stats.resubmitted} ads resubmitted, "
+          f"{(stats.input_tokens + stats.output_tokens) / max(len(ads), 1):.0f} tokens per ad.")
+    if failed:
+        print(f"Failed ads: {', '.join(failed)}")
+    return stats
+
+
+def stub_answer(text, rng, drop_rate=0.02):
+    """
+    Answer of the stub client to an annotation request: every ad is wrapped in
+    one BIBL, and a share of the items of a packed request is left out to
+    exercise the individual resubmits.
+    """
+    request = text.rsplit("### INPUT ###\n", 1)[-1]
+    packed = _PACKED_ITEM_RE.findall(request)
+    if packed:
+        return "\n".join(f'<ITEM n="{n}"><BIBL>{ad}</BIBL></ITEM>' for n, ad in packed
+                         if rng.random() >= drop_rate)
+    return f"<ITEM><BIBL>{request.strip()}</BIBL></ITEM>"
+
+
+def create_client(provider="openai", stub=False):
+    """ creates the ai_client for the provider, or the local stub client for offline tests. """
+    if stub:
+        # the latency grows with the number of tokens, as with a real model
+        return StubClient(latency=0.3, seconds_per_token=0.0001, answer=stub_answer)
+
+    from ai_client import create_ai_client
+    from decouple import config
+    return create_ai_client(provider=provider, api_key=config(f"{provider.upper()}_API_KEY", default=None))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Annotate ads with an LLM, several ads per request.")
+    parser.add_argument("input", help="TSV file with id and text columns, or a text file with one ad per line")
+    parser.add_argument("output", help="TSV output with id and annotation columns")
+    parser.add_argument("--pack-size", type=int, default=8,
+                        help="ads per request; 1 sends every ad on its own")
+    parser.add_argument("--concurrency", type=int, default=4, help="maximum number of requests in flight")
+    parser.add_argument("--retries", type=int, default=5, help="retries per request on errors")
+    parser.add_argument("--model", default=MODEL)
+    parser.add_argument("--provider", default="openai", help="ai_client provider")
+    parser.add_argument("--stub", action="store_true", help="use a local stub instead of the LLM")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    with metrics.session(args, "annotate_ads"):
+        asyncio.run(run_annotation(create_client(args.provider, args.stub), load_ads(args.input), args.output,
+                                   args.pack_size, args.concurrency, args.retries, model=args.model))
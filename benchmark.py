@@ -0,0 +1,226 @@
+"""
+Throughput and peak memory of the processing stages on synthetic corpora.
+
+For every corpus size, a corpus is generated with generate_corpus.py in a
+temporary directory, with the same entries per ad and error rates options,
+and each stage is run on it:
+
+- analyze_annotations: evaluate_tsv.analyze_annotations on every model output
+- process_tsv: the evaluation of the whole TSV file (evaluate_tsv.process_tsv)
+- extract_bibl_tags: convert_inline_to_standoff.extract_bibl_tags on the model outputs
+- compare_tags: compare_llms.compare_tags of the model outputs with the ground truth
+- create_consolidated_dataset: format_output.create_consolidated_dataset with the
+  rule-based repair (xml_repair.repair_xml) as correction of every faulty ad
+
+Each stage is timed once without and once with tracemalloc, which slows it
+down, for the peak memory of its Python allocations. The results are written
+as JSON; with --baseline, throughput drops beyond --tolerance compared with an
+earlier result file are reported as regressions. The share of ads that
+evaluate_tsv.py flags is reported next to the configured malformation rates;
+it does not include the stray '&', which only the consolidation detects.
+
+Usage:
+    python benchmark.py --sizes 1000 22000
+    python benchmark.py --sizes 22000 1000000 --output benchmark_new.json --baseline benchmark_old.json
+    python benchmark.py --sizes 22000 --bibls 1-8 --unclosed-rate 0.2
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from compare_llms import compare_tags, tags_from_entries
+from convert_inline_to_standoff import extract_bibl_tags
+from evaluate_tsv import ANNOTATION_COL_INDEX, analyze_annotations, process_tsv
+import generate_corpus
+from generate_corpus import MALFORMATION_RATES, write_corpus
+from xml_repair import repair_xml
+
+# format_output and result_store live in results/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "results"))
+from format_output import create_consolidated_dataset, is_faulty_record, iter_ground_data  # noqa: E402
+from result_store import SqliteResultStore  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 22000]
+
+
+def prepare_corrections(evaluated_tsv_path: str, faulty_lines_path: str, store_path: str) -> int:
+    """ writes incorrect_tags.txt and a result store with the repaired XML of every faulty ad. """
+    store = SqliteResultStore(store_path)
+    count = 0
+    with open(faulty_lines_path, "w", encoding="utf-8") as faulty_file:
+        for record in iter_ground_data(evaluated_tsv_path):
+            if is_faulty_record(record):
+                count += 1
+                xml = list(record.values())[ANNOTATION_COL_INDEX]
+                faulty_file.write(xml + "\n")
+                store.put(count, {"model": "xml_repair"}, repair_xml(xml))
+    store.close()
+    return count
+
+
+def stage_functions(paths: Dict[str, str]) -> Dict[str, Callable[[], int]]:
+    """ the benchmarked stages on a corpus written by write_corpus; each returns the number of ads. """
+    def read_annotations():
+        with open(paths["tsv"], "r", encoding="utf-8", newline="") as f:
+            return [row[ANNOTATION_COL_INDEX] for row in list(csv.reader(f, delimiter="\t"))[1:]]
+
+    def read_text(name):
+        with open(paths[name], "r", encoding="utf-8") as f:
+            return f.read()
+
+    def analyze():
+        annotations = read_annotations()
+        for annotation in annotations:
+            analyze_annotations(annotation)
+        return len(annotations)
+
+    def evaluate():
+        process_tsv(paths["tsv"], paths["evaluated"], stream=True)
+        return paths["count"]
+
+    def extract():
+        extract_bibl_tags(read_text("predictions"))
+        return paths["count"]
+
+    def compare():
+        ground_truth = tags_from_entries(extract_bibl_tags(read_text("groundtruth")))
+        predictions = tags_from_entries(extract_bibl_tags(read_text("predictions")))
+        compare_tags(ground_truth, predictions)
+        return paths["count"]
+
+    def consolidate():
+        return len(create_consolidated_dataset(paths["evaluated"], paths["faulty_lines"], paths["corrections"]))
+
+    return {
+        "analyze_annotations": analyze,
+        "process_tsv": evaluate,
+        "extract_bibl_tags": extract,
+        "compare_tags": compare,
+        "create_consolidated_dataset": consolidate,
+    }
+
+
+def measure(function: Callable[[], int], memory: bool = True) -> Dict[str, float]:
+    """ seconds, ads per second and, with memory, the peak of traced allocations in MB. """
+    # the stages print progress, which would distort the timing of small corpora
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        count = function()
+        seconds = time.perf_counter() - start
+        result = {"seconds": seconds, "ads_per_second": count / seconds if seconds else 0.0}
+        if memory:
+            tracemalloc.start()
+            try:
+                function()
+                result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            finally:
+                tracemalloc.stop()
+    return result
+
+
+def run_benchmarks(sizes: Sequence[int], seed: int = 0, stages: Optional[Sequence[str]] = None,
+                   memory: bool = True, **corpus_options) -> Dict[str, Any]:
+    """
+    Benchmarks the stages on a corpus of every size.
+
+    Args:
+        sizes: Numbers of ads
+        seed: Seed of the corpus generator
+        stages: Names of the stages to run, None for all
+        memory: Also measure the peak memory of every stage
+        corpus_options: Options of generate_corpus.write_corpus, e.g. bibls=(1, 8)
+            or unclosed_rate=0.2; the defaults of the generator otherwise
+
+    Returns:
+        Dictionary with the environment and, under 'results', the measurements
+        of every stage by corpus size
+    """
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "seed": seed,
+        "corpus": {name: list(value) if isinstance(value, tuple) else value
+                   for name, value in corpus_options.items()},
+        "results": {}
+    }
+    malformation_rates = {name: corpus_options.get(name, default) for name, default in MALFORMATION_RATES.items()}
+    configured = ", ".join(f"{name[:-len('_rate')]} {rate:.1%}" for name, rate in malformation_rates.items())
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            start = time.perf_counter()
+            paths = write_corpus(directory, size, seed, **corpus_options)
+            paths.update(count=size,
+                         evaluated=os.path.join(directory, "all_bib_items_evaluated.tsv"),
+                         faulty_lines=os.path.join(directory, "incorrect_tags.txt"),
+                         corrections=os.path.join(directory, "corrections.sqlite"))
+            functions = stage_functions(paths)
+            # the consolidation needs the evaluated TSV and the corrections
+            with contextlib.redirect_stdout(io.StringIO()):
+                process_tsv(paths["tsv"], paths["evaluated"], stream=True)
+            faulty = prepare_corrections(paths["evaluated"], paths["faulty_lines"], paths["corrections"])
+            print(f"{size} ads ({faulty} faulty, {faulty / size if size else 0:.1%} flagged by evaluate_tsv.py; "
+                  f"configured: {configured}), generated in {time.perf_counter() - start:.1f}s")
+            report.setdefault("faulty", {})[str(size)] = faulty
+
+            results = {}
+            for name, function in functions.items():
+                if stages and name not in stages:
+                    continue
+                results[name] = measure(function, memory)
+                memory_text = f", {results[name]['peak_memory_mb']:.1f} MB peak" if memory else ""
+                print(f"  {name:28} {results[name]['seconds']:8.2f}s "
+                      f"{results[name]['ads_per_second']:10.0f} ads/s{memory_text}")
+            report["results"][str(size)] = results
+    return report
+
+
+def find_regressions(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[str]:
+    """ the stages and sizes whose throughput dropped by more than tolerance compared with the baseline. """
+    regressions = []
+    for size, results in report["results"].items():
+        for name, result in results.items():
+            previous = baseline.get("results", {}).get(size, {}).get(name)
+            if previous and result["ads_per_second"] < (1 - tolerance) * previous["ads_per_second"]:
+                regressions.append(f"{name} at {size} ads: {result['ads_per_second']:.0f} ads/s, "
+                                   f"baseline {previous['ads_per_second']:.0f} ads/s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on synthetic corpora.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="corpus sizes in ads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", nargs="+", metavar="STAGE", help="only run these stages")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc runs")
+    parser.add_argument("--output", default=f"benchmark_{datetime.now():%Y%m%d_%H%M%S}.json",
+                        help="JSON file for the results")
+    parser.add_argument("--baseline", help="earlier JSON result file to compare the throughput with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="relative throughput drop reported as a regression")
+    generate_corpus.add_arguments(parser)
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.sizes, args.seed, args.stages, not args.no_memory,
+                            **generate_corpus.corpus_options(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -1,5 +1,14 @@
+import argparse
+import multiprocessing
 import os
 
+import numpy as np
+
+import metrics
+from align_bibls import SimilarityCache, align_models, load_ads
+from convert_inline_to_standoff import extract_bibl_tags, write_standoff
+from fuzzy_match import QGramIndex, match_values
+
 def read_tags(filename):
     """ reads a file containing key-value pairs for tags (BIBL, AUTHOR, etc) separated by ": " 
     and returns a dictionary where each key maps to a list of corresponding values. """
@@ -41,31 +50,332 @@ def compare_tags(ground_truth, predictions):
     f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) else 0
     return precision, recall, f1
 
-def main(ground_truth_file, prediction_files_dir):
-    """ compares ground truth tags with prediction tags from multiple files and writes the results to a file."""
-    ground_truth_tags = read_tags(ground_truth_file)
-    
+def build_hit_matrix(ground_truth, predictions_by_model):
+    """ builds the scoring matrices for several models at once.
+
+    Every distinct (tag, value) pair of the ground truth and all predictions is one item.
+    Returns the sorted tag names, the tag index of every item and three model x item
+    matrices: hits (item in ground truth and prediction), gold (the item's share of the
+    recall denominator) and predicted (the item's share of the precision denominator).
+    The shares are chosen so that summing them reproduces compare_tags exactly. """
+    items = _index_items(ground_truth, predictions_by_model)
+
+    def counts(tags):
+        vector = np.zeros(len(items))
+        for key, values in tags.items():
+            for value in values:
+                vector[items[(key, value)]] += 1
+        return vector
+
+    tag_names = sorted({key for key, _ in items})
+    item_tags = np.array([tag_names.index(key) for key, _ in items], dtype=np.intp)
+    gold_counts = counts(ground_truth)
+    in_ground_truth = gold_counts > 0
+    # tags predicted by each model; a ground truth tag the model never predicted
+    # counts with all its values in the recall denominator, as in compare_tags
+    ground_truth_tags = np.array([name in ground_truth for name in tag_names])
+
+    hits, gold, predicted = [], [], []
+    for tags in predictions_by_model.values():
+        pred_counts = counts(tags)
+        predicted_tags = np.array([name in tags for name in tag_names])
+        hits.append(in_ground_truth & (pred_counts > 0))
+        gold.append(np.where(predicted_tags[item_tags], in_ground_truth, gold_counts)
+                    + np.where(ground_truth_tags[item_tags], 0, pred_counts))
+        predicted.append(pred_counts)
+    return tag_names, item_tags, np.array(hits, dtype=float), np.array(gold), np.array(predicted)
+
+
+def _index_items(ground_truth, predictions_by_model):
+    """ maps every distinct (tag, value) pair to its item index, in order of appearance. """
+    items = {}
+    for tags in [ground_truth] + list(predictions_by_model.values()):
+        for key, values in tags.items():
+            for value in values:
+                items.setdefault((key, value), len(items))
+    return items
+
+
+def fuzzy_hit_matrices(ground_truth, predictions_by_model, thresholds):
+    """ hit matrices like the one of build_hit_matrix, but a ground truth item is hit if it is
+    matched one-to-one to a predicted value of the same tag with at least the similarity
+    threshold (see fuzzy_match.py). Returns a dictionary from threshold to a pair of matrices:
+    hits on the ground truth items, for recall, and hits on the matched predicted items,
+    for precision, so that bootstrap resamples weight both sides of a match correctly. """
+    items = _index_items(ground_truth, predictions_by_model)
+    hits = {threshold: (np.zeros((len(predictions_by_model), len(items))),
+                        np.zeros((len(predictions_by_model), len(items))))
+            for threshold in thresholds}
+    indexes = {key: QGramIndex(sorted(set(values))) for key, values in ground_truth.items()}
+    for m, tags in enumerate(predictions_by_model.values()):
+        for key, values in ground_truth.items():
+            if key not in tags:
+                continue
+            for threshold, pairs in match_values(values, tags[key], thresholds, indexes[key]).items():
+                gold_hits, predicted_hits = hits[threshold]
+                for gold_value, predicted_value in pairs:
+                    gold_hits[m, items[(key, gold_value)]] = 1
+                    predicted_hits[m, items[(key, predicted_value)]] = 1
+    return hits
+
+
+def _scores(hits, gold, predicted, predicted_hits):
+    """ precision, recall and F1 from summed matrices of any matching shape. """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.nan_to_num(predicted_hits / predicted)
+        recall = np.nan_to_num(hits / gold)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    return precision, recall, f1
+
+
+def score_matrix(item_tags, hits, gold, predicted, n_tags, n_bootstrap=2000, seed=0, predicted_hits=None):
+    """ overall and per-tag scores of all models, with bootstrap resamples of the items.
+
+    A resample draws the items with replacement; each draw is a row of item weights,
+    so all resamples of all models and tags are computed with two matrix products.
+    Returns a dictionary of (models,) arrays for the overall scores and (models, tags)
+    arrays for the per-tag scores, each also as (bootstrap, ...) resamples.
+    predicted_hits are the hits counted for precision if they differ from hits, as for fuzzy matches. """
+    if predicted_hits is None:
+        predicted_hits = hits
+    n_models, n_items = hits.shape
+    tag_mask = np.zeros((n_tags, n_items))
+    tag_mask[item_tags, np.arange(n_items)] = 1
+
+    # (models x tags) sums per matrix, stacked as one (items x 4*models*tags) operand
+    operand = np.stack([matrix[:, None, :] * tag_mask[None, :, :] for matrix in (hits, gold, predicted, predicted_hits)])
+    operand = operand.reshape(-1, n_items).T
+
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(n_items, np.full(n_items, 1 / n_items), size=n_bootstrap).astype(float)
+    full = np.ones((1, n_items)) @ operand
+    resampled = weights @ operand
+
+    def summed_scores(sums):
+        sums = sums.reshape(len(sums), 4, n_models, n_tags)
+        overall = _scores(*(sums[:, k].sum(axis=2) for k in range(4)))
+        per_tag = _scores(*(sums[:, k] for k in range(4)))
+        metrics = ("precision", "recall", "f1")
+        return {**dict(zip(metrics, overall)), **{f"tag_{metric}": values for metric, values in zip(metrics, per_tag)}}
+
+    result = {key: values[0] for key, values in summed_scores(full).items()}
+    result.update({f"bootstrap_{key}": values for key, values in summed_scores(resampled).items()})
+    return result
+
+
+def confidence_interval(samples, level=0.95):
+    """ percentile interval over the first (bootstrap) axis. """
+    return np.percentile(samples, [50 * (1 - level), 50 * (1 + level)], axis=0)
+
+
+def format_table(model_names, tag_names, scores, level=0.95):
+    """ one table of all models sorted by F1, followed by the per-tag F1 scores. """
+    f1_low, f1_high = confidence_interval(scores["bootstrap_f1"], level)
+    tag_low, tag_high = confidence_interval(scores["bootstrap_tag_f1"], level)
+    order = np.argsort(-scores["f1"], kind="stable")
+    width = max(len(name) for name in model_names)
+    percent = f"{level:.0%}"
+
+    lines = [f"{'model':<{width}}  precision  recall  f1      f1 {percent} CI",
+             f"{'-' * width}  ---------  ------  ------  ---------------"]
+    for m in order:
+        lines.append(f"{model_names[m]:<{width}}  {scores['precision'][m]:.4f}     {scores['recall'][m]:.4f}  "
+                     f"{scores['f1'][m]:.4f}  [{f1_low[m]:.4f}, {f1_high[m]:.4f}]")
+
+    lines += ["", f"per-tag f1 ({percent} CI)"]
+    for t, tag in enumerate(tag_names):
+        lines.append(f"{tag}:")
+        for m in order:
+            lines.append(f"  {model_names[m]:<{width}}  {scores['tag_f1'][m, t]:.4f}  "
+                         f"[{tag_low[m, t]:.4f}, {tag_high[m, t]:.4f}]")
+    return "\n".join(lines) + "\n"
+
+
+def format_fuzzy_table(model_names, fuzzy_scores, level=0.95):
+    """ F1 and its confidence interval of all models at each similarity threshold. """
+    thresholds = list(fuzzy_scores)
+    width = max(len(name) for name in model_names)
+    intervals = {threshold: confidence_interval(scores["bootstrap_f1"], level)
+                 for threshold, scores in fuzzy_scores.items()}
+    order = np.argsort(-fuzzy_scores[thresholds[0]]["f1"], kind="stable")
+
+    lines = [f"{'model':<{width}}" + "".join(f"  {f'f1 at {threshold:.2f}':<23}" for threshold in thresholds).rstrip()]
+    for m in order:
+        lines.append(f"{model_names[m]:<{width}}" + "".join(
+            f"  {fuzzy_scores[threshold]['f1'][m]:.4f} [{intervals[threshold][0][m]:.4f}, {intervals[threshold][1][m]:.4f}]"
+            for threshold in thresholds))
+    return "\n".join(lines) + "\n"
+
+
+def score_models(ground_truth_tags, predictions, n_bootstrap=2000, seed=0, thresholds=()):
+    """ scores the tags of all models against the ground truth and returns the result table.
+    With similarity thresholds, fuzzy matching F1 scores at each threshold are added."""
+    with metrics.timer("score") as stage:
+        stage.items = len(predictions)
+        tag_names, item_tags, hits, gold, predicted = build_hit_matrix(ground_truth_tags, predictions)
+        # per-tag rows only for the tags of the ground truth
+        scores = score_matrix(item_tags, hits, gold, predicted, len(tag_names), n_bootstrap, seed)
+    shown = [t for t, tag in enumerate(tag_names) if tag in ground_truth_tags]
+    for key in ("tag_precision", "tag_recall", "tag_f1"):
+        scores[key] = scores[key][:, shown]
+        scores[f"bootstrap_{key}"] = scores[f"bootstrap_{key}"][:, :, shown]
+
+    table = format_table(list(predictions), [tag_names[t] for t in shown], scores)
+    if thresholds:
+        with metrics.timer("fuzzy_score") as stage:
+            stage.items = len(predictions)
+            fuzzy_scores = {
+                threshold: score_matrix(item_tags, gold_hits, gold, predicted, len(tag_names), n_bootstrap, seed,
+                                        predicted_hits=predicted_hits)
+                for threshold, (gold_hits, predicted_hits) in fuzzy_hit_matrices(ground_truth_tags, predictions, thresholds).items()
+            }
+        table += f"\nfuzzy matching ({len(thresholds)} similarity thresholds)\n"
+        table += format_fuzzy_table(list(predictions), fuzzy_scores)
+    return table
+
+
+def write_results(table, n_bootstrap):
+    print(table)
     with open(result_file, 'w') as f:
-        for filename in os.listdir(prediction_files_dir):
-            if filename.endswith('.txt'):
-                prediction_tags = read_tags(os.path.join(prediction_files_dir, filename))
-                precision, recall, f1 = compare_tags(ground_truth_tags, prediction_tags)
-            
-                result_str =  f"results for {filename}:\n" + \
-                              f"precision: {precision:.4f}\n" + \
-                              f"recall: {recall:.4f}\n" + \
-                              f"f1 score: {f1:.4f}\n\n"
-                
-                print(result_str)
-                
-                f.write(result_str)
+        f.write(f"{n_bootstrap} bootstrap resamples of the tagged items\n\n")
+        f.write(table)
+
+
+def main(ground_truth_file, prediction_files_dir, n_bootstrap=2000, seed=0, thresholds=()):
+    """ compares ground truth tags with prediction tags from all files in a directory
+    and writes one table with bootstrap confidence intervals to the result file."""
+    ground_truth_tags = read_tags(ground_truth_file)
+    predictions = {
+        filename: read_tags(os.path.join(prediction_files_dir, filename))
+        for filename in sorted(os.listdir(prediction_files_dir)) if filename.endswith('.txt')
+    }
+    write_results(score_models(ground_truth_tags, predictions, n_bootstrap, seed, thresholds), n_bootstrap)
+
+
+def tags_from_entries(entries):
+    """ the (tag, value) pairs of extract_bibl_tags as a dictionary like read_tags returns. """
+    tags_dict = {}
+    for key, value in entries:
+        tags_dict.setdefault(key, []).append(value)
+    return tags_dict
+
+
+def _inline_file_tags(paths):
+    """ extracts the tags of one inline annotated file, optionally writing its standoff file. """
+    input_path, standoff_path = paths
+    with open(input_path, 'r', encoding='utf-8') as file:
+        entries = extract_bibl_tags(file.read())
+    if standoff_path and entries:
+        write_standoff(entries, standoff_path)
+    return tags_from_entries(entries)
+
+
+def load_inline_predictions(inline_dir, standoff_dir=None, workers=1):
+    """ extracts the tags of all inline annotated files in a directory, in parallel with
+    several workers. Files without any BIBL tag (e.g. the unannotated input) are skipped.
+    Returns a dictionary from filename to tags. """
+    filenames = sorted(filename for filename in os.listdir(inline_dir) if filename.endswith('.txt'))
+    if standoff_dir:
+        os.makedirs(standoff_dir, exist_ok=True)
+    paths = [(os.path.join(inline_dir, filename),
+              os.path.join(standoff_dir, filename) if standoff_dir else None) for filename in filenames]
+
+    with metrics.timer("extract") as stage:
+        stage.items = len(paths)
+        if workers > 1:
+            with multiprocessing.Pool(min(workers, len(paths))) as pool:
+                all_tags = pool.map(_inline_file_tags, paths)
+        else:
+            all_tags = [_inline_file_tags(file_paths) for file_paths in paths]
+
+    predictions = {}
+    for filename, tags in zip(filenames, all_tags):
+        if tags:
+            predictions[filename] = tags
+        else:
+            print(f"Skipped {filename}: no BIBL tags")
+    return predictions
+
+
+def main_inline(ground_truth_inline_file, inline_dir, standoff_dir=None, workers=1,
+                n_bootstrap=2000, seed=0, thresholds=()):
+    """ converts and scores the inline annotated model outputs in memory, without the
+    standoff files as intermediate step; writing them is optional. Tags are taken directly
+    from the extracted entries, so values containing ': ' or line breaks stay intact."""
+    with open(ground_truth_inline_file, 'r', encoding='utf-8') as file:
+        ground_truth_tags = tags_from_entries(extract_bibl_tags(file.read()))
+    predictions = load_inline_predictions(inline_dir, standoff_dir, workers)
+    write_results(score_models(ground_truth_tags, predictions, n_bootstrap, seed, thresholds), n_bootstrap)
+
+
+def aligned_hit_matrices(counts_by_model):
+    """ matrices like those of build_hit_matrix for the per-ad aligned counts of
+    align_bibls.align_models; every (ad, tag) pair is one item. """
+    items = {}
+    for model_counts in counts_by_model.values():
+        for ad, tag_counts in model_counts.items():
+            for tag in tag_counts:
+                items.setdefault((ad, tag), len(items))
+    tag_names = sorted({tag for _, tag in items})
+    item_tags = np.array([tag_names.index(tag) for _, tag in items], dtype=np.intp)
+
+    counts = np.zeros((3, len(counts_by_model), len(items)))
+    for m, model_counts in enumerate(counts_by_model.values()):
+        for ad, tag_counts in model_counts.items():
+            for tag, values in tag_counts.items():
+                counts[:, m, items[(ad, tag)]] = values
+    hits, gold, predicted = counts
+    return tag_names, item_tags, hits, gold, predicted
+
+
+def main_aligned(ground_truth_inline_file, inline_dir, workers=1, cache_path=None, n_bootstrap=2000, seed=0):
+    """ scores the inline annotated model outputs per ad, with BIBL entries aligned
+    to the ground truth entries of the same ad (see align_bibls.py). """
+    gold_ads = load_ads(ground_truth_inline_file)
+    predicted_ads = {filename: load_ads(os.path.join(inline_dir, filename))
+                     for filename in sorted(os.listdir(inline_dir)) if filename.endswith('.txt')}
+    predicted_ads = {filename: ads for filename, ads in predicted_ads.items() if any(ad.bibls for ad in ads)}
+
+    with metrics.timer("align") as stage:
+        stage.items = len(predicted_ads)
+        counts = align_models(gold_ads, predicted_ads, SimilarityCache(cache_path), workers)
+    tag_names, item_tags, hits, gold, predicted = aligned_hit_matrices(counts)
+    scores = score_matrix(item_tags, hits, gold, predicted, len(tag_names), n_bootstrap, seed)
+    table = "per-ad aligned evaluation\n" + format_table(list(predicted_ads), tag_names, scores)
+    write_results(table, n_bootstrap)
 
 
 ground_truth_file = 'groundtruth/eval_set_small_standoff.txt'
+ground_truth_inline_file = 'groundtruth/eval_set_small.txt'
+inline_files_dir = 'tests_llm_requests'
 prediction_files_dir = 'tests_standoff_tags'
 result_file = 'model_comparison_results.txt'
 
 if __name__ == "__main__":
-    main(ground_truth_file, prediction_files_dir)
-
-
+    parser = argparse.ArgumentParser(description="Compare the standoff tags of several models with the ground truth.")
+    parser.add_argument("--bootstrap", type=int, default=2000, help="number of bootstrap resamples")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fuzzy", type=float, nargs="+", metavar="THRESHOLD",
+                        help="also score fuzzy matches at these similarity thresholds, e.g. 1.0 0.95 0.9 0.8")
+    parser.add_argument("--inline", action="store_true",
+                        help=f"convert and score the inline annotations in {inline_files_dir} in one pass")
+    parser.add_argument("--write-standoff", action="store_true",
+                        help=f"with --inline, also write the standoff files to {prediction_files_dir}")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="with --inline or --aligned, number of processes (0 = all cores)")
+    parser.add_argument("--aligned", action="store_true",
+                        help=f"score the inline annotations in {inline_files_dir} per ad with aligned BIBL entries")
+    parser.add_argument("--similarity-cache", metavar="PATH",
+                        help="with --aligned, JSON Lines file to cache the BIBL similarity matrices in")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    with metrics.session(args, "compare_llms"):
+        if args.aligned:
+            main_aligned(ground_truth_inline_file, inline_files_dir, args.workers or multiprocessing.cpu_count(),
+                         args.similarity_cache, args.bootstrap, args.seed)
+        elif args.inline:
+            main_inline(ground_truth_inline_file, inline_files_dir,
+                        prediction_files_dir if args.write_standoff else None,
+                        args.workers or multiprocessing.cpu_count(), args.bootstrap, args.seed, args.fuzzy or ())
+        else:
+            main(ground_truth_file, prediction_files_dir, args.bootstrap, args.seed, args.fuzzy or ())
@@ -1,5 +1,8 @@
 import re
 import os
+import struct
+import sys
+from collections import namedtuple
 
 def clean_inner_tags(content):
     """ removes all inner tags for BIBL tag. """
@@ -43,11 +46,160 @@ def process_file(input_path, output_path):
         text = file.read()
 
     tags_data = extract_bibl_tags(text)
+    # unannotated inputs like the test set itself have no BIBL, and no standoff file
+    if tags_data:
+        write_standoff(tags_data, output_path)
 
-    # write results to output file in specific standoff format
+def write_standoff(tags_data, output_path):
+    """ writes (tag, content) pairs to output file in specific standoff format. """
     with open(output_path, 'w', encoding='utf-8') as file:
         file.writelines(f"{entry[0]}: {entry[1]}\n" for entry in tags_data)
 
+# one entity of an ad: start and end are character offsets in the de-tagged ad text
+Span = namedtuple("Span", ["ad", "tag", "start", "end", "text"])
+
+MARKUP_RE = re.compile(r"<[^>]+>")
+TAG_RE = re.compile(r"<(/?)(\w+)>")
+
+def extract_spans(line, ad=0, bibl_only=True):
+    """ extracts the entities of one ad (one line of inline annotated text) with their
+    offsets in the de-tagged text, in the order their opening tags appear. nested tags
+    get offsets in the same de-tagged text. a closing tag closes the innermost open tag
+    of the same name; tags that are never closed are dropped, other markup like <BR/> is
+    removed from the text as in clean_inner_tags. with bibl_only, only BIBL
+    and the tags inside a BIBL are returned, as in extract_bibl_tags.
+    returns the de-tagged text and the list of spans. """
+    plain = []
+    length = 0
+    stack = []
+    spans = []
+    position = 0
+    for markup in MARKUP_RE.finditer(line):
+        text = line[position:markup.start()]
+        plain.append(text)
+        length += len(text)
+        position = markup.end()
+        match = TAG_RE.fullmatch(markup.group(0))
+        if match is None:
+            continue
+        closing, tag = match.group(1), match.group(2)
+        if not closing:
+            stack.append((tag, length, len(spans)))
+            spans.append(None)
+            continue
+        for depth in range(len(stack) - 1, -1, -1):
+            if stack[depth][0] == tag:
+                break
+        else:
+            continue
+        # tags opened inside the closed one and still open are dropped
+        del stack[depth + 1:]
+        _, start, order = stack.pop()
+        inside_bibl = tag == "BIBL" or any(open_tag == "BIBL" for open_tag, _, _ in stack)
+        if not bibl_only or inside_bibl:
+            spans[order] = (tag, start, length)
+    plain.append(line[position:])
+    plain = "".join(plain)
+
+    result = []
+    for span in spans:
+        if span is None:
+            continue
+        tag, start, end = span
+        # offsets of the stripped text, as extract_bibl_tags strips the contents
+        while start < end and plain[start].isspace():
+            start += 1
+        while end > start and plain[end - 1].isspace():
+            end -= 1
+        result.append(Span(ad, tag, start, end, plain[start:end]))
+    return plain, result
+
+def iter_ads(lines, bibl_only=True):
+    """ yields (ad index, de-tagged text, spans) for every ad, one input line per ad,
+    e.g. of an open file. only one line is held in memory at a time. """
+    for ad, line in enumerate(lines):
+        text, spans = extract_spans(line.rstrip("\n"), ad, bibl_only)
+        yield ad, text, spans
+
+def iter_spans(lines, bibl_only=True):
+    """ yields the spans of all ads, see iter_ads. """
+    for _, _, spans in iter_ads(lines, bibl_only):
+        yield from spans
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def _unescape(text):
+    return re.sub(r"\\(.)", lambda m: {"t": "\t", "n": "\n", "r": "\r"}.get(m.group(1), m.group(1)), text)
+
+def write_spans_tsv(spans, output_file):
+    """ writes spans as TSV lines ad, tag, start, end, text to an open text file.
+    tabs, line breaks and backslashes in the text are escaped. """
+    for span in spans:
+        output_file.write(f"{span.ad}\t{span.tag}\t{span.start}\t{span.end}\t{_escape(span.text)}\n")
+
+def read_spans_tsv(input_file):
+    """ yields the spans of a TSV file written by write_spans_tsv. """
+    for line in input_file:
+        ad, tag, start, end, text = line.rstrip("\n").split("\t")
+        yield Span(int(ad), tag, int(start), int(end), _unescape(text))
+
+# binary format: per ad with spans, the ad index, the offset of the first span and the UTF-8
+# length of the de-tagged text from there to the end of the last span as uint32, that text,
+# the number of spans as uint32, and per span the tag length as uint8, the tag, and start and
+# end as uint32. span texts are slices of the stored text, so every character is stored once.
+SPANS_MAGIC = b"SPN2"
+_AD = struct.Struct("<III")
+_COUNT = struct.Struct("<I")
+_OFFSETS = struct.Struct("<II")
+
+def write_spans_binary(ads, output_file):
+    """ writes the (ad, text, spans) tuples of iter_ads in the compact binary format to an
+    open binary file. ads without spans are left out. """
+    output_file.write(SPANS_MAGIC)
+    for ad, text, spans in ads:
+        if not spans:
+            continue
+        first = min(span.start for span in spans)
+        encoded = text[first:max(span.end for span in spans)].encode("utf-8")
+        parts = [_AD.pack(ad, first, len(encoded)), encoded, _COUNT.pack(len(spans))]
+        for span in spans:
+            tag = span.tag.encode("utf-8")
+            parts += [bytes([len(tag)]), tag, _OFFSETS.pack(span.start, span.end)]
+        output_file.write(b"".join(parts))
+
+def _read_exactly(input_file, size):
+    data = input_file.read(size)
+    if len(data) != size:
+        raise ValueError("Truncated binary spans file")
+    return data
+
+def read_spans_binary(input_file):
+    """ yields the spans of a binary file written by write_spans_binary. """
+    if input_file.read(len(SPANS_MAGIC)) != SPANS_MAGIC:
+        raise ValueError("Not a binary spans file")
+    while True:
+        header = input_file.read(_AD.size)
+        if not header:
+            return
+        ad, first, text_length = _AD.unpack(header)
+        text = _read_exactly(input_file, text_length).decode("utf-8")
+        count, = _COUNT.unpack(_read_exactly(input_file, _COUNT.size))
+        for _ in range(count):
+            tag = _read_exactly(input_file, _read_exactly(input_file, 1)[0]).decode("utf-8")
+            start, end = _OFFSETS.unpack(_read_exactly(input_file, _OFFSETS.size))
+            yield Span(ad, tag, start, end, text[start - first:end - first])
+
+def process_file_spans(input_path, output_path, binary=False):
+    """ streams a single file ad by ad into a TSV or binary spans file, in constant memory. """
+    with open(input_path, 'r', encoding='utf-8') as file:
+        if binary:
+            with open(output_path, 'wb') as output_file:
+                write_spans_binary(iter_ads(file), output_file)
+        else:
+            with open(output_path, 'w', encoding='utf-8') as output_file:
+                write_spans_tsv(iter_spans(file), output_file)
+
 # process all .txt files in input directory, write outputs to output directory
 def process_directory(input_dir, output_dir):
     if not os.path.exists(output_dir):
@@ -74,8 +226,17 @@ def main():
     output_dir = 'tests_standoff_tags'
     process_directory(input_dir, output_dir)
 
+def main_spans(input_path, output_path):
+    """ converts one inline annotated file to spans, binary if the output path ends with .bin. """
+    process_file_spans(input_path, output_path, binary=output_path.endswith(".bin"))
+    print(f"Processed {input_path}")
+
 if __name__ == "__main__":
-    main()
+    # python convert_inline_to_standoff.py INPUT OUTPUT(.tsv|.bin) writes per-ad spans
+    if len(sys.argv) == 3:
+        main_spans(sys.argv[1], sys.argv[2])
+    else:
+        main()
 
 
  
\ No newline at end of file
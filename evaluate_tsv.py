@@ -1,9 +1,16 @@
+import argparse
 import csv
+import hashlib
+import json
 from xml.etree import ElementTree as ET
-from collections import Counter
+from collections import Counter, deque
 import io
+import multiprocessing
 import os
 import re
+import time
+
+import metrics
 
 def escape_xml_text(text: str) -> str:
     """
@@ -38,9 +45,10 @@ def check_overlapping_tags(xml_string):
                     tags.pop()
     return not not tags # Returns True if there are unclosed tags at the end
 
-def analyze_annotations(xml_string: str):
+def analyze_annotations_etree(xml_string: str):
     """
-    Performs an analysis of the inline XML annotations.
+    Performs an analysis of the inline XML annotations
+    with a full ElementTree parse (reference implementation).
 
     Args:
         xml_string: The string containing the annotated text.
@@ -54,6 +62,7 @@ def analyze_annotations(xml_string: str):
         "has_overlapping_tags": True,
         "tags_used": [],
         "tag_counts": {},
+        "error_position": None,
     }
 
     safe_xml_string = escape_xml_text(xml_string)
@@ -74,11 +83,156 @@ def analyze_annotations(xml_string: str):
 
     return analysis
 
-def process_tsv(input_filepath, output_filepath):
+ANNOTATION_TAGS = ("ITEM", "BIBL", "AUTHOR", "TITLE", "YEAR", "PLACE", "FORMAT", "VOLUME", "PRIZE")
+
+# matches the simple opening/closing tags of our tag set, and everything
+# the simple tokenizer cannot decide on its own: any other '<', ']]>'
+# and characters that are not allowed in XML
+_TOKEN_RE = re.compile(
+    r"<(/?)(" + "|".join(ANNOTATION_TAGS) + r")>"
+    r"|<|\]\]>"
+    r"|[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]"
+)
+
+
+def analyze_annotations(xml_string: str):
+    """
+    Performs an analysis of the inline XML annotations in a single pass
+    over the string, using a tokenizer for our fixed tag set.
+
+    Gives the same results as analyze_annotations_etree. Strings that
+    use anything beyond plain tags of ANNOTATION_TAGS (attributes, other
+    tag names, comments, ...) are handed to analyze_annotations_etree,
+    and so are malformed strings, to get the parser's error message.
+
+    Args:
+        xml_string: The string containing the annotated text.
+
+    Returns:
+        A dictionary with the analysis results. "error_position" is the
+        character offset of the first mismatched closing tag or of the
+        innermost unclosed opening tag, None if the string is well-formed.
+    """
+    stack = []
+    all_tags = []
+    for match in _TOKEN_RE.finditer(xml_string):
+        tag = match.group(2)
+        if tag is None:
+            return analyze_annotations_etree(xml_string)
+        if match.group(1):
+            if not stack or stack[-1][0] != tag:
+                return _malformed_analysis(xml_string, match.start())
+            stack.pop()
+        else:
+            stack.append((tag, match.start()))
+            all_tags.append(tag)
+
+    if stack:
+        return _malformed_analysis(xml_string, stack[-1][1])
+
+    return {
+        "xml_well_formed": True,
+        "error_message": None,
+        "has_overlapping_tags": False,
+        "tags_used": sorted(set(all_tags)),
+        "tag_counts": dict(Counter(all_tags)),
+        "error_position": None,
+    }
+
+
+def _malformed_analysis(xml_string, position):
+    """ analysis of a string the tokenizer found malformed at position. """
+    analysis = analyze_annotations_etree(xml_string)
+    analysis["error_position"] = position
+    return analysis
+
+
+def benchmark_analyzers(annotations, repeat=3):
+    """
+    Micro-benchmark of analyze_annotations against analyze_annotations_etree
+    on a list of annotation strings. Checks that both give the same results
+    and returns the best time of each in seconds.
+    """
+    for annotation in annotations:
+        fast = analyze_annotations(annotation)
+        reference = analyze_annotations_etree(annotation)
+        fast.pop("error_position")
+        reference.pop("error_position")
+        if fast != reference:
+            raise AssertionError(f"Analyzers disagree on: {annotation}")
+
+    timings = {}
+    for name, analyzer in (("etree", analyze_annotations_etree),
+                           ("single_pass", analyze_annotations)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for annotation in annotations:
+                analyzer(annotation)
+            best = min(best, time.perf_counter() - start)
+        timings[name] = best
+        print(f"  {name}: {best:.3f}s ({len(annotations) / best:.0f} rows/s)")
+    return timings
+
+
+QUALITY_COLUMNS = [
+    "quality_xml_well_formed",
+    "quality_error_message",
+    "quality_has_overlapping_tags",
+    "quality_tags_used",
+    "quality_tag_counts",
+    "quality_summary"
+]
+
+# Assuming the annotation string is in the second column
+ANNOTATION_COL_INDEX = 1
+
+
+def annotate_row(row, annotation_col_index=ANNOTATION_COL_INDEX):
+    """
+    Analyzes the annotation column of a TSV row and returns
+    the row extended by the quality columns.
+    """
+    analysis_results = analyze_annotations(row[annotation_col_index])
+
+    summary = "OK"
+    if not analysis_results["xml_well_formed"]:
+        summary = f"XML_ERROR: {analysis_results['error_message']}"
+    elif analysis_results["has_overlapping_tags"]:
+        summary = "Overlapping tags detected"
+
+    return row + [
+        analysis_results["xml_well_formed"],
+        analysis_results["error_message"],
+        analysis_results["has_overlapping_tags"],
+        ", ".join(analysis_results["tags_used"]),
+        str(analysis_results["tag_counts"]),
+        summary
+    ]
+
+
+def process_tsv(input_filepath, output_filepath, stream=False,
+                batch_size=1000, progress_interval=2.0, workers=1,
+                incremental=False):
     """
     Reads TSV file, analyzes the annotations in one column,
     and writes the results to a new TSV file with additional columns.
+
+    With stream=True, every row is written as soon as it is analyzed
+    (flushed every batch_size rows) and progress is reported at most
+    every progress_interval seconds, so memory stays flat for any input size.
+    workers > 1 analyzes chunks of batch_size rows on a process pool
+    (this implies stream=True), the output keeps the input row order.
+    With incremental=True, only rows appended since the last incremental
+    run are analyzed and appended to the output (see process_tsv_incremental).
     """
+    if incremental:
+        return process_tsv_incremental(input_filepath, output_filepath,
+                                       batch_size=batch_size, workers=workers)
+    if stream or workers > 1:
+        return process_tsv_streaming(input_filepath, output_filepath,
+                                     batch_size, progress_interval, workers)
+
     print(f"Starting analysis of {input_filepath}...")
 
     with open(input_filepath, 'r', newline='', encoding='utf-8') as infile:
@@ -90,43 +244,17 @@ def process_tsv(input_filepath, output_filepath):
             print("ERROR: The input file is empty.")
             return
 
-        # Assuming the annotation string is in the second column
-        annotation_col_index = 1 
-
-        new_header = header + [
-            "quality_xml_well_formed",
-            "quality_error_message",
-            "quality_has_overlapping_tags",
-            "quality_tags_used",
-            "quality_tag_counts",
-            "quality_summary"
-        ]
+        new_header = header + QUALITY_COLUMNS
 
         processed_rows = []
         for i, row in enumerate(reader):
-            if len(row) > annotation_col_index:
+            if len(row) > ANNOTATION_COL_INDEX:
                 doc_id = row[0]
-                annotation_string = row[annotation_col_index]
                 
                 print(f"  Processing row {i+1} (ID: {doc_id})...")
 
-                analysis_results = analyze_annotations(annotation_string)
-
-                summary = "OK"
-                if not analysis_results["xml_well_formed"]:
-                    summary = f"XML_ERROR: {analysis_results['error_message']}"
-                elif analysis_results["has_overlapping_tags"]:
-                    summary = "Overlapping tags detected"
-                
-                new_row = row + [
-                    analysis_results["xml_well_formed"],
-                    analysis_results["error_message"],
-                    analysis_results["has_overlapping_tags"],
-                    ", ".join(analysis_results["tags_used"]),
-                    str(analysis_results["tag_counts"]),
-                    summary
-                ]
-                processed_rows.append(new_row)
+                processed_rows.append(annotate_row(row))
+    record_quality(processed_rows)
 
     with open(output_filepath, 'w', newline='', encoding='utf-8') as outfile:
         writer = csv.writer(outfile, delimiter='\t')
@@ -134,16 +262,241 @@ def process_tsv(input_filepath, output_filepath):
         writer.writerows(processed_rows)
 
     print(f"\nAnalysis complete. Results saved to {output_filepath}")
+    return len(processed_rows)
+
+
+def process_tsv_streaming(input_filepath, output_filepath,
+                          batch_size=1000, progress_interval=2.0, workers=1):
+    """
+    Streaming variant of process_tsv: analyzed rows are written in batches
+    of batch_size while reading, instead of being collected in memory.
+    With workers > 1, the batches are analyzed on a process pool and
+    written in their original order.
+    Returns the number of rows written.
+    """
+    print(f"Starting streaming analysis of {input_filepath}...")
+
+    with open(input_filepath, 'r', newline='', encoding='utf-8') as infile, \
+            open(output_filepath, 'w', newline='', encoding='utf-8') as outfile:
+        reader = csv.reader(infile, delimiter='\t')
+        writer = csv.writer(outfile, delimiter='\t')
+
+        try:
+            header = next(reader)
+        except StopIteration:
+            print("ERROR: The input file is empty.")
+            return 0
+
+        writer.writerow(header + QUALITY_COLUMNS)
+
+        written = 0
+        start = last_report = time.monotonic()
+        for batch in annotated_batches(read_batches(reader, batch_size), workers):
+            writer.writerows(batch)
+            outfile.flush()
+            written += len(batch)
+
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                print_progress(written, now - start)
+
+    print_progress(written, time.monotonic() - start)
+    print(f"\nAnalysis complete. Results saved to {output_filepath}")
+    return written
+
+
+def process_tsv_incremental(input_filepath, output_filepath, checkpoint_filepath=None,
+                            batch_size=1000, workers=1):
+    """
+    Append-only variant of process_tsv for an input TSV that keeps growing.
+
+    A checkpoint (by default next to the output file) stores the byte offset
+    and number of input rows already processed, the size of the output at
+    that point and a fingerprint of the header. If the checkpoint matches,
+    the input is read from the stored offset and only the new rows are
+    analyzed and appended; otherwise the whole file is processed again.
+    A trailing line without newline is left for the next run, since the
+    annotation job may still be writing it. Rows are expected to be single
+    lines, as written by the annotation job.
+    Returns the number of rows written in this run.
+    """
+    checkpoint_filepath = checkpoint_filepath or output_filepath + ".checkpoint.json"
+    checkpoint = load_checkpoint(checkpoint_filepath)
+
+    with open(input_filepath, 'rb') as infile:
+        header_line = infile.readline()
+        if not header_line.endswith(b'\n'):
+            print("ERROR: The input file is empty.")
+            return 0
+        fingerprint = hashlib.sha256(header_line).hexdigest()
+
+        resume = (checkpoint is not None
+                  and checkpoint["header_fingerprint"] == fingerprint
+                  and checkpoint["offset"] <= os.path.getsize(input_filepath)
+                  and os.path.exists(output_filepath)
+                  and os.path.getsize(output_filepath) >= checkpoint["output_offset"])
+
+        if resume:
+            print(f"Resuming analysis of {input_filepath} after row {checkpoint['rows']}...")
+            infile.seek(checkpoint["offset"])
+            # drop rows of an interrupted run that were written after the checkpoint
+            os.truncate(output_filepath, checkpoint["output_offset"])
+            progress = {"offset": checkpoint["offset"], "rows": checkpoint["rows"]}
+            mode = 'a'
+        else:
+            print(f"Starting incremental analysis of {input_filepath} from the beginning...")
+            progress = {"offset": infile.tell(), "rows": 0}
+            mode = 'w'
+
+        with open(output_filepath, mode, newline='', encoding='utf-8') as outfile:
+            writer = csv.writer(outfile, delimiter='\t')
+            if not resume:
+                header = next(csv.reader([header_line.decode('utf-8')], delimiter='\t'))
+                writer.writerow(header + QUALITY_COLUMNS)
+
+            reader = csv.reader(_complete_lines(infile, progress), delimiter='\t')
+            written = 0
+            for batch in annotated_batches(read_batches(reader, batch_size), workers):
+                writer.writerows(batch)
+                written += len(batch)
+
+    save_checkpoint(checkpoint_filepath, {
+        "input": input_filepath,
+        "offset": progress["offset"],
+        "rows": progress["rows"],
+        "output_offset": os.path.getsize(output_filepath),
+        "header_fingerprint": fingerprint,
+    })
+    print(f"Analyzed {written} new rows. Results saved to {output_filepath}")
+    return written
+
+
+def _complete_lines(infile, progress):
+    """
+    Yields the decoded complete lines of a binary file and keeps the
+    byte offset and line count after the last yielded line in progress.
+    """
+    for line in infile:
+        if not line.endswith(b'\n'):
+            break
+        progress["offset"] += len(line)
+        progress["rows"] += 1
+        yield line.decode('utf-8')
+
+
+def load_checkpoint(checkpoint_filepath):
+    """ loads an incremental checkpoint, None if there is none or it is unreadable. """
+    try:
+        with open(checkpoint_filepath, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def save_checkpoint(checkpoint_filepath, checkpoint):
+    """ writes the checkpoint atomically, so an interrupted run keeps the old one. """
+    tmp_filepath = checkpoint_filepath + ".tmp"
+    with open(tmp_filepath, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=4)
+    os.replace(tmp_filepath, checkpoint_filepath)
+
+
+def read_batches(reader, batch_size):
+    """ yields lists of at most batch_size rows that contain an annotation column. """
+    batch = []
+    for row in reader:
+        if len(row) <= ANNOTATION_COL_INDEX:
+            continue
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def annotate_batch(rows):
+    """ annotates a list of rows, used as the unit of work for the process pool. """
+    return [annotate_row(row) for row in rows]
+
+
+def record_quality(rows):
+    """ counts the analyzed rows and their defects in the run metrics. """
+    well_formed_index = -len(QUALITY_COLUMNS)
+    metrics.count("rows_analyzed", len(rows))
+    metrics.count("rows_not_well_formed", sum(1 for row in rows if not row[well_formed_index]))
+    metrics.count("rows_overlapping_tags", sum(1 for row in rows if row[well_formed_index + 2]))
+
+
+def annotated_batches(batches, workers=1):
+    """
+    Yields the annotated version of every batch, in input order.
+    With workers > 1 the batches are spread over a process pool; at most
+    two batches per worker are in flight so memory stays bounded.
+    """
+    if workers <= 1:
+        for batch in batches:
+            annotated = annotate_batch(batch)
+            record_quality(annotated)
+            yield annotated
+        return
+
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.apply_async(annotate_batch, (batch,)))
+            if len(pending) >= 2 * workers:
+                annotated = pending.popleft().get()
+                record_quality(annotated)
+                yield annotated
+        while pending:
+            annotated = pending.popleft().get()
+            record_quality(annotated)
+            yield annotated
+
+
+def print_progress(rows, elapsed):
+    """ prints the number of processed rows and the throughput. """
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    print(f"  {rows} rows processed ({rate:.0f} rows/s)")
 
 
 if __name__ == '__main__':
     INPUT_TSV_FILE = os.path.join("output", "annotated_output_llama3.tsv")
     OUTPUT_TSV_FILE = os.path.join("output", "annotated_output_llama3_evaluated.tsv")
-    
+
+    parser = argparse.ArgumentParser(description="Evaluate the XML annotations of a TSV file.")
+    parser.add_argument("input", nargs="?", default=INPUT_TSV_FILE)
+    parser.add_argument("output", nargs="?", default=OUTPUT_TSV_FILE)
+    parser.add_argument("--stream", action="store_true",
+                        help="write rows while analyzing instead of at the end")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="rows per flush in streaming mode")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only analyze rows added since the last incremental run")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="compare the single-pass analyzer with the ElementTree one on the input")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes (0 = all cores)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    workers = args.workers or os.cpu_count() or 1
+    INPUT_TSV_FILE = args.input
+
     try:
-        process_tsv(INPUT_TSV_FILE, OUTPUT_TSV_FILE)
+        if args.benchmark:
+            with open(args.input, 'r', newline='', encoding='utf-8') as f:
+                rows = list(csv.reader(f, delimiter='\t'))[1:]
+            benchmark_analyzers([row[ANNOTATION_COL_INDEX] for row in rows
+                                 if len(row) > ANNOTATION_COL_INDEX])
+        else:
+            with metrics.session(args, "evaluate_tsv"), metrics.timer("evaluate") as stage:
+                stage.items = process_tsv(args.input, args.output, stream=args.stream,
+                                          batch_size=args.batch_size, workers=workers,
+                                          incremental=args.incremental) or 0
     except FileNotFoundError:
         print(f"\nERROR: The input file was not found at '{INPUT_TSV_FILE}'")
         print("Please update the INPUT_TSV_FILE variable in the script.")
     except Exception as e:
-        print(f"\nAn unexpected error occurred: {e}")
\ No newline at end of file
+        print(f"\nAn unexpected error occurred: {e}")
@@ -0,0 +1,169 @@
+"""
+Fuzzy matching of tag values for the standoff evaluation.
+
+Two values match at a threshold if their normalized edit similarity,
+1 - levenshtein(a, b) / max(len(a), len(b)), is at least the threshold, so
+'Regiment Löbl. Eydgnoßschafft,' matches 'Regiment Löbl. Eydgnoßschafft' at 0.95.
+
+Comparing every predicted value with every ground truth value is quadratic,
+so candidates are blocked with a character q-gram index: by the q-gram lemma,
+strings within edit distance k share at least max(len) + q - 1 - k * q of their
+padded q-grams, and only pairs that pass this count filter (and the length
+filter |len(a) - len(b)| <= k) are compared. For short values at low
+thresholds the bound is 0 or less, so values sharing no q-gram can still
+match; then every value passing the length filter is a candidate.
+"""
+
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+Q = 3
+_PAD = "\0"
+# tolerance for comparing similarities with thresholds
+_EPSILON = 1e-9
+
+
+def qgrams(value: str, q: int = Q) -> Counter:
+    """ multiset of the padded q-grams of a value. """
+    padded = _PAD * (q - 1) + value + _PAD * (q - 1)
+    return Counter(padded[i:i + q] for i in range(len(padded) - q + 1))
+
+
+def levenshtein(a: str, b: str, max_distance: Optional[int] = None) -> int:
+    """
+    Edit distance of two strings. With max_distance, only a diagonal band of
+    the table is computed and max_distance + 1 is returned for larger distances.
+    """
+    # a common prefix and suffix do not change the distance
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is None:
+        max_distance = len(a)
+    if len(a) - len(b) > max_distance:
+        return max_distance + 1
+    if not b:
+        return len(a)
+
+    too_far = max_distance + 1
+    previous = [j if j <= max_distance else too_far for j in range(len(b) + 1)]
+    for i, char_a in enumerate(a, 1):
+        low, high = max(1, i - max_distance), min(len(b), i + max_distance)
+        current = [too_far] * (len(b) + 1)
+        current[0] = i if i <= max_distance else too_far
+        row_min = current[0]
+        for j in range(low, high + 1):
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != b[j - 1]))
+            current[j] = value if value < too_far else too_far
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return too_far
+        previous = current
+    return previous[-1]
+
+
+def similarity(a: str, b: str, threshold: float = 0.0) -> float:
+    """ normalized edit similarity; values below threshold may be returned as 0. """
+    longest = max(len(a), len(b))
+    if not longest:
+        return 1.0
+    max_distance = int((1.0 - threshold) * longest + _EPSILON)
+    distance = levenshtein(a, b, max_distance)
+    return 1.0 - distance / longest if distance <= max_distance else 0.0
+
+
+class QGramIndex:
+    """ q-gram postings of a list of values, for candidate lookup. """
+
+    def __init__(self, values: Sequence[str], q: int = Q):
+        self.values = list(values)
+        self.q = q
+        self.postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        self.by_length: Dict[int, List[int]] = defaultdict(list)
+        for index, value in enumerate(self.values):
+            for gram, count in qgrams(value, q).items():
+                self.postings[gram].append((index, count))
+            self.by_length[len(value)].append(index)
+
+    def _filters(self, length: int, other_length: int, threshold: float) -> Tuple[bool, int]:
+        """ whether two lengths pass the length filter, and the q-grams they must share. """
+        longest = max(length, other_length)
+        max_distance = int((1.0 - threshold) * longest + _EPSILON)
+        return abs(length - other_length) <= max_distance, longest + self.q - 1 - max_distance * self.q
+
+    def candidates(self, value: str, threshold: float) -> List[int]:
+        """ indexes of the values that can have at least the given similarity to value. """
+        grams = qgrams(value, self.q)
+        shared: Dict[int, int] = defaultdict(int)
+        for gram, count in grams.items():
+            for index, indexed_count in self.postings.get(gram, ()):
+                shared[index] += min(count, indexed_count)
+
+        result = []
+        for index, common in shared.items():
+            length_ok, min_common = self._filters(len(value), len(self.values[index]), threshold)
+            if length_ok and common >= min_common:
+                result.append(index)
+        # values without a shared q-gram, for lengths where the count filter does not exclude them
+        for length, indexes in self.by_length.items():
+            length_ok, min_common = self._filters(len(value), length, threshold)
+            if length_ok and min_common <= 0:
+                result.extend(index for index in indexes if index not in shared)
+        return result
+
+
+def match_values(
+    gold_values: Iterable[str],
+    predicted_values: Iterable[str],
+    thresholds: Sequence[float],
+    index: Optional[QGramIndex] = None
+) -> Dict[float, List[Tuple[str, str]]]:
+    """
+    One-to-one fuzzy matching of two sets of values at several thresholds.
+
+    Similarities are computed once for all candidate pairs of the lowest
+    threshold; at each threshold the pairs are then matched greedily, most
+    similar first, so every value is matched at most once.
+
+    Args:
+        gold_values: Ground truth values of one tag
+        predicted_values: Predicted values of the same tag
+        thresholds: Similarity thresholds between 0 and 1
+        index: QGramIndex of sorted(set(gold_values)), to reuse it for several predictions
+
+    Returns:
+        Dictionary from threshold to the list of matched (gold, predicted) pairs
+    """
+    gold = sorted(set(gold_values))
+    predicted = sorted(set(predicted_values))
+    if index is None:
+        index = QGramIndex(gold)
+
+    pairs = []
+    lowest = min(thresholds)
+    for p, value in enumerate(predicted):
+        for g in index.candidates(value, lowest):
+            score = similarity(gold[g], value, lowest)
+            if score >= lowest - _EPSILON:
+                pairs.append((score, g, p))
+    pairs.sort(key=lambda pair: (-pair[0], pair[1], pair[2]))
+
+    matches = {}
+    for threshold in thresholds:
+        used_gold, used_predicted, matched = set(), set(), []
+        for score, g, p in pairs:
+            if score < threshold - _EPSILON:
+                break
+            if g not in used_gold and p not in used_predicted:
+                used_gold.add(g)
+                used_predicted.add(p)
+                matched.append((gold[g], predicted[p]))
+        matches[threshold] = matched
+    return matches
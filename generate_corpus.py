@@ -0,0 +1,218 @@
+"""
+Synthetic annotated ads for benchmarks at the scale of the whole Avisblatt.
+
+The ads are built from templates and word lists modelled on the ground truth:
+an ad number, a bookseller's introduction, then one or more BIBL entries with
+AUTHOR, TITLE, FORMAT, VOLUME, PLACE, YEAR and PRIZE tags, some of them left
+untagged. Every ad exists twice: the clean annotation, used as ground truth,
+and a 'model output' in which inner tags are dropped and a share of the ads
+is malformed like the real LLM output:
+
+- unclosed: an inner closing tag is missing, or its '>' (<TITLEEine ...),
+- overlapping: two inner tags are closed in the wrong order,
+- ampersand: a stray '&' in the text, e.g. 'Gebrüder Thurneysen & Comp.'.
+
+evaluate_tsv.py escapes every '&' before parsing, so it does not flag the
+stray '&'; the consolidation (format_output.xml_to_json_lowercase) parses the
+annotation as it is and reports such an ad as not well-formed.
+
+The generator is seeded, so the same arguments give the same corpus.
+
+Usage:
+    python generate_corpus.py /tmp/corpus --ads 22000
+    python generate_corpus.py /tmp/corpus --ads 1000000 --bibls 1-6 --unclosed-rate 0.1
+"""
+
+import argparse
+import csv
+import os
+import random
+import uuid
+from typing import Any, Dict, Iterator, List, Tuple
+
+INTRODUCTIONS = [
+    "Bey Herrn {seller} dem Buchbinder sind folgende Bücher zu verkauffen:",
+    "Bey Herrn {seller}, in der {street}, sind zu haben:",
+    "Bey {seller} seind, nebst vielen andern, folgende Bücher in billichem Preiß zu haben.",
+    "Es ist bey Herrn {seller} Buchdrucker in der {street} zu haben:",
+    "Folgende Bücher sind um billichen Preiß zu verkauffen, bey {seller}:",
+]
+SELLERS = ["Daniel Haag", "M. Hemminger", "Joh. Conrad von Mechel", "Nicolaus Köllner", "Joh. Friederich Samson",
+           "Emanuel Thurneysen", "Joh. Rudolf Im-Hof", "Joh. Schweighauser"]
+STREETS = ["Steinen-Vorstadt", "Eschemer-Vorstadt", "Freyen Strass", "Spahlen-Vorstadt", "St. Johann-Vorstadt"]
+AUTHORS = ["Moreri", "Simlers", "Menantes", "Kyburtzens", "Würsteysens", "Breitingers", "Gellerts", "Hübners",
+           "Hen. Cars Drelincourts", "Justi Lipsii", "Zollikofers", "Lavaters", "Spreng", "Iselins", "Bernoulli"]
+TITLES = ["Dictionaire", "Atlas", "Regiment Löbl. Eydgnoßschafft", "Brieffsteller", "Kinder-Bibel",
+          "Baßler-Chronick", "Griechische Bibel", "Psalmbuch", "Hand-Bibel in Holländischer Sprach",
+          "Auserlesene Geistliche Lieder", "Epistolarum Centuriae", "Liebreiche Besuche", "Geographie",
+          "Zeitungs-Lexicon", "Betrachtungen über die Werke Gottes", "Gebett-Buch", "Historie der Stadt Basel",
+          "Physicalische Belustigungen", "Neues Testament", "Catechismus"]
+FORMATS = ["fol.", "4tò", "8vò", "4to.", "8.", "12mo", "in Fol."]
+VOLUMES = ["6. Tom.", "2. Tom", "10. Theil", "3 Bände", "2. Theil", "4. Vol."]
+PLACES = ["Basel", "Zürich", "Leipz.", "Nürnberg", "Augsburg", "Argent.", "Bern", "Franckfurt"]
+PRIZES = ["54 kr.", "fl. 1. 36 kr.", "7 Btz.", "3 bz.", "kr. 30.", "fl. 4.", "10 Batzen", "à 36. kr.", "xr. 12."]
+FILLERS = ["gantz neu", "in Frantzös. schem Band", "mit Kupfer", "wohl-conditionirt", "in Leder gebunden",
+           "mit silbernen Schlossen", "samt anderen"]
+# default share of ads with each malformation, see model_output
+MALFORMATION_RATES = {"unclosed_rate": 0.05, "overlap_rate": 0.03, "ampersand_rate": 0.02}
+
+
+def _value(rng: random.Random, tag: str) -> str:
+    if tag == "YEAR":
+        return str(rng.randint(1690, 1840))
+    return rng.choice({"AUTHOR": AUTHORS, "TITLE": TITLES, "FORMAT": FORMATS, "VOLUME": VOLUMES,
+                       "PLACE": PLACES, "PRIZE": PRIZES}[tag])
+
+
+def generate_bibl(rng: random.Random, inner_tag_rate: float = 0.85) -> List[Tuple[str, str]]:
+    """ the parts of one BIBL entry as (tag, text); the tag is None for untagged text. """
+    parts = []
+    fields = ["TITLE"]
+    if rng.random() < 0.7:
+        fields.insert(0, "AUTHOR")
+    fields += [tag for tag, rate in (("FORMAT", 0.6), ("VOLUME", 0.25), ("PLACE", 0.3), ("YEAR", 0.3),
+                                     ("PRIZE", 0.4)) if rng.random() < rate]
+    for tag in fields:
+        if parts:
+            parts.append((None, rng.choice([" ", ", ", " in ", ". "])))
+        parts.append((tag if rng.random() < inner_tag_rate else None, _value(rng, tag)))
+    if rng.random() < 0.4:
+        parts.append((None, f", {rng.choice(FILLERS)}"))
+    parts.append((None, "."))
+    return parts
+
+
+def generate_ad(rng: random.Random, number: int, bibls: Tuple[int, int] = (1, 4),
+                inner_tag_rate: float = 0.85) -> List[List[Tuple[str, str]]]:
+    """ the BIBL entries of one ad, the introduction as an untagged first entry. """
+    introduction = rng.choice(INTRODUCTIONS).format(seller=rng.choice(SELLERS), street=rng.choice(STREETS))
+    return [[(None, f"{number}. {introduction}")]] + [generate_bibl(rng, inner_tag_rate)
+                                                       for _ in range(rng.randint(*bibls))]
+
+
+def render(entries: List[List[Tuple[str, str]]]) -> str:
+    """ the inline annotation of an ad as produced by generate_ad. """
+    rendered = [entries[0][0][1]]
+    for parts in entries[1:]:
+        inner = "".join(text if tag is None else f"<{tag}>{text}</{tag}>" for tag, text in parts)
+        rendered.append(f"<BIBL>{inner}</BIBL>")
+    return " ".join(rendered)
+
+
+def model_output(rng: random.Random, entries: List[List[Tuple[str, str]]], tag_drop_rate: float = 0.1,
+                 unclosed_rate: float = MALFORMATION_RATES["unclosed_rate"],
+                 overlap_rate: float = MALFORMATION_RATES["overlap_rate"],
+                 ampersand_rate: float = MALFORMATION_RATES["ampersand_rate"]) -> str:
+    """ the annotation of an ad with the errors of an LLM, see the module docstring. """
+    entries = [[(tag if tag is None or rng.random() >= tag_drop_rate else None, text) for tag, text in parts]
+               for parts in entries]
+    text = render(entries)
+    inner_tags = [tag for parts in entries[1:] for tag, _ in parts if tag]
+
+    if inner_tags and rng.random() < unclosed_rate:
+        tag = rng.choice(inner_tags)
+        if rng.random() < 0.5:
+            text = text.replace(f"</{tag}>", "", 1)
+        else:
+            text = text.replace(f"<{tag}>", f"<{tag}", 1)
+    if rng.random() < overlap_rate:
+        # <A>x</A> <B>y</B> -> <A>x <B>y</A></B>
+        for parts in entries[1:]:
+            tagged = [(tag, value) for tag, value in parts if tag]
+            if len(tagged) >= 2:
+                (first, first_value), (second, second_value) = tagged[:2]
+                original = f"<{first}>{first_value}</{first}>"
+                start = text.find(original)
+                end = text.find(f"</{second}>", start)
+                if start >= 0 and end >= 0:
+                    text = (text[:start] + f"<{first}>{first_value}" + text[start + len(original):end]
+                            + f"</{first}></{second}>" + text[end + len(second) + 3:])
+                break
+    if rng.random() < ampersand_rate:
+        position = text.rfind("</BIBL>")
+        text = text[:position] + " Gebr. Thurneysen & Comp." + text[position:] if position >= 0 else text + " &"
+    return text
+
+
+def generate_corpus(count: int, seed: int = 0, bibls: Tuple[int, int] = (1, 4), inner_tag_rate: float = 0.85,
+                    **error_rates: float) -> Iterator[Tuple[str, str, str]]:
+    """
+    Generates (id, clean annotation, model output) for count ads.
+
+    Args:
+        count: Number of ads
+        seed: Seed for the random generator
+        bibls: Inclusive range of the number of BIBL entries per ad
+        inner_tag_rate: Share of the inner fields that are tagged in the clean annotation
+        error_rates: tag_drop_rate, unclosed_rate, overlap_rate and ampersand_rate of model_output
+    """
+    rng = random.Random(seed)
+    for number in range(1, count + 1):
+        ad_id = f"{uuid.UUID(int=rng.getrandbits(128))}/t{rng.randint(1, 12)}"
+        entries = generate_ad(rng, number, bibls, inner_tag_rate)
+        yield ad_id, render(entries), model_output(rng, entries, **error_rates)
+
+
+def write_corpus(output_dir: str, count: int, seed: int = 0, **options) -> Dict[str, str]:
+    """
+    Writes a corpus to output_dir:
+
+    - all_bib_items_annotated.tsv: id and annotation (<ITEM>model output</ITEM>),
+      the input of evaluate_tsv.py
+    - groundtruth.txt: the clean annotations, one ad per line
+    - predictions.txt: the model outputs, one ad per line, like tests_llm_requests
+
+    Returns the paths by name ('tsv', 'groundtruth', 'predictions').
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {"tsv": os.path.join(output_dir, "all_bib_items_annotated.tsv"),
+             "groundtruth": os.path.join(output_dir, "groundtruth.txt"),
+             "predictions": os.path.join(output_dir, "predictions.txt")}
+    with open(paths["tsv"], "w", encoding="utf-8", newline="") as tsv_file, \
+            open(paths["groundtruth"], "w", encoding="utf-8") as groundtruth_file, \
+            open(paths["predictions"], "w", encoding="utf-8") as predictions_file:
+        writer = csv.writer(tsv_file, delimiter="\t")
+        writer.writerow(["id", "annotation"])
+        for ad_id, clean, output in generate_corpus(count, seed, **options):
+            writer.writerow([ad_id, f"<ITEM>{output}</ITEM>"])
+            groundtruth_file.write(clean + "\n")
+            predictions_file.write(output + "\n")
+    return paths
+
+
+def _parse_range(text: str) -> Tuple[int, int]:
+    low, _, high = text.partition("-")
+    return int(low), int(high or low)
+
+
+def add_arguments(parser):
+    """ adds the options of the corpus (entries per ad and error rates) to an argparse parser. """
+    group = parser.add_argument_group("corpus")
+    group.add_argument("--bibls", type=_parse_range, default=(1, 4), help="BIBL entries per ad, e.g. 1-4")
+    group.add_argument("--inner-tag-rate", type=float, default=0.85, help="share of tagged inner fields")
+    group.add_argument("--tag-drop-rate", type=float, default=0.1, help="share of inner tags the model misses")
+    group.add_argument("--unclosed-rate", type=float, default=MALFORMATION_RATES["unclosed_rate"],
+                       help="share of ads with an unclosed tag")
+    group.add_argument("--overlap-rate", type=float, default=MALFORMATION_RATES["overlap_rate"],
+                       help="share of ads with overlapping tags")
+    group.add_argument("--ampersand-rate", type=float, default=MALFORMATION_RATES["ampersand_rate"],
+                       help="share of ads with a stray '&'")
+
+
+def corpus_options(args) -> Dict[str, Any]:
+    """ the keyword arguments of write_corpus from the options added by add_arguments. """
+    return {"bibls": args.bibls, "inner_tag_rate": args.inner_tag_rate, "tag_drop_rate": args.tag_drop_rate,
+            "unclosed_rate": args.unclosed_rate, "overlap_rate": args.overlap_rate,
+            "ampersand_rate": args.ampersand_rate}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic corpus of annotated ads.")
+    parser.add_argument("output_dir")
+    parser.add_argument("--ads", type=int, default=22000, help="number of ads")
+    parser.add_argument("--seed", type=int, default=0)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    paths = write_corpus(args.output_dir, args.ads, args.seed, **corpus_options(args))
+    print(f"Wrote {args.ads} ads to {', '.join(paths.values())}")
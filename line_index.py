@@ -0,0 +1,216 @@
+"""
+Random access to the lines of large text and TSV files through a sidecar offset index.
+
+Reading line 1504 of incorrect_tags.txt or one record of
+all_bib_items_annotated.tsv should not need a pass over the whole file. A
+LineIndex stores the byte offset of every line in a binary sidecar file next
+to the data file (<path>.idx), together with the size and modification time
+of the data file; the sidecar is rebuilt when they no longer match. Both
+files are memory-mapped, so a line, a range of lines or (for TSV files) the
+line of a record id is found in O(1) without loading the offsets.
+
+Sidecar layout (little endian): the header (magic, data size, data mtime in
+ns, line count, id table size, id column, header lines), line count + 1
+offsets as uint64, then an open-addressing hash table of (id hash, line)
+pairs if an id column was given. Lines are split at '\\n', so TSV rows must
+not contain quoted line breaks, as with the rows written by the annotation job.
+
+Usage:
+    python line_index.py results/data/incorrect_tags.txt 1504
+    python line_index.py results/data/all_bib_items_annotated.tsv 120-180
+    python line_index.py results/data/all_bib_items_annotated.tsv --id d7feab55-01a0-5dde-b35b-2cc1f65614bc/t7
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+from typing import List, Optional, Tuple
+
+SIDECAR_SUFFIX = ".idx"
+_MAGIC = b"LIX1"
+_HEADER = struct.Struct("<4sQqQQqQ")
+_OFFSET = struct.Struct("<Q")
+_SLOT = struct.Struct("<QQ")
+
+
+def _key_hash(key: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class LineIndex:
+    """
+    Lines of a file by number (starting at 1), and optionally by the value of a TSV column.
+
+    Args:
+        path: Data file
+        id_column: Column of the record id in tab-separated lines, None for no id lookup
+        header_lines: Number of leading lines without a record id, e.g. 1 for a TSV header
+        sidecar_path: Index file, <path>.idx by default
+    """
+
+    def __init__(self, path: str, id_column: Optional[int] = None, header_lines: int = 0,
+                 sidecar_path: Optional[str] = None):
+        self.path = path
+        self.id_column = id_column
+        self.header_lines = header_lines
+        self.sidecar_path = sidecar_path or path + SIDECAR_SUFFIX
+        self._data_file = open(path, "rb")
+        size = os.fstat(self._data_file.fileno()).st_size
+        # an empty file cannot be memory-mapped
+        self.data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._index_file = None
+        self.index = self._load_sidecar() or self._build()
+        _, _, _, self.line_count, self.table_size, _, _ = _HEADER.unpack_from(self.index, 0)
+        self._table_start = _HEADER.size + (self.line_count + 1) * _OFFSET.size
+
+    def _expected_header(self) -> Tuple[int, int, int]:
+        stat = os.fstat(self._data_file.fileno())
+        return stat.st_size, stat.st_mtime_ns, -1 if self.id_column is None else self.id_column
+
+    def _load_sidecar(self):
+        """ the memory-mapped sidecar if it matches the data file, otherwise None. """
+        try:
+            index_file = open(self.sidecar_path, "rb")
+        except OSError:
+            return None
+        try:
+            index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            index_file.close()
+            return None
+        size, mtime, id_column = self._expected_header()
+        if len(index) >= _HEADER.size:
+            magic, stored_size, stored_mtime, _, _, stored_column, stored_header = _HEADER.unpack_from(index, 0)
+            # an index with an id table also serves lookups by line number
+            if (magic, stored_size, stored_mtime) == (_MAGIC, size, mtime) and (
+                    self.id_column is None or (stored_column, stored_header) == (id_column, self.header_lines)):
+                self._index_file = index_file
+                return index
+        index.close()
+        index_file.close()
+        return None
+
+    def _build(self):
+        """ scans the data file once and writes the sidecar; kept in memory if it cannot be written. """
+        data = self.data
+        offsets = [0]
+        position = data.find(b"\n")
+        while position >= 0:
+            offsets.append(position + 1)
+            position = data.find(b"\n", position + 1)
+        if offsets[-1] != len(data):
+            # last line without newline
+            offsets.append(len(data))
+        line_count = len(offsets) - 1
+
+        table = b""
+        table_size = 0
+        if self.id_column is not None:
+            table_size = 1
+            while table_size < 2 * (line_count - self.header_lines):
+                table_size *= 2
+            slots = [(0, 0)] * table_size
+            for line in range(self.header_lines + 1, line_count + 1):
+                key = self._key(offsets[line - 1], offsets[line])
+                if key is None:
+                    continue
+                slot = _key_hash(key) & (table_size - 1)
+                while slots[slot][1]:
+                    slot = (slot + 1) & (table_size - 1)
+                slots[slot] = (_key_hash(key), line)
+            table = b"".join(_SLOT.pack(*slot) for slot in slots)
+
+        size, mtime, id_column = self._expected_header()
+        index = (_HEADER.pack(_MAGIC, size, mtime, line_count, table_size, id_column, self.header_lines)
+                 + b"".join(_OFFSET.pack(offset) for offset in offsets) + table)
+        try:
+            temporary_path = self.sidecar_path + ".tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(index)
+            os.replace(temporary_path, self.sidecar_path)
+        except OSError:
+            pass
+        return index
+
+    def _key(self, start: int, end: int) -> Optional[bytes]:
+        fields = self.data[start:end].rstrip(b"\r\n").split(b"\t", self.id_column + 1)
+        return fields[self.id_column] if len(fields) > self.id_column else None
+
+    def __len__(self) -> int:
+        return self.line_count
+
+    def _span(self, number: int) -> Tuple[int, int]:
+        if not 1 <= number <= self.line_count:
+            raise IndexError(f"line {number} out of range 1-{self.line_count}")
+        start, = _OFFSET.unpack_from(self.index, _HEADER.size + (number - 1) * _OFFSET.size)
+        end, = _OFFSET.unpack_from(self.index, _HEADER.size + number * _OFFSET.size)
+        return start, end
+
+    def line(self, number: int, keepends: bool = False) -> str:
+        """ the line with the given number, starting at 1. """
+        start, end = self._span(number)
+        text = self.data[start:end].decode("utf-8")
+        return text if keepends else text.rstrip("\r\n")
+
+    def lines(self, first: int, last: int, keepends: bool = False) -> List[str]:
+        """ the lines first to last, inclusive; the range is clipped to the file. """
+        return [self.line(number, keepends) for number in range(max(first, 1), min(last, self.line_count) + 1)]
+
+    def find(self, record_id: str) -> Optional[int]:
+        """ the line number of the record with the given id, None if there is none. """
+        if not self.table_size:
+            raise ValueError("the index was built without an id column")
+        key = record_id.encode("utf-8")
+        key_hash = _key_hash(key)
+        slot = key_hash & (self.table_size - 1)
+        while True:
+            stored_hash, line = _SLOT.unpack_from(self.index, self._table_start + slot * _SLOT.size)
+            if not line:
+                return None
+            # the hash may collide, so the id in the line is compared as well
+            if stored_hash == key_hash and self._key(*self._span(line)) == key:
+                return line
+            slot = (slot + 1) & (self.table_size - 1)
+
+    def close(self):
+        if isinstance(self.index, mmap.mmap):
+            self.index.close()
+        if self._index_file:
+            self._index_file.close()
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self._data_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def parse_line_range(text: str) -> Tuple[int, int]:
+    """ parses '120-180', '120-' or '120' into an inclusive (first, last) range. """
+    first, separator, last = text.partition("-")
+    if not separator:
+        return int(first), int(first)
+    return int(first or 1), int(last) if last else 2 ** 63
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print lines of a file by number or record id.")
+    parser.add_argument("path")
+    parser.add_argument("lines", nargs="?", type=parse_line_range, help="line or range, e.g. 1504 or 120-180")
+    parser.add_argument("--id", dest="record_id", help="record id in the first column of a TSV file with header")
+    args = parser.parse_args()
+
+    if args.record_id:
+        with LineIndex(args.path, id_column=0, header_lines=1) as index:
+            number = index.find(args.record_id)
+            print(f"{number}\t{index.line(number)}" if number else f"No record with id {args.record_id}")
+    else:
+        with LineIndex(args.path) as index:
+            first, last = args.lines or (1, len(index))
+            for number in range(max(first, 1), min(last, len(index)) + 1):
+                print(f"{number}\t{index.line(number)}")
@@ -0,0 +1,68 @@
+"""
+Retries of LLM requests with exponential backoff, shared by the runners that
+send requests concurrently (the correction script and annotate_ads.py).
+
+A runner passes a coroutine function that makes one attempt: it sends the
+request, checks the response and returns the result, or raises. Any exception
+is counted as an error of the model and retried after a randomized,
+exponentially growing delay; RetryNow is retried at once, e.g. for a streamed
+generation that was aborted because it could no longer become valid.
+"""
+
+import asyncio
+import random
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+
+class RetryNow(Exception):
+    """ raised by an attempt that should be repeated without waiting. """
+
+
+class RequestFailed(RuntimeError):
+    """ all attempts failed; the message is the error of the last attempt. """
+
+
+def backoff_delay(attempt: int, backoff: float = 1.0) -> float:
+    """ seconds to wait before the given retry (starting at 1), with jitter. """
+    return backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+
+
+async def with_retries(attempt_once: Callable[[], Awaitable[T]], model: str, retries: int = 5,
+                       backoff: float = 1.0, label: Optional[str] = None) -> T:
+    """
+    Makes up to retries + 1 attempts and returns the result of the first successful one.
+
+    Args:
+        attempt_once: Coroutine function making one attempt
+        model: Model name for the retry and error metrics
+        retries: Number of retries after the first attempt
+        backoff: Delay before the first retry in seconds, doubled for every further retry
+        label: If given, failed attempts are printed as '<label>, attempt N failed: ...'
+
+    Raises:
+        RequestFailed: If every attempt raised
+    """
+    error = None
+    wait = False
+    for attempt in range(retries + 1):
+        if attempt:
+            metrics.count_retry(model)
+            if wait:
+                await asyncio.sleep(backoff_delay(attempt, backoff))
+        try:
+            return await attempt_once()
+        except RetryNow as e:
+            error = str(e)
+            wait = False
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            wait = True
+            metrics.count_error(model)
+            metrics.count(f"errors_{type(e).__name__}")
+            if label:
+                print(f"{label}, attempt {attempt + 1} failed: {error}")
+    raise RequestFailed(error)
@@ -0,0 +1,328 @@
+"""
+Run metrics shared by the scripts: stage timers, counters and LLM call statistics.
+
+The scripts record through the functions of this module:
+
+    with metrics.timer("consolidate") as stage:
+        for record in records:
+            ...
+            stage.items += 1
+    metrics.count("rows_not_well_formed")
+    metrics.observe_llm(model, latency, input_tokens, output_tokens)
+    metrics.count_retry(model)
+
+and wrap their main part in `session(args, name)`, with the options of
+add_arguments on their command line. At the end of the session, the metrics
+are written as JSON (by default to metrics/<name>_<time>_<pid>.json): seconds,
+calls, items and items per second of every stage, the counters, and for every
+model the number of requests and retries, token counts and latency
+percentiles (p50/p95/p99) and histogram, plus the peak memory of the process.
+--profile PATH additionally runs the session under cProfile, --trace-memory
+records the peak of the Python allocations with tracemalloc.
+
+Metrics recorded in worker processes of a multiprocessing pool stay in the
+workers, so the scripts record them where the results are collected. The
+metrics files of runs on several shards of the data are combined with
+merge_reports.
+"""
+
+import cProfile
+import json
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120]
+
+
+def percentile(sorted_values: List[float], share: float) -> Optional[float]:
+    """ nearest-rank percentile of sorted values, e.g. share=0.95 for p95. """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(share * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """ peak resident memory of this process in MB, None where it is not available. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+class StageTimer:
+    """ accumulated time, calls and processed items of one stage. """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.items = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "seconds": self.seconds,
+            "calls": self.calls,
+            "items": self.items,
+            "items_per_second": self.items / self.seconds if self.seconds > 0 and self.items else None
+        }
+
+
+class ModelStats:
+    """ latencies, token counts and retries of the LLM calls of one model. """
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.retries = 0
+        self.errors = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        histogram = {f"<={bound}s": 0 for bound in LATENCY_BUCKETS}
+        histogram[f">{LATENCY_BUCKETS[-1]}s"] = 0
+        for latency in latencies:
+            bucket = next((f"<={bound}s" for bound in LATENCY_BUCKETS if latency <= bound),
+                          f">{LATENCY_BUCKETS[-1]}s")
+            histogram[bucket] += 1
+        return {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "retries": self.retries,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "latency": {
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+                "p50": percentile(latencies, 0.5),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+                "histogram": histogram
+            }
+        }
+
+
+class Metrics:
+    """ thread-safe registry of stage timers, counters and LLM statistics. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages: Dict[str, StageTimer] = {}
+            self.counters: Dict[str, int] = {}
+            self.models: Dict[str, ModelStats] = {}
+            self.peak_traced_mb: Optional[float] = None
+            self.started = time.monotonic()
+
+    @contextmanager
+    def timer(self, stage: str):
+        """ times the block as one call of the stage; the yielded StageTimer takes the item count. """
+        with self.lock:
+            timer = self.stages.setdefault(stage, StageTimer())
+        start = time.perf_counter()
+        try:
+            yield timer
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                timer.seconds += elapsed
+                timer.calls += 1
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def _model(self, model: str) -> ModelStats:
+        return self.models.setdefault(model or "unknown", ModelStats())
+
+    def observe_llm(self, model: str, latency: float, input_tokens: int = 0, output_tokens: int = 0):
+        """ records one completed LLM request. """
+        with self.lock:
+            stats = self._model(model)
+            stats.latencies.append(latency)
+            stats.input_tokens += input_tokens or 0
+            stats.output_tokens += output_tokens or 0
+
+    def observe_response(self, model: str, latency: float, raw: Dict[str, Any]):
+        """ records one completed LLM request from the to_dict() of an ai_client response. """
+        usage = raw.get("usage") or {}
+        self.observe_llm(model, latency, usage.get("input_tokens") or 0, usage.get("output_tokens") or 0)
+
+    def count_retry(self, model: str):
+        with self.lock:
+            self._model(model).retries += 1
+
+    def count_error(self, model: str):
+        """ a request that failed or returned an unusable response. """
+        with self.lock:
+            self._model(model).errors += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "wall_seconds": time.monotonic() - self.started,
+                "peak_rss_mb": peak_rss_mb(),
+                "peak_traced_mb": self.peak_traced_mb,
+                "stages": {name: timer.to_dict() for name, timer in self.stages.items()},
+                "counters": dict(self.counters),
+                "llm": {model: stats.to_dict() for model, stats in self.models.items()}
+            }
+
+    def write(self, path: str, **info: Any):
+        """ writes the metrics as JSON, with info (script name, arguments) at the top. """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({**info, **self.to_dict()}, f, indent=2, ensure_ascii=False, default=str)
+
+
+def _histogram_percentile(histogram: Dict[str, int], share: float, maximum: Optional[float]) -> Optional[float]:
+    """ upper bound of the histogram bucket holding the nearest-rank percentile. """
+    total = sum(histogram.values())
+    if not total:
+        return None
+    rank = max(1, math.ceil(share * total))
+    seen = 0
+    for bound in LATENCY_BUCKETS:
+        seen += histogram.get(f"<={bound}s", 0)
+        if seen >= rank:
+            return min(bound, maximum) if maximum is not None else bound
+    return maximum
+
+
+def merge_reports(reports: List[Dict[str, Any]], **info: Any) -> Dict[str, Any]:
+    """
+    Combines the metrics files of runs on separate shards of the data.
+
+    Stage times, items, counters, requests and tokens are summed; wall time
+    and peak memory are the maximum over the runs, which ran in parallel.
+    The latency percentiles of the single runs cannot be combined exactly,
+    so they are estimated from the summed histogram (the upper bound of the
+    bucket), the mean and maximum are exact.
+
+    Args:
+        reports: Contents of the metrics files written by session
+        info: Entries for the top of the result, e.g. the number of shards
+
+    Returns:
+        Dictionary in the format of Metrics.to_dict
+    """
+    def maximum(values):
+        values = [value for value in values if value is not None]
+        return max(values) if values else None
+
+    stages: Dict[str, StageTimer] = {}
+    counters: Dict[str, int] = {}
+    models: Dict[str, Dict[str, Any]] = {}
+    for report in reports:
+        for name, stage in report.get("stages", {}).items():
+            timer = stages.setdefault(name, StageTimer())
+            timer.seconds += stage["seconds"]
+            timer.calls += stage["calls"]
+            timer.items += stage["items"]
+        for name, value in report.get("counters", {}).items():
+            counters[name] = counters.get(name, 0) + value
+        for model, stats in report.get("llm", {}).items():
+            merged = models.setdefault(model, {"requests": 0, "errors": 0, "retries": 0, "input_tokens": 0,
+                                               "output_tokens": 0, "latency_sum": 0.0, "max": None,
+                                               "histogram": {}})
+            for key in ("requests", "errors", "retries", "input_tokens", "output_tokens"):
+                merged[key] += stats[key]
+            latency = stats["latency"]
+            merged["latency_sum"] += (latency["mean"] or 0.0) * stats["requests"]
+            merged["max"] = maximum([merged["max"], latency["max"]])
+            for bucket, count in latency["histogram"].items():
+                merged["histogram"][bucket] = merged["histogram"].get(bucket, 0) + count
+
+    llm = {}
+    for model, merged in models.items():
+        histogram, latency_max = merged.pop("histogram"), merged.pop("max")
+        latency_sum = merged.pop("latency_sum")
+        llm[model] = {**merged, "latency": {
+            "mean": latency_sum / merged["requests"] if merged["requests"] else None,
+            "p50": _histogram_percentile(histogram, 0.5, latency_max),
+            "p95": _histogram_percentile(histogram, 0.95, latency_max),
+            "p99": _histogram_percentile(histogram, 0.99, latency_max),
+            "max": latency_max,
+            "histogram": histogram
+        }}
+    return {
+        **info,
+        "wall_seconds": maximum(report.get("wall_seconds") for report in reports),
+        "peak_rss_mb": maximum(report.get("peak_rss_mb") for report in reports),
+        "peak_traced_mb": maximum(report.get("peak_traced_mb") for report in reports),
+        "stages": {name: timer.to_dict() for name, timer in stages.items()},
+        "counters": counters,
+        "llm": llm
+    }
+
+
+_metrics = Metrics()
+timer = _metrics.timer
+count = _metrics.count
+observe_llm = _metrics.observe_llm
+observe_response = _metrics.observe_response
+count_retry = _metrics.count_retry
+count_error = _metrics.count_error
+
+
+def add_arguments(parser):
+    """ adds --metrics, --profile and --trace-memory to an argparse parser. """
+    group = parser.add_argument_group("metrics")
+    group.add_argument("--metrics", metavar="PATH",
+                       help="JSON file for the run metrics (default: metrics/<script>_<time>_<pid>.json)")
+    group.add_argument("--profile", metavar="PATH",
+                       help="run under cProfile, write the stats to PATH and print the slowest functions")
+    group.add_argument("--trace-memory", action="store_true",
+                       help="record the peak memory of Python allocations with tracemalloc (slower)")
+
+
+@contextmanager
+def session(args, name: str):
+    """
+    Collects the metrics of a script run and writes them at the end, also if the run fails.
+
+    Args:
+        args: Parsed arguments with the options of add_arguments
+        name: Name of the script, used for the default metrics path
+    """
+    _metrics.reset()
+    # microseconds and the process id, so runs started within the same second keep their own file
+    path = args.metrics or os.path.join("metrics", f"{name}_{datetime.now():%Y%m%d_%H%M%S_%f}_{os.getpid()}.json")
+    profiler = cProfile.Profile() if args.profile else None
+    if args.trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield _metrics
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+        if args.trace_memory:
+            _metrics.peak_traced_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        _metrics.write(path, script=name, arguments=vars(args), finished=datetime.now().isoformat())
+        print(f"Metrics written to {path}")
@@ -0,0 +1,371 @@
+"""
+Runs the evaluation, correction, consolidation and model comparison workflow as a graph of stages.
+
+Every stage is one of the existing scripts, run in its own working directory
+with explicit paths, and declares the files and directories it reads and
+writes, including the local modules the script imports. A stage depends on
+the stages that write one of its inputs. The content hashes of the inputs,
+the outputs and the command of every successful run are recorded in a state
+file, and a stage only runs again if its command or an input changed, an
+output is missing, or it is forced:
+
+    evaluate      results/data/all_bib_items.tsv (id and annotation, e.g. from annotate_ads.py)
+                  -> results/data/all_bib_items_annotated.tsv, results/data/incorrect_tags.txt
+    correct       results/data/incorrect_tags.txt -> results/output/content, results/output/raw
+    consolidate   the evaluated TSV and the corrections -> results/output/consolidated_data.*
+    convert       tests_llm_requests -> tests_standoff_tags
+    compare       groundtruth and tests_standoff_tags -> model_comparison_results.txt
+
+The correction records the lines that failed after all retries in
+results/output/failed_lines.json; while it lists any, the correct stage stays
+stale, so the next run retries them. Stages whose dependencies are done run concurrently, so the comparison
+branch runs alongside the correction branch. File hashes are cached by size
+and modification time, so checking an unchanged tree takes well under a
+second; after editing one file in results/output/content, only the
+consolidation runs.
+
+Usage:
+    python pipeline.py                  # run the stale stages
+    python pipeline.py --dry-run        # list the stages that would run, and why
+    python pipeline.py compare --force  # run compare and the stale stages it depends on
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Sequence
+
+import metrics
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE_PATH = os.path.join(ROOT, ".pipeline_state.json")
+LOG_DIR = os.path.join(ROOT, ".pipeline_logs")
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Args:
+        name: Unique name of the stage
+        command: Arguments after the Python interpreter, e.g. ["compare_llms.py"]
+        inputs: Files and directories read by the stage, relative to the repository root
+        outputs: Files and directories written by the stage, relative to the repository root
+        cwd: Working directory of the command, relative to the repository root
+        failures: JSON file in which the command lists the items it could not
+            process, relative to the repository root; the stage is stale while it lists any
+    """
+
+    def __init__(self, name: str, command: List[str], inputs: List[str], outputs: List[str], cwd: str = ".",
+                 failures: Optional[str] = None):
+        self.name = name
+        self.command = command
+        self.inputs = inputs
+        self.outputs = outputs
+        self.cwd = cwd
+        self.failures = failures
+
+
+def default_stages(correction_args: Sequence[str] = ("--concurrency", "8"), workers: int = 0,
+                   annotations: str = "results/data/all_bib_items.tsv") -> List[Stage]:
+    """
+    the stages of the workflow; the scripts and the local modules they import
+    (directly or through another module) are inputs, so changing the code re-runs a stage.
+    """
+    workers_args = ["--workers", str(workers)]
+    return [
+        Stage("evaluate",
+              ["shard.py", "evaluate", annotations, "results/data/all_bib_items_annotated.tsv",
+               "results/data/incorrect_tags.txt"] + workers_args,
+              inputs=["shard.py", "evaluate_tsv.py", "results/format_output.py", "results/result_store.py",
+                      "line_index.py", "metrics.py", annotations],
+              outputs=["results/data/all_bib_items_annotated.tsv", "results/data/incorrect_tags.txt"]),
+        Stage("correct",
+              ["correction_of_results/correction_of_malformed_xml_with_LLM.py", "--output-dir", "output"]
+              + list(correction_args),
+              inputs=["results/correction_of_results/correction_of_malformed_xml_with_LLM.py",
+                      "results/correction_of_results/response_cache.py", "results/correction_of_results/stub_client.py",
+                      "results/correction_of_results/xml_stream.py", "results/format_output.py",
+                      "results/result_store.py", "xml_repair.py",
+                      "evaluate_tsv.py", "line_index.py", "llm_retry.py", "metrics.py",
+                      "results/data/incorrect_tags.txt"],
+              outputs=["results/output/content", "results/output/raw"],
+              cwd="results",
+              failures="results/output/failed_lines.json"),
+        Stage("consolidate",
+              ["format_output.py", "--stream"] + workers_args,
+              inputs=["results/format_output.py", "results/result_store.py", "line_index.py", "metrics.py",
+                      "results/data/all_bib_items_annotated.tsv", "results/data/incorrect_tags.txt",
+                      "results/output/content"],
+              outputs=["results/output/consolidated_data.jsonl", "results/output/consolidated_data.csv"],
+              cwd="results"),
+        Stage("convert",
+              ["convert_inline_to_standoff.py"],
+              inputs=["convert_inline_to_standoff.py", "tests_llm_requests"],
+              outputs=["tests_standoff_tags"]),
+        Stage("compare",
+              ["compare_llms.py"],
+              inputs=["compare_llms.py", "align_bibls.py", "convert_inline_to_standoff.py", "fuzzy_match.py",
+                      "metrics.py", "groundtruth/eval_set_small_standoff.txt", "tests_standoff_tags"],
+              outputs=["model_comparison_results.txt"]),
+    ]
+
+
+class FileHasher:
+    """ sha256 of files and directories, with file hashes cached by size and modification time. """
+
+    def __init__(self, cache: Optional[Dict[str, List]] = None):
+        self.cache = cache if cache is not None else {}
+        self.lock = threading.Lock()
+
+    def file_hash(self, path: str) -> str:
+        stat = os.stat(path)
+        key = os.path.relpath(path, ROOT)
+        with self.lock:
+            cached = self.cache.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self.lock:
+            self.cache[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def hash(self, path: str) -> Optional[str]:
+        """ hash of a file, or of the names and hashes of the files in a directory
+        (hidden files excluded); None if the path does not exist. """
+        full_path = os.path.join(ROOT, path)
+        if os.path.isfile(full_path):
+            return self.file_hash(full_path)
+        if not os.path.isdir(full_path):
+            return None
+        digest = hashlib.sha256()
+        for directory, subdirectories, files in os.walk(full_path):
+            subdirectories[:] = sorted(d for d in subdirectories if not d.startswith("."))
+            for name in sorted(f for f in files if not f.startswith(".")):
+                file_path = os.path.join(directory, name)
+                digest.update(f"{os.path.relpath(file_path, full_path)}\0{self.file_hash(file_path)}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+
+def load_state(path: str = STATE_PATH) -> Dict:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {"stages": {}, "files": {}}
+
+
+def save_state(state: Dict, path: str = STATE_PATH):
+    # replace the file atomically, so an interrupted run keeps the previous state
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def dependencies(stages: Sequence[Stage]) -> Dict[str, List[str]]:
+    """ for every stage, the stages writing one of its inputs. """
+    writers = {output: stage.name for stage in stages for output in stage.outputs}
+    return {stage.name: sorted({writers[path] for path in stage.inputs
+                                if path in writers and writers[path] != stage.name})
+            for stage in stages}
+
+
+def failure_count(stage: Stage) -> int:
+    """ number of items listed in the failures file of the stage, 0 if there is none. """
+    if stage.failures is None or not os.path.exists(os.path.join(ROOT, stage.failures)):
+        return 0
+    with open(os.path.join(ROOT, stage.failures), "r", encoding="utf-8") as f:
+        return len(json.load(f))
+
+
+def stale_reason(stage: Stage, state: Dict, hasher: FileHasher) -> Optional[str]:
+    """ why the stage has to run, None if it is up to date. """
+    recorded = state["stages"].get(stage.name)
+    if recorded is None:
+        return "never run"
+    if recorded["command"] != stage.command or recorded["cwd"] != stage.cwd:
+        return "command changed"
+    for path in stage.inputs:
+        if hasher.hash(path) != recorded["inputs"].get(path):
+            return f"{path} changed"
+    for path in stage.outputs:
+        if hasher.hash(path) is None:
+            return f"{path} missing"
+    failed = failure_count(stage)
+    if failed:
+        return f"{failed} failed in {stage.failures}"
+    return None
+
+
+def run_stage(stage: Stage) -> bool:
+    """ runs the command of a stage with its output in the log directory; True on success. """
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with open(os.path.join(LOG_DIR, f"{stage.name}.log"), "w", encoding="utf-8") as log:
+        process = subprocess.run([sys.executable] + stage.command, cwd=os.path.join(ROOT, stage.cwd),
+                                 stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode == 0
+
+
+def run_pipeline(
+    stages: Sequence[Stage],
+    targets: Optional[Sequence[str]] = None,
+    force: bool = False,
+    dry_run: bool = False,
+    concurrency: int = 4,
+    state_path: str = STATE_PATH
+) -> Dict[str, str]:
+    """
+    Runs the stale stages in dependency order, independent stages concurrently.
+
+    Args:
+        stages: Stages of the pipeline
+        targets: Names of the stages to bring up to date, with the stages they
+            depend on; None for all stages
+        force: Run the targets even if they are up to date
+        dry_run: Only report which stages would run
+        concurrency: Maximum number of stages running at the same time
+        state_path: JSON file with the hashes of the last successful runs
+
+    Returns:
+        Dictionary from stage name to 'ran', 'up to date', 'failed', 'skipped'
+        (a dependency failed or an input is missing) or, with dry_run, 'stale'
+    """
+    by_name = {stage.name: stage for stage in stages}
+    depends_on = dependencies(stages)
+    selected = set()
+    pending_names = list(targets or by_name)
+    while pending_names:
+        name = pending_names.pop()
+        if name not in by_name:
+            raise ValueError(f"unknown stage '{name}', expected one of {', '.join(by_name)}")
+        if name not in selected:
+            selected.add(name)
+            pending_names.extend(depends_on[name])
+    forced = set(targets or by_name) if force else set()
+
+    state = load_state(state_path)
+    hasher = FileHasher(state.setdefault("files", {}))
+    state_lock = threading.Lock()
+    # stages report from several threads, one line per print
+    print_lock = threading.Lock()
+    status: Dict[str, str] = {}
+    # stages that ran, or with dry_run would run
+    reran = set()
+
+    def report(message: str):
+        with print_lock:
+            print(message, flush=True)
+
+    def check(name: str) -> Optional[str]:
+        stage = by_name[name]
+        missing = [path for path in stage.inputs if path not in
+                   {output for dependency in depends_on[name] for output in by_name[dependency].outputs}
+                   and hasher.hash(path) is None]
+        if missing:
+            raise FileNotFoundError(", ".join(missing))
+        if name in forced:
+            return "forced"
+        # a real run of a dependency shows up in the input hashes, unless its outputs did not change
+        if dry_run and any(dependency in reran for dependency in depends_on[name]):
+            return "dependency stale"
+        return stale_reason(stage, state, hasher)
+
+    def execute(name: str) -> str:
+        stage = by_name[name]
+        try:
+            reason = check(name)
+        except FileNotFoundError as e:
+            report(f"[{name}] skipped, missing input: {e}")
+            return "skipped"
+        if reason is None:
+            report(f"[{name}] up to date")
+            return "up to date"
+        if dry_run:
+            report(f"[{name}] stale: {reason}")
+            # the stages depending on it would run as well
+            reran.add(name)
+            return "stale"
+        report(f"[{name}] running ({reason}): python {' '.join(stage.command)}")
+        start = time.monotonic()
+        with metrics.timer(name):
+            succeeded = run_stage(stage)
+        # some scripts report errors without a failing exit status, so the outputs are checked as well
+        if not succeeded or any(hasher.hash(path) is None for path in stage.outputs):
+            report(f"[{name}] failed after {time.monotonic() - start:.1f}s, see {os.path.join(LOG_DIR, name + '.log')}")
+            return "failed"
+        record = {
+            "command": stage.command,
+            "cwd": stage.cwd,
+            "inputs": {path: hasher.hash(path) for path in stage.inputs},
+            "outputs": {path: hasher.hash(path) for path in stage.outputs},
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        with state_lock, hasher.lock:
+            state["stages"][name] = record
+            save_state(state, state_path)
+        reran.add(name)
+        failed = failure_count(stage)
+        report(f"[{name}] done in {time.monotonic() - start:.1f}s"
+               + (f", {failed} failed in {stage.failures}; they are retried on the next run" if failed else ""))
+        return "ran"
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        running = {}
+        while len(status) < len(selected):
+            finished = len(status)
+            for name in sorted(selected):
+                if name in status or name in running.values():
+                    continue
+                if any(status.get(dependency) in ("failed", "skipped") for dependency in depends_on[name]):
+                    report(f"[{name}] skipped, a dependency did not complete")
+                    status[name] = "skipped"
+                elif all(dependency in status for dependency in depends_on[name]):
+                    running[executor.submit(execute, name)] = name
+            if not running:
+                if len(status) == finished:
+                    raise ValueError(f"cyclic dependencies between {', '.join(sorted(selected - set(status)))}")
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                status[running.pop(future)] = future.result()
+
+    save_state(state, state_path)
+    counts = {value: sum(1 for s in status.values() if s == value) for value in sorted(set(status.values()))}
+    print(f"Pipeline finished in {time.monotonic() - start:.1f}s: "
+          + ", ".join(f"{count} {value}" for value, count in counts.items()))
+    return status
+
+
+if __name__ == "__main__":
+    stage_names = [stage.name for stage in default_stages()]
+    parser = argparse.ArgumentParser(description="Run the stale stages of the evaluation and consolidation workflow.")
+    parser.add_argument("stages", nargs="*", metavar="STAGE",
+                        help=f"stages to bring up to date ({', '.join(stage_names)}); default: all")
+    parser.add_argument("--force", action="store_true", help="run the given stages even if they are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only list the stages that would run")
+    parser.add_argument("--concurrency", type=int, default=4, help="maximum number of stages running at once")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="processes for the evaluation and the consolidation (0 = all cores)")
+    parser.add_argument("--annotations", default="results/data/all_bib_items.tsv",
+                        help="TSV with the id and the annotation of every ad, the input of the evaluation")
+    parser.add_argument("--correction-args", default="--concurrency 8",
+                        help="arguments for the correction script, e.g. '--concurrency 16 --stream'")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    with metrics.session(args, "pipeline"):
+        status = run_pipeline(default_stages(args.correction_args.split(), args.workers, args.annotations), args.stages or None,
+                              args.force, args.dry_run, args.concurrency)
+        for value in status.values():
+            metrics.count(f"stages_{value.replace(' ', '_')}")
+    sys.exit(1 if "failed" in status.values() else 0)
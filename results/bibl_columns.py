@@ -0,0 +1,156 @@
+"""
+Columnar export of the flattened BIBL fields for fast analytics.
+
+Every BIBL of the consolidated data becomes one row (ad id, bibl index, author,
+title, year, place, format, volume, prize). Each column is stored as a NumPy
+.npy file in one directory, so the loader can memory-map it:
+
+- text columns are dictionary-encoded: an int32 array of codes per row and a
+  vocabulary stored as one UTF-8 blob with an int64 offset array,
+- 'year_value' is the parsed year as int16 (-1 if missing),
+- 'prize_kreuzer' is the price normalized to Kreuzer as float32 (NaN if missing).
+
+Example, median price in Kreuzer per format and decade:
+
+    columns = load_bibl_columns("output/bibl_columns")
+    decade = columns["year_value"] // 10 * 10
+    known = (decade > 0) & ~np.isnan(columns["prize_kreuzer"])
+    for code in np.unique(columns["format"][known]):
+        ...
+"""
+
+import json
+import os
+from array import array
+from typing import Any, Dict, Iterable, List
+
+import numpy as np
+
+from format_output import BIBL_FIELDS, flatten_bibls, normalize_prize, parse_year
+
+TEXT_COLUMNS = ["ad_id"] + BIBL_FIELDS
+FORMAT_VERSION = 1
+
+
+class _Vocabulary:
+    """ assigns consecutive codes to distinct strings. """
+
+    def __init__(self):
+        self.codes: Dict[str, int] = {}
+        self.values: List[str] = []
+
+    def code(self, value: str) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+def write_bibl_columns(records: Iterable[Dict[str, Any]], output_dir: str) -> int:
+    """
+    Write the flattened BIBL fields of consolidated records as columns.
+
+    Args:
+        records: Consolidated records, e.g. format_output.iter_consolidated_file
+        output_dir: Directory for the column files
+
+    Returns:
+        Number of BIBL rows written
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    vocabularies = {column: _Vocabulary() for column in TEXT_COLUMNS}
+    codes = {column: array("i") for column in TEXT_COLUMNS}
+    bibl_index, year_value, prize_kreuzer = array("i"), array("h"), array("f")
+
+    for record in records:
+        for row in flatten_bibls(record):
+            for column in TEXT_COLUMNS:
+                codes[column].append(vocabularies[column].code(row[column]))
+            bibl_index.append(row["bibl_index"])
+            year = parse_year(row["year"])
+            year_value.append(year if year is not None else -1)
+            prize = normalize_prize(row["prize"])
+            prize_kreuzer.append(prize if prize is not None else float("nan"))
+
+    for column in TEXT_COLUMNS:
+        np.save(os.path.join(output_dir, f"{column}.npy"), np.frombuffer(codes[column], dtype=np.int32))
+        _save_vocabulary(output_dir, column, vocabularies[column].values)
+    np.save(os.path.join(output_dir, "bibl_index.npy"), np.frombuffer(bibl_index, dtype=np.int32))
+    np.save(os.path.join(output_dir, "year_value.npy"), np.frombuffer(year_value, dtype=np.int16))
+    np.save(os.path.join(output_dir, "prize_kreuzer.npy"), np.frombuffer(prize_kreuzer, dtype=np.float32))
+
+    rows = len(bibl_index)
+    with open(os.path.join(output_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump({
+            "version": FORMAT_VERSION,
+            "rows": rows,
+            "text_columns": TEXT_COLUMNS,
+            "numeric_columns": ["bibl_index", "year_value", "prize_kreuzer"]
+        }, f, indent=2)
+    return rows
+
+
+def _save_vocabulary(output_dir: str, column: str, values: List[str]):
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+    with open(os.path.join(output_dir, f"{column}.vocab.bin"), 'wb') as f:
+        f.write(b"".join(encoded))
+    np.save(os.path.join(output_dir, f"{column}.vocab_offsets.npy"), offsets)
+
+
+class BiblColumns:
+    """
+    Memory-mapped BIBL columns written by write_bibl_columns.
+
+    columns["title"] is the int32 code array of a text column, columns["year_value"]
+    a numeric column; vocabulary(column) and decode(column, codes) map codes to strings.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported column format version {self.meta['version']}")
+        self.columns = {
+            column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode='r')
+            for column in self.meta["text_columns"] + self.meta["numeric_columns"]
+        }
+        self._vocabularies: Dict[str, List[str]] = {}
+
+    def __len__(self) -> int:
+        return self.meta["rows"]
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.columns[column]
+
+    def vocabulary(self, column: str) -> List[str]:
+        """ the distinct values of a text column, indexed by code. """
+        if column not in self._vocabularies:
+            offsets = np.load(os.path.join(self.directory, f"{column}.vocab_offsets.npy"), mmap_mode='r')
+            blob = np.memmap(os.path.join(self.directory, f"{column}.vocab.bin"), dtype=np.uint8, mode='r') \
+                if offsets[-1] else np.zeros(0, dtype=np.uint8)
+            self._vocabularies[column] = [
+                bytes(blob[start:end]).decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])
+            ]
+        return self._vocabularies[column]
+
+    def decode(self, column: str, codes) -> List[str]:
+        vocabulary = self.vocabulary(column)
+        return [vocabulary[code] for code in np.asarray(codes)]
+
+    def code(self, column: str, value: str) -> int:
+        """ code of a value in a text column, -1 if it does not occur. """
+        try:
+            return self.vocabulary(column).index(value)
+        except ValueError:
+            return -1
+
+
+def load_bibl_columns(directory: str) -> BiblColumns:
+    """
+    Memory-map the BIBL columns in a directory written by write_bibl_columns.
+    """
+    return BiblColumns(directory)
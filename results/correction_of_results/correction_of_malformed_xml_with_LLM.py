@@ -1,44 +1,484 @@
+import argparse
+import asyncio
 import json
 import os
+import sys
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from ai_client import create_ai_client
-from decouple import config
+from response_cache import ResponseCache
+
+# result_store is shared with format_output.py in the parent directory,
+# xml_repair and metrics live next to evaluate_tsv.py in the repository root
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+import metrics
+from line_index import LineIndex, parse_line_range
+from llm_retry import RequestFailed, RetryNow, with_retries
+from result_store import open_store
+from xml_repair import repair_annotation, repair_xml
+from xml_stream import GenerationAborted, StreamStats, read_stream
 
 INPUT_DIR = "data"
 OUTPUT_DIR = "output"
-
-client = create_ai_client(provider="openai", api_key=config("OPENAI_API_KEY"))
+FAILURES_PATH = os.path.join(OUTPUT_DIR, "failed_lines.json")
+MODEL = "gpt-4"
 
 prompt = "Fix this xml. Add xml-tags if faulty where it makes sense. Format your response as JSON. Use the keys 'fixed_xml', 'number_of_fixes', 'explanation'."
 
-with(open(os.path.join(INPUT_DIR, "incorrect_tags.txt"), "r", encoding="utf-8")) as f:
-    xmls = f.readlines()
-lines = len(xmls)
-print("Opened input file with", lines, "lines.")
-
-os.makedirs(os.path.join(OUTPUT_DIR, "raw"), exist_ok=True)
-os.makedirs(os.path.join(OUTPUT_DIR, "content"), exist_ok=True)
-
-line = 1
-print("Starting processing...")
-for xml in xmls:
-    filename = f"line_{line}.json"
-    if os.path.exists(os.path.join(OUTPUT_DIR, "raw", filename)) and\
-            os.path.exists(os.path.join(OUTPUT_DIR, "content", filename)):
-        print(f"Skipping line {line} of {lines}, already processed.")
-        line += 1
-        continue
-
-    print("Processing", xml)
-    response, duration = client.prompt("gpt-4", f"{prompt}\n{xml}")
-    with(open(os.path.join(OUTPUT_DIR, "raw", filename), "w", encoding="utf-8")) as f_out:
-        json.dump(response.to_dict(), f_out,
-                  indent=4, ensure_ascii=False)
-
-    with(open(os.path.join(OUTPUT_DIR, "content", filename), "w", encoding="utf-8")) as f_out:
-        json_text_response = response.text
-        json.dump(json.loads(json_text_response), f_out,
-                  indent=4, ensure_ascii=False)
-
-    print(f"Processed line {line} of {lines}")
-    line += 1
\ No newline at end of file
+
+def create_client(stub=False, stub_latency=0.5, stub_broken_xml_rate=0.0, stub_error_rate=0.02):
+    """ creates the OpenAI client, or the local stub client for offline tests,
+    which answers with the rule-based repair of the line. """
+    if stub:
+        from stub_client import StubClient
+        return StubClient(latency=stub_latency, invalid_json_rate=stub_error_rate, error_rate=stub_error_rate,
+                          broken_xml_rate=stub_broken_xml_rate,
+                          fix=lambda xml: repair_xml(xml)["fixed_xml"])
+
+    from ai_client import create_ai_client
+    from decouple import config
+    return create_ai_client(provider="openai", api_key=config("OPENAI_API_KEY"))
+
+
+def load_lines(input_dir=INPUT_DIR, line_range=None):
+    """
+    Returns the lines of incorrect_tags.txt by line number, starting at 1,
+    with their line endings as readlines() returns them. With an inclusive
+    (first, last) line_range, only these lines are read, through the
+    sidecar offset index (see line_index.py).
+    """
+    path = os.path.join(input_dir, "incorrect_tags.txt")
+    if line_range is None:
+        with(open(path, "r", encoding="utf-8")) as f:
+            return dict(enumerate(f.readlines(), start=1))
+    first, last = line_range
+    with LineIndex(path) as index:
+        return dict(zip(range(max(first, 1), len(index) + 1), index.lines(first, last, keepends=True)))
+
+
+def save_failures(failures, failures_path):
+    """ records the lines that failed after all retries, with their last error. """
+    with(open(failures_path, "w", encoding="utf-8")) as f_out:
+        json.dump(failures, f_out, indent=4, ensure_ascii=False)
+
+
+def group_pending_lines(xmls, store):
+    """
+    Groups the line numbers that have not been processed yet by cache key,
+    so that identical (after whitespace normalization) lines are sent once.
+    Returns a dictionary key -> (xml, [line numbers]) in input order.
+    """
+    processed = store.processed_lines()
+    groups = {}
+    for line, xml in xmls.items():
+        if line in processed:
+            continue
+        key = ResponseCache.key(MODEL, prompt, xml)
+        groups.setdefault(key, (xml, []))[1].append(line)
+    return groups
+
+
+def repair_pending_lines(xmls, store, max_fixes=3):
+    """
+    Repairs the unprocessed lines with the rule-based repair pass and stores
+    the corrections, so that only lines it cannot fix are sent to the LLM.
+    Returns the number of repaired lines.
+    """
+    processed = store.processed_lines()
+    repaired = 0
+    for line, xml in xmls.items():
+        if line in processed:
+            continue
+        with metrics.timer("repair") as stage:
+            stage.items += 1
+            correction = repair_annotation(xml, max_fixes)
+        if correction is None:
+            continue
+        raw = {
+            "text": json.dumps(correction, ensure_ascii=False),
+            "model": "xml_repair",
+            "provider": "rule-based",
+            "finish_reason": "stop",
+            "usage": {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0},
+            "duration": 0.0,
+            "timestamp": datetime.now().isoformat()
+        }
+        store.put(line, raw, correction)
+        repaired += 1
+    metrics.count("lines_repaired", repaired)
+    print(f"Repaired {repaired} lines without the LLM.")
+    return repaired
+
+
+def run_sequential(client, xmls, store, cache=None):
+    """
+    sends the lines one after another, stops at the first error.
+    Lines with a cached response are answered from the cache.
+    """
+    lines = max(xmls, default=0)
+    processed = store.processed_lines()
+    print("Starting processing...")
+    for line, xml in xmls.items():
+        if line in processed:
+            print(f"Skipping line {line} of {lines}, already processed.")
+            continue
+
+        key = ResponseCache.key(MODEL, prompt, xml)
+        entry = cache.get(key) if cache else None
+        if entry:
+            print(f"Line {line} answered from cache.")
+            metrics.count("cache_hits")
+            store.put(line, entry["raw"], entry["content"])
+        else:
+            print("Processing", xml)
+            with metrics.timer("correct") as stage:
+                stage.items += 1
+                response, duration = client.prompt(MODEL, f"{prompt}\n{xml}")
+            raw = response.to_dict()
+            metrics.observe_response(MODEL, duration, raw)
+            content = json.loads(response.text)
+            store.put(line, raw, content)
+            if cache:
+                cache.put(key, raw, content)
+
+        print(f"Processed line {line} of {lines}")
+
+    if cache:
+        cache.report()
+
+
+class RateLimiter:
+    """
+    Token bucket limiting requests per minute and (estimated) tokens per minute.
+    A limit of None disables that bucket.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.request_allowance = requests_per_minute or 0
+        self.token_allowance = tokens_per_minute or 0
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_refill) / 60
+        self.last_refill = now
+        if self.requests_per_minute:
+            self.request_allowance = min(self.requests_per_minute,
+                                         self.request_allowance + elapsed_minutes * self.requests_per_minute)
+        if self.tokens_per_minute:
+            self.token_allowance = min(self.tokens_per_minute,
+                                       self.token_allowance + elapsed_minutes * self.tokens_per_minute)
+
+    async def acquire(self, tokens=0):
+        """ waits until one request with the given number of tokens may be sent. """
+        async with self.lock:
+            while True:
+                self._refill()
+                wait = 0.0
+                if self.requests_per_minute and self.request_allowance < 1:
+                    wait = (1 - self.request_allowance) / self.requests_per_minute * 60
+                if self.tokens_per_minute:
+                    # a single request larger than the bucket only has to wait for a full bucket
+                    needed = min(tokens, self.tokens_per_minute)
+                    if self.token_allowance < needed:
+                        wait = max(wait, (needed - self.token_allowance) / self.tokens_per_minute * 60)
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if self.requests_per_minute:
+                self.request_allowance -= 1
+            if self.tokens_per_minute:
+                self.token_allowance -= tokens
+
+
+def estimate_tokens(text):
+    """ rough token estimate for rate limiting, about four characters per token. """
+    return len(text) // 4 + 1
+
+
+async def correct_line(client, lines, xml, store, semaphore, limiter, retries=5,
+                       backoff=1.0, cache=None, stream=None):
+    """
+    Sends one line to the LLM, retrying with exponential backoff on errors
+    and on responses that are not valid JSON, and writes the result for all
+    line numbers in `lines` (identical lines). A cached response is used
+    without sending a request.
+    With a StreamStats object as `stream`, the response is streamed and its
+    'fixed_xml' validated while it arrives (see xml_stream.py); a generation
+    that can no longer become valid XML is aborted and resubmitted at once.
+    Returns None on success, otherwise the error message of the last attempt.
+    """
+    key = ResponseCache.key(MODEL, prompt, xml)
+    entry = cache.get(key) if cache else None
+    if entry:
+        metrics.count("cache_hits", len(lines))
+        for line in lines:
+            store.put(line, entry["raw"], entry["content"])
+        return None
+
+    request_text = f"{prompt}\n{xml}"
+
+    async def attempt():
+        await limiter.acquire(estimate_tokens(request_text))
+        async with semaphore:
+            start = time.monotonic()
+            if stream is not None:
+                response = await asyncio.to_thread(client.prompt_stream, MODEL, request_text)
+                try:
+                    content = json.loads(await asyncio.to_thread(read_stream, response, stream))
+                except GenerationAborted as e:
+                    # an aborted generation is not a server problem, so it is resubmitted without waiting
+                    metrics.count("generations_aborted")
+                    print(f"Line {lines[0]} aborted after {e.received} chars: {e}")
+                    raise RetryNow(f"GenerationAborted: {e}") from e
+                duration = time.monotonic() - start
+            else:
+                response, duration = await asyncio.to_thread(client.prompt, MODEL, request_text)
+                content = json.loads(response.text)
+        return response, duration, content
+
+    try:
+        response, duration, content = await with_retries(attempt, MODEL, retries, backoff, label=f"Line {lines[0]}")
+    except RequestFailed as e:
+        return str(e)
+    raw = response.to_dict()
+    metrics.observe_response(MODEL, duration, raw)
+    if cache:
+        cache.put(key, raw, content)
+        cache.record_hits(len(lines) - 1)
+    for line in lines:
+        store.put(line, raw, content)
+    return None
+
+
+async def run_concurrent(client, xmls, store, concurrency=8, requests_per_minute=None,
+                         tokens_per_minute=None, retries=5, cache=None,
+                         failures_path=FAILURES_PATH, stream=False):
+    """
+    Sends all lines that have not been processed yet with at most `concurrency`
+    requests in flight, one request per distinct line. Lines that still fail
+    after all retries are recorded in failures_path instead of aborting the run;
+    they are retried on the next run, like any line without a stored result.
+    With stream=True, responses are streamed and validated incrementally.
+    """
+    lines = len(xmls)
+    groups = group_pending_lines(xmls, store)
+    pending = sum(len(group_lines) for _, group_lines in groups.values())
+    print(f"{lines - pending} of {lines} lines already processed, "
+          f"{pending} to do ({len(groups)} distinct).")
+
+    # client.prompt blocks, so each request in flight needs its own thread
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    stream_stats = StreamStats() if stream else None
+
+    start = time.monotonic()
+    with metrics.timer("correct") as stage:
+        errors = await asyncio.gather(*(
+            correct_line(client, group_lines, xml, store, semaphore, limiter, retries,
+                         cache=cache, stream=stream_stats)
+            for xml, group_lines in groups.values()
+        ))
+        stage.items = pending
+    elapsed = time.monotonic() - start
+
+    failures = {line: error for (_, group_lines), error in zip(groups.values(), errors)
+                if error is not None for line in group_lines}
+    save_failures(failures, failures_path)
+
+    done = pending - len(failures)
+    metrics.count("lines_failed", len(failures))
+    rate = done / elapsed if elapsed > 0 else 0.0
+    print(f"Processed {done} lines in {elapsed:.1f}s ({rate:.2f} lines/s), {len(failures)} failed.")
+    if stream_stats:
+        stream_stats.report()
+    if cache:
+        cache.report()
+    return failures
+
+
+def batch_custom_id(line):
+    return f"line-{line}"
+
+
+def line_from_custom_id(custom_id):
+    return int(custom_id.rsplit("-", 1)[1])
+
+
+def export_batch(xmls, batch_path, store, cache=None):
+    """
+    Writes one OpenAI Batch API request per distinct line that has not been
+    processed yet to a JSONL file. The custom_id encodes the line number
+    in incorrect_tags.txt (of the first of identical lines). Lines with
+    a cached response are written directly instead of being exported.
+    Returns the number of exported requests.
+    """
+    exported = 0
+    with(open(batch_path, "w", encoding="utf-8")) as f_out:
+        for key, (xml, lines) in group_pending_lines(xmls, store).items():
+            entry = cache.get(key) if cache else None
+            if entry:
+                for line in lines:
+                    store.put(line, entry["raw"], entry["content"])
+                continue
+            request = {
+                "custom_id": batch_custom_id(lines[0]),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": MODEL,
+                    "messages": [{"role": "user", "content": f"{prompt}\n{xml}"}]
+                }
+            }
+            f_out.write(json.dumps(request, ensure_ascii=False) + "\n")
+            exported += 1
+            if cache:
+                cache.record_hits(len(lines) - 1)
+    print(f"Exported {exported} requests to {batch_path}")
+    if cache:
+        cache.report()
+    return exported
+
+
+class BatchResponse:
+    """ wraps a chat completion from a batch result like the responses of ai_client. """
+
+    def __init__(self, body):
+        choice = body["choices"][0]
+        usage = body.get("usage", {})
+        self.text = choice["message"]["content"]
+        self.model = body.get("model")
+        self.finish_reason = choice.get("finish_reason")
+        self.input_tokens = usage.get("prompt_tokens", 0)
+        self.output_tokens = usage.get("completion_tokens", 0)
+        self.created = body.get("created")
+
+    def to_dict(self):
+        return {
+            "text": self.text,
+            "model": self.model,
+            "provider": "openai-batch",
+            "finish_reason": self.finish_reason,
+            "usage": {
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": self.input_tokens + self.output_tokens
+            },
+            "duration": None,
+            "timestamp": datetime.fromtimestamp(self.created).isoformat() if self.created else None
+        }
+
+
+def import_batch(results_path, xmls, store, cache=None, failures_path=FAILURES_PATH):
+    """
+    Reads a Batch API results JSONL file and writes the same raw/content
+    line_N.json files as the synchronous runs, for the exported line and
+    all unprocessed lines identical to it. Failed requests and responses
+    that are not valid JSON are recorded in failures_path.
+    Returns the dictionary of failed lines.
+    """
+    groups = group_pending_lines(xmls, store)
+    imported = 0
+    failures = {}
+    with(open(results_path, "r", encoding="utf-8")) as f:
+        for result_line in f:
+            if not result_line.strip():
+                continue
+            result = json.loads(result_line)
+            line = line_from_custom_id(result["custom_id"])
+            response = result.get("response") or {}
+            if result.get("error") or response.get("status_code") != 200:
+                failures[line] = str(result.get("error") or response.get("body"))
+                continue
+            try:
+                batch_response = BatchResponse(response["body"])
+                content = json.loads(batch_response.text)
+            except (KeyError, IndexError, json.JSONDecodeError) as e:
+                failures[line] = f"{type(e).__name__}: {e}"
+                continue
+            if line not in xmls:
+                # outside of --lines
+                continue
+            raw = batch_response.to_dict()
+            key = ResponseCache.key(MODEL, prompt, xmls[line])
+            if cache:
+                cache.put(key, raw, content)
+            for group_line in groups.get(key, (None, [line]))[1]:
+                store.put(group_line, raw, content)
+                imported += 1
+
+    save_failures(failures, failures_path)
+    print(f"Imported {imported} results from {results_path}, {len(failures)} failed.")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correct malformed XML lines with an LLM.")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="number of requests in flight (1 = the original sequential loop)")
+    parser.add_argument("--requests-per-minute", type=float, default=None)
+    parser.add_argument("--tokens-per-minute", type=float, default=None)
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--export-batch", metavar="JSONL",
+                        help="write a Batch API request file for all unprocessed lines and exit")
+    parser.add_argument("--import-batch", metavar="JSONL",
+                        help="write the output files from a Batch API results file and exit")
+    parser.add_argument("--repair", action="store_true",
+                        help="fix mechanical defects with the rule-based repair pass first")
+    parser.add_argument("--max-fixes", type=int, default=3,
+                        help="lines needing more structural fixes are left for the LLM")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream the responses and abort generations with broken XML early")
+    parser.add_argument("--stub", action="store_true",
+                        help="use the local stub client instead of the OpenAI API")
+    parser.add_argument("--stub-latency", type=float, default=0.5,
+                        help="mean latency of the stub client in seconds")
+    parser.add_argument("--stub-error-rate", type=float, default=0.02,
+                        help="share of stub requests that fail, and of stub responses that are invalid JSON")
+    parser.add_argument("--stub-broken-xml-rate", type=float, default=0.0,
+                        help="share of stub responses with a mismatched closing tag")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not read or write the response cache")
+    parser.add_argument("--store", default=None,
+                        help="result store: a directory for line_N.json files (default: the output "
+                             "directory) or a .sqlite file")
+    parser.add_argument("--output-dir", default=None,
+                        help=f"defaults to '{OUTPUT_DIR}', or 'output_stub' with --stub")
+    parser.add_argument("--lines", type=parse_line_range, default=None,
+                        help="only process these lines of the input file, e.g. 120-180")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    output_dir = args.output_dir or ("output_stub" if args.stub else OUTPUT_DIR)
+
+    xmls = load_lines(line_range=args.lines)
+    print("Opened input file with", len(xmls), "lines." if args.lines is None else "selected lines.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    store = open_store(args.store or output_dir)
+    failures_path = os.path.join(output_dir, "failed_lines.json")
+    cache = None if args.no_cache else ResponseCache(os.path.join(output_dir, "response_cache.jsonl"))
+
+    with metrics.session(args, "correction"):
+        if args.repair:
+            repair_pending_lines(xmls, store, args.max_fixes)
+
+        if args.export_batch:
+            export_batch(xmls, args.export_batch, store, cache)
+        elif args.import_batch:
+            import_batch(args.import_batch, xmls, store, cache, failures_path)
+        elif args.concurrency > 1 or args.stream:
+            client = create_client(args.stub, args.stub_latency, args.stub_broken_xml_rate, args.stub_error_rate)
+            asyncio.run(run_concurrent(client, xmls, store, args.concurrency, args.requests_per_minute,
+                                       args.tokens_per_minute, args.retries, cache, failures_path,
+                                       args.stream))
+        else:
+            client = create_client(args.stub, args.stub_latency, args.stub_broken_xml_rate, args.stub_error_rate)
+            run_sequential(client, xmls, store, cache)
+    store.close()
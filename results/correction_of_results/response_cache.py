@@ -0,0 +1,72 @@
+"""
+Persistent, content-addressed cache for the LLM corrections.
+
+The Avisblatt reprinted many ads week after week, so incorrect_tags.txt contains
+identical or nearly identical lines. Responses are cached under a hash of
+(model, prompt, normalized line), and each distinct input is sent only once.
+The cache is an append-only JSON Lines file, one entry per key.
+"""
+
+import hashlib
+import json
+import os
+import sys
+
+# the consolidation's normalizer (results/format_output.py), so cache keys and
+# the consolidation see the same line
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from format_output import normalize_xml  # noqa: E402
+
+
+class ResponseCache:
+    """
+    Maps cache keys to the raw response and parsed content of a correction.
+
+    Args:
+        path: JSON Lines file the cache is loaded from and appended to
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with(open(path, "r", encoding="utf-8")) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # an interrupted write leaves a truncated last line
+                        continue
+                    self.entries[entry["key"]] = entry
+
+    @staticmethod
+    def key(model, prompt, xml):
+        text = "\0".join((model, prompt, normalize_xml(xml)))
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """ returns the cached entry with 'raw' and 'content', None if there is none. """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def record_hits(self, count):
+        """ counts lines answered by a response shared with an identical line of the same run. """
+        self.hits += count
+
+    def put(self, key, raw, content):
+        entry = {"key": key, "raw": raw, "content": content}
+        self.entries[key] = entry
+        with(open(self.path, "a", encoding="utf-8")) as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def report(self):
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        print(f"Cache: {self.hits} hits, {self.misses} misses ({rate:.1%} hit rate), "
+              f"{len(self.entries)} entries in {self.path}")
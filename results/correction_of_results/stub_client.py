@@ -0,0 +1,141 @@
+"""
+Local stand-in for the ai_client used by correction_of_malformed_xml_with_LLM.py,
+to test the throughput of the correction runner without network access.
+
+The stub answers every prompt after a random latency with the same JSON shape
+the correction prompt asks for, echoing the input line as 'fixed_xml' (or the
+result of a fix function, e.g. the rule-based repair).
+A configurable share of answers is invalid JSON or raises, to exercise retries,
+and a share gets a mismatched closing tag in 'fixed_xml', to exercise the early
+abort of streamed responses. prompt_stream returns the answer in chunks of
+about one token, spread over the same latency. Other runners pass their own
+answer function, e.g. annotate_ads.py for the annotation prompt.
+"""
+
+import json
+import random
+import time
+from datetime import datetime
+
+
+class StubResponse:
+    """ mimics the response object returned by ai_client. """
+
+    def __init__(self, text, model, duration, input_tokens, output_tokens):
+        self.text = text
+        self.model = model
+        self.duration = duration
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+
+    def to_dict(self):
+        return {
+            "text": self.text,
+            "model": self.model,
+            "provider": "stub",
+            "finish_reason": "stop",
+            "usage": {
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "total_tokens": self.input_tokens + self.output_tokens
+            },
+            "duration": self.duration,
+            "timestamp": datetime.now().isoformat()
+        }
+
+
+class StubStream:
+    """ a streamed stub response: iterates over the chunks, to_dict() once exhausted. """
+
+    def __init__(self, chunks, model, duration, input_tokens):
+        self.chunks = chunks
+        self.model = model
+        self.duration = duration
+        self.input_tokens = input_tokens
+        self.received = []
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.closed:
+                return
+            time.sleep(self.duration / len(self.chunks))
+            self.received.append(chunk)
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+    def to_dict(self):
+        text = "".join(self.received)
+        return StubResponse(text, self.model, self.duration, self.input_tokens, len(text) // 4).to_dict()
+
+
+class StubClient:
+    """
+    Client with the same prompt(model, text) -> (response, duration) interface as ai_client,
+    and prompt_stream(model, text) for streamed responses.
+
+    Args:
+        latency: mean latency of a request in seconds
+        invalid_json_rate: share of responses that are not valid JSON
+        error_rate: share of requests that raise, like a dropped connection
+        broken_xml_rate: share of responses with a mismatched closing tag in 'fixed_xml'
+        fix: function applied to the input line to get 'fixed_xml', None to echo it
+        answer: function (request text, random generator) -> response text, instead
+            of the answer to the correction prompt
+        seconds_per_token: additional latency per input and output token
+        seed: seed for the random generator, for reproducible runs
+    """
+
+    def __init__(self, latency=0.5, invalid_json_rate=0.0, error_rate=0.0, broken_xml_rate=0.0,
+                 fix=None, answer=None, seconds_per_token=0.0, seed=None):
+        self.latency = latency
+        self.invalid_json_rate = invalid_json_rate
+        self.error_rate = error_rate
+        self.broken_xml_rate = broken_xml_rate
+        self.fix = fix
+        self.answer = answer
+        self.seconds_per_token = seconds_per_token
+        self.random = random.Random(seed)
+
+    def _duration(self, text, content):
+        return (self.random.uniform(0.5, 1.5) * self.latency
+                + (len(text) + len(content)) // 4 * self.seconds_per_token)
+
+    def _content(self, text):
+        if self.answer:
+            return self.answer(text, self.random)
+        # the correction prompt is a single line followed by the XML line
+        xml = text.split("\n", 1)[-1].strip()
+        fixed_xml = self.fix(xml) if self.fix else xml
+        if self.random.random() < self.broken_xml_rate:
+            position = int(len(fixed_xml) * self.random.uniform(0.2, 0.8))
+            fixed_xml = fixed_xml[:position] + "</NOTE>" + fixed_xml[position:]
+        if self.random.random() < self.invalid_json_rate:
+            return '{"fixed_xml": "' + fixed_xml
+        return json.dumps({
+            "fixed_xml": fixed_xml,
+            "number_of_fixes": 0,
+            "explanation": "stub: returned the input unchanged." if not self.fix else "stub: repaired the input."
+        }, ensure_ascii=False, indent=2)
+
+    def prompt(self, model, text):
+        content = self._content(text)
+        duration = self._duration(text, content)
+        time.sleep(duration)
+
+        if self.random.random() < self.error_rate:
+            raise ConnectionError("stub: simulated connection error")
+
+        response = StubResponse(content, f"{model}-stub", duration,
+                                input_tokens=len(text) // 4, output_tokens=len(content) // 4)
+        return response, duration
+
+    def prompt_stream(self, model, text):
+        if self.random.random() < self.error_rate:
+            raise ConnectionError("stub: simulated connection error")
+
+        content = self._content(text)
+        chunks = [content[i:i + 4] for i in range(0, len(content), 4)]
+        return StubStream(chunks, f"{model}-stub", self._duration(text, content), input_tokens=len(text) // 4)
@@ -0,0 +1,140 @@
+"""
+Incremental validation of streamed LLM corrections.
+
+With --stream, the correction runner reads the response chunk by chunk. The
+'fixed_xml' string is decoded from the JSON as it arrives and fed into an
+XMLPullParser ('&' escaped as in evaluate_tsv.escape_xml_text), so a generation
+is aborted as soon as it contains a mismatched closing tag, an unknown tag name
+or anything else the parser rejects, instead of after the whole response.
+
+A streaming client has prompt_stream(model, text), returning an iterable of text
+chunks with close() to stop the generation and to_dict() for the raw response
+once the stream is exhausted (see stub_client.StubStream).
+"""
+
+import json
+import re
+from xml.etree.ElementTree import ParseError, XMLPullParser
+
+from evaluate_tsv import ANNOTATION_TAGS, escape_xml_text
+
+
+class GenerationAborted(Exception):
+    """ raised when a streamed generation can no longer become valid XML. """
+
+    def __init__(self, reason, received):
+        super().__init__(reason)
+        self.received = received
+
+
+class JsonStringReader:
+    """ decodes the string value of one key from a JSON object streamed in chunks. """
+
+    _ESCAPE_RE = re.compile(r'\\(?:u[0-9a-fA-F]{4}(?:\\u[0-9a-fA-F]{4})?|[^u])')
+
+    def __init__(self, key):
+        self._start_re = re.compile(r'"' + re.escape(key) + r'"\s*:\s*"')
+        self._buffer = ""
+        self.started = False
+        self.finished = False
+
+    def feed(self, text):
+        """ returns the newly decoded characters of the value. """
+        if self.finished:
+            return ""
+        self._buffer += text
+        if not self.started:
+            match = self._start_re.search(self._buffer)
+            if not match:
+                return ""
+            self.started = True
+            self._buffer = self._buffer[match.end():]
+
+        decoded = []
+        position = 0
+        while position < len(self._buffer):
+            char = self._buffer[position]
+            if char == '"':
+                self.finished = True
+                break
+            if char != "\\":
+                decoded.append(char)
+                position += 1
+                continue
+            match = self._ESCAPE_RE.match(self._buffer, position)
+            # wait for the rest of an escape sequence, or the low half of a surrogate pair
+            incomplete = match is None or (match.group(0).startswith("\\u")
+                                           and 0xD800 <= int(match.group(0)[2:6], 16) < 0xDC00
+                                           and len(match.group(0)) == 6)
+            if incomplete and len(self._buffer) - position < 12:
+                break
+            if match is None:
+                raise GenerationAborted("invalid escape sequence in JSON string", position)
+            decoded.append(json.loads(f'"{match.group(0)}"'))
+            position = match.end()
+        self._buffer = self._buffer[position:]
+        return "".join(decoded)
+
+
+class StreamingXmlValidator:
+    """ feeds XML text into an XMLPullParser and raises GenerationAborted on the first error. """
+
+    def __init__(self, allowed_tags=ANNOTATION_TAGS):
+        self.allowed_tags = set(allowed_tags)
+        self.parser = XMLPullParser(events=("start",))
+        self.parser.feed("<root>")
+        self.received = 0
+
+    def feed(self, text):
+        self.received += len(text)
+        # the pull parser reports syntax errors from read_events
+        try:
+            self.parser.feed(escape_xml_text(text))
+            events = list(self.parser.read_events())
+        except ParseError as e:
+            raise GenerationAborted(str(e), self.received)
+        for _, element in events:
+            if element.tag != "root" and element.tag not in self.allowed_tags:
+                raise GenerationAborted(f"unknown tag <{element.tag}>", self.received)
+
+
+class StreamStats:
+    """ counts completed and aborted generations and the characters received. """
+
+    def __init__(self):
+        self.completed = 0
+        self.aborted = 0
+        self.aborted_chars = 0
+        self.completed_chars = 0
+
+    def report(self):
+        aborted_average = self.aborted_chars / self.aborted if self.aborted else 0
+        completed_average = self.completed_chars / self.completed if self.completed else 0
+        print(f"Streaming: {self.completed} generations completed (avg. {completed_average:.0f} chars), "
+              f"{self.aborted} aborted early (avg. {aborted_average:.0f} chars received).")
+
+
+def read_stream(stream, stats=None, key="fixed_xml"):
+    """
+    Reads a streamed JSON response, validating the XML in `key` as it arrives.
+    Returns the complete response text. On an unrecoverable XML error the
+    stream is closed and GenerationAborted is raised.
+    """
+    reader = JsonStringReader(key)
+    validator = StreamingXmlValidator()
+    chunks = []
+    try:
+        for chunk in stream:
+            chunks.append(chunk)
+            validator.feed(reader.feed(chunk))
+    except GenerationAborted:
+        stream.close()
+        if stats:
+            stats.aborted += 1
+            stats.aborted_chars += sum(len(chunk) for chunk in chunks)
+        raise
+    text = "".join(chunks)
+    if stats:
+        stats.completed += 1
+        stats.completed_chars += len(text)
+    return text
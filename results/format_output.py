@@ -7,11 +7,25 @@ A subset of values from this file is in "incorrect_tags.txt". They refer to a ce
 For each line in the subset, a LLM-generated correction was saved in the form "line_X.json"
 """
 
+import argparse
 import csv
 import json
+import multiprocessing
+import os
+import re
+import sys
+import time
 import xml.etree.ElementTree as ET
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterable, Iterator, List, Optional, Any
+
+from result_store import SqliteResultStore
+
+# metrics and line_index are shared with the scripts in the repository root
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import metrics  # noqa: E402
+from line_index import LineIndex  # noqa: E402
 
 
 def load_ground_data(tsv_path: str) -> List[Dict[str, Any]]:
@@ -105,8 +119,51 @@ def xml_to_json_lowercase(xml_string: str) -> Optional[Dict[str, Any]]:
 
 
 def _element_to_dict_lowercase(element: ET.Element) -> Dict[str, Any]:
+    """
+    Convert XML element to dictionary with lowercase keys.
+
+    Iterative version of _element_to_dict_lowercase_recursive: elements are
+    visited top-down with an explicit stack, each child value is inserted into
+    its parent's dictionary directly (dictionaries of elements with children
+    are filled when the element is popped), and leaves are never pushed.
+
+    Args:
+        element: XML Element to convert
+
+    Returns:
+        Nested dictionary with tag: value/nested_dict structure
+    """
+    if len(element) == 0:
+        # Leaf element - just return tag: text
+        return {element.tag.lower(): element.text.strip() if element.text else ""}
+
+    root_dict = {}
+    stack = [(element, root_dict)]
+    while stack:
+        current, children_dict = stack.pop()
+        for child in current:
+            child_tag = child.tag.lower()
+            if len(child) > 0:
+                child_value = {}
+                stack.append((child, child_value))
+            else:
+                child_value = child.text.strip() if child.text else ""
+
+            # If tag already exists, convert to list or append to list
+            if child_tag in children_dict:
+                if not isinstance(children_dict[child_tag], list):
+                    children_dict[child_tag] = [children_dict[child_tag]]
+                children_dict[child_tag].append(child_value)
+            else:
+                children_dict[child_tag] = child_value
+
+    return {element.tag.lower(): root_dict}
+
+
+def _element_to_dict_lowercase_recursive(element: ET.Element) -> Dict[str, Any]:
     """
     Convert XML element to dictionary with lowercase keys (recursive helper).
+    Reference implementation for _element_to_dict_lowercase, used by the benchmark.
 
     Args:
         element: XML Element to convert
@@ -121,7 +178,7 @@ def _element_to_dict_lowercase(element: ET.Element) -> Dict[str, Any]:
         children_dict = {}
         for child in element:
             child_tag = child.tag.lower()
-            child_data = _element_to_dict_lowercase(child)
+            child_data = _element_to_dict_lowercase_recursive(child)
 
             # If tag already exists, convert to list or append to list
             if child_tag in children_dict:
@@ -139,10 +196,306 @@ def _element_to_dict_lowercase(element: ET.Element) -> Dict[str, Any]:
 
 
 
+def iter_ground_data(tsv_path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the ground data TSV file row by row.
+
+    Args:
+        tsv_path: Path to the all_bib_items_annotated.tsv file
+
+    Yields:
+        Dictionaries containing one row of the ground data
+    """
+    with open(tsv_path, 'r', encoding='utf-8') as f:
+        yield from csv.DictReader(f, delimiter='\t')
+
+
+def is_faulty_record(record: Dict[str, Any]) -> bool:
+    """
+    Check if a record is faulty based on the quality_xml_well_formed column.
+    """
+    return record.get("quality_xml_well_formed", "").upper() == "FALSE"
+
+
+def build_correction_index(tsv_path: str) -> Dict[str, int]:
+    """
+    Build the index from record id to line number in incorrect_tags.txt.
+
+    The Nth faulty record of the ground data is line N of incorrect_tags.txt.
+    Only the ids of faulty records are kept, so the index stays small; an id
+    that occurs in several faulty records maps to the line of the last one.
+
+    Args:
+        tsv_path: Path to the all_bib_items_annotated.tsv file
+
+    Returns:
+        Dictionary mapping record id to line number (starting at 1)
+    """
+    correction_index = {}
+    faulty_count = 0
+    for record in iter_ground_data(tsv_path):
+        if is_faulty_record(record):
+            faulty_count += 1
+            correction_index[record.get("id", "")] = faulty_count
+    return correction_index
+
+
+# sidecars written before repeated faulty ids were counted correctly have no version
+CORRECTION_INDEX_VERSION = 2
+
+
+def load_correction_index(tsv_path: str) -> Dict[str, int]:
+    """
+    Load the correction index of build_correction_index from a sidecar file.
+
+    The index is stored next to the ground data as <tsv_path>.corrections.json
+    with the size and modification time of the TSV file, and rebuilt with a
+    full scan only when they have changed or the sidecar has an older version.
+
+    Args:
+        tsv_path: Path to the all_bib_items_annotated.tsv file
+
+    Returns:
+        Dictionary mapping record id to line number (starting at 1)
+    """
+    sidecar_path = tsv_path + ".corrections.json"
+    stat = os.stat(tsv_path)
+    try:
+        with open(sidecar_path, 'r', encoding='utf-8') as f:
+            sidecar = json.load(f)
+        if (sidecar["version"], sidecar["size"], sidecar["mtime_ns"]) == (
+                CORRECTION_INDEX_VERSION, stat.st_size, stat.st_mtime_ns):
+            return sidecar["index"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    correction_index = build_correction_index(tsv_path)
+    try:
+        with open(sidecar_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": CORRECTION_INDEX_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                       "index": correction_index}, f)
+    except OSError:
+        pass
+    return correction_index
+
+
+def _correction_loader(corrections_dir: str):
+    """
+    Return a function loading the correction for a line number, and the store to close.
+    """
+    if corrections_dir.endswith((".sqlite", ".db")):
+        store = SqliteResultStore(corrections_dir)
+        return store.get_content, store
+
+    def load(line_number: int) -> Optional[Dict[str, Any]]:
+        return load_correction(str(Path(corrections_dir) / f"line_{line_number}.json"))
+    return load, None
+
+
+def consolidate_record(
+    record: Dict[str, Any],
+    xml_column: str,
+    correction: Optional[Dict[str, Any]],
+    skip_known_faulty: bool = False
+) -> Dict[str, Any]:
+    """
+    Create the consolidated entry for one ground data record.
+
+    Every record is parsed at most once. With skip_known_faulty, faulty records
+    without a usable correction are not parsed at all, since the evaluation
+    already found their XML to be malformed; their json_representation holds
+    the error message from the quality_error_message column instead. That
+    message comes from the evaluation, so its positions differ from those of
+    a parse here; the output is only the same as without skip_known_faulty
+    up to these messages.
+
+    Args:
+        record: Row of the ground data
+        xml_column: Name of the column containing the annotated XML
+        correction: Correction for the record if it is faulty and one exists
+        skip_known_faulty: Do not parse original XML known to be malformed
+
+    Returns:
+        Consolidated data record
+    """
+    original_xml = record[xml_column]
+
+    # Create base entry
+    entry = {
+        "id": record.get("id", ""),
+        "original_xml": original_xml,
+        "is_faulty": is_faulty_record(record),
+        "has_correction": False,
+        "corrected_xml": None,
+        "number_of_fixes": 0,
+        "fix_explanation": None,
+        "json_representation": None,
+        "metadata": {k: v for k, v in record.items() if k not in ['id', xml_column]}
+    }
+
+    if entry["is_faulty"] and correction:
+        entry["has_correction"] = True
+        entry["corrected_xml"] = correction.get("fixed_xml")
+        entry["number_of_fixes"] = correction.get("number_of_fixes", 0)
+        entry["fix_explanation"] = correction.get("explanation")
+
+        # Create JSON representation of corrected XML
+        if entry["corrected_xml"]:
+            entry["json_representation"] = xml_to_json_lowercase(entry["corrected_xml"])
+
+    # For non-faulty lines or faulty lines without corrections,
+    # try to create JSON representation from original (may fail for faulty ones)
+    if entry["json_representation"] is None:
+        if skip_known_faulty and entry["is_faulty"]:
+            error = record.get("quality_error_message") or "not well-formed"
+            entry["json_representation"] = {"error": f"Failed to parse XML: {error}"}
+        else:
+            entry["json_representation"] = xml_to_json_lowercase(original_xml)
+
+    return entry
+
+
+def consolidate_chunk(chunk: List[tuple], skip_known_faulty: bool = False) -> List[Dict[str, Any]]:
+    """
+    Consolidate a chunk of (record, xml_column, correction) tuples,
+    used as the unit of work for the process pool.
+    """
+    return [consolidate_record(record, xml_column, correction, skip_known_faulty)
+            for record, xml_column, correction in chunk]
+
+
+def iter_consolidated_records(
+    tsv_path: str,
+    corrections_dir: str,
+    correction_index: Optional[Dict[str, int]] = None,
+    workers: int = 1,
+    chunk_size: int = 500,
+    skip_known_faulty: bool = False
+) -> Iterator[Dict[str, Any]]:
+    """
+    Stream consolidated records, joining corrections by record id.
+
+    Reading the TSV and loading corrections happens in this process; with
+    workers > 1 the XML-to-JSON conversion runs on a process pool over chunks
+    of chunk_size records, and records are still yielded in input order.
+
+    Args:
+        tsv_path: Path to the all_bib_items_annotated.tsv file
+        corrections_dir: Directory containing line_X.json correction files,
+            or a .sqlite result store written by the correction script
+        correction_index: Record id to line number in incorrect_tags.txt,
+            built with build_correction_index if not given
+        workers: Number of processes for the conversion
+        chunk_size: Number of records per unit of work
+        skip_known_faulty: See consolidate_record
+
+    Yields:
+        Consolidated data records in the order of the ground data
+    """
+    if correction_index is None:
+        correction_index = build_correction_index(tsv_path)
+    load, store = _correction_loader(corrections_dir)
+
+    try:
+        with open(tsv_path, 'r', encoding='utf-8') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            columns = reader.fieldnames or []
+            if len(columns) < 2:
+                raise ValueError("Could not determine XML column in ground data")
+            xml_column = columns[1]
+
+            def chunks():
+                chunk = []
+                for record in reader:
+                    correction = None
+                    line_number = correction_index.get(record.get("id", ""))
+                    if line_number is not None and is_faulty_record(record):
+                        correction = load(line_number)
+                    chunk.append((record, xml_column, correction))
+                    if len(chunk) >= chunk_size:
+                        yield chunk
+                        chunk = []
+                if chunk:
+                    yield chunk
+
+            if workers <= 1:
+                for chunk in chunks():
+                    yield from consolidate_chunk(chunk, skip_known_faulty)
+                return
+
+            with multiprocessing.Pool(workers) as pool:
+                # at most two chunks per worker in flight, so memory stays bounded
+                pending = deque()
+                for chunk in chunks():
+                    pending.append(pool.apply_async(consolidate_chunk, (chunk, skip_known_faulty)))
+                    if len(pending) >= 2 * workers:
+                        yield from pending.popleft().get()
+                while pending:
+                    yield from pending.popleft().get()
+    finally:
+        if store:
+            store.close()
+
+
+def rebuild_records(
+    tsv_path: str,
+    record_ids: Iterable[str],
+    corrections_dir: str,
+    skip_known_faulty: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    Consolidate only the records with the given ids, without a full scan.
+
+    The rows are read through the line offset index of the TSV file (see
+    line_index.py) and the corrections through the cached correction index,
+    so after the first run only the requested rows are read.
+
+    Args:
+        tsv_path: Path to the all_bib_items_annotated.tsv file
+        record_ids: Ids of the records to rebuild
+        corrections_dir: Directory containing line_X.json correction files,
+            or a .sqlite result store written by the correction script
+        skip_known_faulty: See consolidate_record
+
+    Returns:
+        Consolidated data records in the order of record_ids; ids that are
+        not in the ground data are skipped
+    """
+    correction_index = load_correction_index(tsv_path)
+    load, store = _correction_loader(corrections_dir)
+
+    with open(tsv_path, 'r', encoding='utf-8') as f:
+        columns = next(csv.reader([f.readline()], delimiter='\t'))
+    if len(columns) < 2 or "id" not in columns:
+        raise ValueError("Could not determine id and XML column in ground data")
+    xml_column = columns[1]
+
+    records = []
+    try:
+        with LineIndex(tsv_path, id_column=columns.index("id"), header_lines=1) as index:
+            for record_id in record_ids:
+                line_number = index.find(record_id)
+                if line_number is None:
+                    print(f"No record with id {record_id} in {tsv_path}")
+                    continue
+                record = dict(zip(columns, next(csv.reader([index.line(line_number)], delimiter='\t'))))
+                correction = None
+                correction_line = correction_index.get(record_id)
+                if correction_line is not None and is_faulty_record(record):
+                    correction = load(correction_line)
+                records.append(consolidate_record(record, xml_column, correction, skip_known_faulty))
+    finally:
+        if store:
+            store.close()
+    return records
+
+
 def create_consolidated_dataset(
     tsv_path: str,
     faulty_lines_path: str,
-    corrections_dir: str
+    corrections_dir: str,
+    workers: int = 1,
+    skip_known_faulty: bool = False
 ) -> List[Dict[str, Any]]:
     """
     Create consolidated dataset combining ground data with corrections.
@@ -150,84 +503,70 @@ def create_consolidated_dataset(
     Args:
         tsv_path: Path to the all_bib_items_annotated.tsv file
         faulty_lines_path: Path to the incorrect_tags.txt file
-        corrections_dir: Directory containing line_X.json correction files
+        corrections_dir: Directory containing line_X.json correction files,
+            or a .sqlite result store written by the correction script
+        workers: Number of processes for the XML-to-JSON conversion
+        skip_known_faulty: See consolidate_record
 
     Returns:
         List of consolidated data records
     """
-    # Load all data
-    ground_data = load_ground_data(tsv_path)
     faulty_lines = load_faulty_lines(faulty_lines_path)
+    correction_index = build_correction_index(tsv_path)
 
-    # Get XML column name
-    columns = list(ground_data[0].keys()) if ground_data else []
-    xml_column = columns[1] if len(columns) > 1 else None
+    print(f"Found {len(correction_index)} faulty records in ground data")
+    print(f"Found {len(faulty_lines)} lines in incorrect_tags.txt")
 
-    if not xml_column:
-        raise ValueError("Could not determine XML column in ground data")
+    return list(iter_consolidated_records(tsv_path, corrections_dir, correction_index,
+                                          workers=workers, skip_known_faulty=skip_known_faulty))
 
-    # Extract faulty records from ground data (in order)
-    faulty_ground_records = []
-    for record in ground_data:
-        if record.get("quality_xml_well_formed", "").upper() == "FALSE":
-            faulty_ground_records.append(record)
 
-    print(f"Found {len(faulty_ground_records)} faulty records in ground data")
-    print(f"Found {len(faulty_lines)} lines in incorrect_tags.txt")
+def benchmark_consolidation(tsv_path: str, corrections_dir: str, workers: int) -> Dict[str, float]:
+    """
+    Benchmark the consolidation and print records per second.
 
-    # Create position-based mapping: Nth faulty record -> line N in incorrect_tags.txt
-    faulty_record_to_line = {}
-    for idx, record in enumerate(faulty_ground_records):
-        record_id = record.get("id", "")
-        faulty_record_to_line[record_id] = idx + 1  # Line numbers start at 1
-
-    consolidated = []
-
-    for record in ground_data:
-        original_xml = record[xml_column]
-
-        # Check if line is faulty based on quality_xml_well_formed column
-        is_faulty = record.get("quality_xml_well_formed", "").upper() == "FALSE"
-
-        # Create base entry
-        entry = {
-            "id": record.get("id", ""),
-            "original_xml": original_xml,
-            "is_faulty": is_faulty,
-            "has_correction": False,
-            "corrected_xml": None,
-            "number_of_fixes": 0,
-            "fix_explanation": None,
-            "json_representation": None,
-            "metadata": {k: v for k, v in record.items() if k not in ['id', xml_column]}
-        }
-
-        # If faulty, look up the correction by position
-        if is_faulty:
-            record_id = record.get("id", "")
-            if record_id in faulty_record_to_line:
-                line_number = faulty_record_to_line[record_id]
-                correction_file = Path(corrections_dir) / f"line_{line_number}.json"
-
-                correction = load_correction(str(correction_file))
-                if correction:
-                    entry["has_correction"] = True
-                    entry["corrected_xml"] = correction.get("fixed_xml")
-                    entry["number_of_fixes"] = correction.get("number_of_fixes", 0)
-                    entry["fix_explanation"] = correction.get("explanation")
-
-                    # Create JSON representation of corrected XML
-                    if entry["corrected_xml"]:
-                        entry["json_representation"] = xml_to_json_lowercase(entry["corrected_xml"])
-
-        # For non-faulty lines or faulty lines without corrections,
-        # try to create JSON representation from original (may fail for faulty ones)
-        if entry["json_representation"] is None:
-            entry["json_representation"] = xml_to_json_lowercase(original_xml)
+    Times the XML-to-JSON converters on all parseable records, then the full
+    consolidation sequentially (as before), sequentially without re-parsing
+    known faulty records, and on a process pool with `workers` processes.
 
-        consolidated.append(entry)
+    Args:
+        tsv_path: Path to the all_bib_items_annotated.tsv file
+        corrections_dir: Directory containing line_X.json correction files,
+            or a .sqlite result store
+        workers: Number of processes for the parallel run
 
-    return consolidated
+    Returns:
+        Records (or elements) per second of each variant
+    """
+    correction_index = build_correction_index(tsv_path)
+    results = {}
+
+    elements = []
+    for record in iter_ground_data(tsv_path):
+        try:
+            elements.append(ET.fromstring(list(record.values())[1]))
+        except ET.ParseError:
+            continue
+    for name, converter in (("recursive converter", _element_to_dict_lowercase_recursive),
+                            ("iterative converter", _element_to_dict_lowercase)):
+        start = time.perf_counter()
+        for element in elements:
+            converter(element)
+        results[name] = len(elements) / (time.perf_counter() - start)
+
+    variants = [
+        ("sequential", dict(workers=1)),
+        ("sequential, skip known faulty", dict(workers=1, skip_known_faulty=True)),
+        (f"{workers} workers, skip known faulty", dict(workers=workers, skip_known_faulty=True)),
+    ]
+    for name, options in variants:
+        start = time.perf_counter()
+        count = sum(1 for _ in iter_consolidated_records(tsv_path, corrections_dir, correction_index, **options))
+        results[name] = count / (time.perf_counter() - start)
+
+    for name, rate in results.items():
+        print(f"{name}: {rate:.0f} records/s")
+    return results
 
 
 def save_consolidated_json(consolidated_data: List[Dict[str, Any]], output_path: str):
@@ -242,6 +581,24 @@ def save_consolidated_json(consolidated_data: List[Dict[str, Any]], output_path:
         json.dump(consolidated_data, f, indent=2, ensure_ascii=False)
 
 
+CSV_FIELDNAMES = ["id", "original_xml", "is_faulty", "has_correction", "corrected_xml", "number_of_fixes", "fix_explanation"]
+
+
+def flatten_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Flatten a consolidated record to the CSV columns.
+    """
+    return {
+        "id": record["id"],
+        "original_xml": record["original_xml"],
+        "is_faulty": record["is_faulty"],
+        "has_correction": record.get("has_correction", False),
+        "corrected_xml": record["corrected_xml"] or "",
+        "number_of_fixes": record["number_of_fixes"],
+        "fix_explanation": record["fix_explanation"] or "",
+    }
+
+
 def save_consolidated_csv(consolidated_data: List[Dict[str, Any]], output_path: str):
     """
     Save consolidated dataset to CSV file (flattened).
@@ -253,37 +610,160 @@ def save_consolidated_csv(consolidated_data: List[Dict[str, Any]], output_path:
     if not consolidated_data:
         return
 
-    # Flatten the data for CSV
-    flattened = []
-    for record in consolidated_data:
-        flat_record = {
-            "id": record["id"],
-            "original_xml": record["original_xml"],
-            "is_faulty": record["is_faulty"],
-            "has_correction": record.get("has_correction", False),
-            "corrected_xml": record["corrected_xml"] or "",
-            "number_of_fixes": record["number_of_fixes"],
-            "fix_explanation": record["fix_explanation"] or "",
-        }
-        flattened.append(flat_record)
-
     with open(output_path, 'w', encoding='utf-8', newline='') as f:
-        fieldnames = ["id", "original_xml", "is_faulty", "has_correction", "corrected_xml", "number_of_fixes", "fix_explanation"]
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDNAMES)
         writer.writeheader()
-        writer.writerows(flattened)
+        for record in consolidated_data:
+            writer.writerow(flatten_record(record))
+
+
+def save_consolidated_streaming(
+    records: Iterable[Dict[str, Any]],
+    jsonl_path: str,
+    csv_path: str
+) -> Dict[str, int]:
+    """
+    Write consolidated records to JSON Lines and CSV while they are produced.
 
+    Args:
+        records: Iterable of consolidated records, e.g. iter_consolidated_records
+        jsonl_path: Path to output JSON Lines file (one record per line)
+        csv_path: Path to output CSV file
 
-def main():
+    Returns:
+        Counts of total, faulty and corrected records
+    """
+    stats = {"total": 0, "faulty": 0, "corrected": 0}
+    with open(jsonl_path, 'w', encoding='utf-8') as jsonl_file, \
+            open(csv_path, 'w', encoding='utf-8', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDNAMES)
+        writer.writeheader()
+        for record in records:
+            jsonl_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            writer.writerow(flatten_record(record))
+            stats["total"] += 1
+            stats["faulty"] += record["is_faulty"]
+            stats["corrected"] += record.get("has_correction", False)
+    return stats
+
+
+BIBL_FIELDS = ["author", "title", "year", "place", "format", "volume", "prize"]
+
+# Basel currency of the Avisblatt period: 1 Gulden = 15 Batzen = 60 Kreuzer
+PRIZE_UNITS_IN_KREUZER = {"fl": 60, "gulden": 60, "guld": 60, "bz": 4, "btz": 4, "batzen": 4,
+                          "kr": 1, "xr": 1, "kreuzer": 1, "creutzer": 1}
+# a half after a number, also after a '.' or space ('fl. 1. 1/2'), or on its own ('1/2 fl.')
+_PRIZE_TOKEN_RE = re.compile(r"(?<![\d/])(½|1/2)(?!\d)|(\d+)(?:[.\s]*(½|1/2|1/)(?!\d))?|([A-Za-z]+)")
+_YEAR_RE = re.compile(r"\b(1[4-8]\d\d)\b")
+
+
+def normalize_prize(prize: str) -> Optional[float]:
+    """
+    Convert a PRIZE text to Kreuzer, e.g. 'fl. 2. kr. 30.' -> 150.0 or 'fl. 1. 1/2' -> 90.0.
+
+    Each number is paired with the currency unit directly before or after it.
+
+    Args:
+        prize: Text of a PRIZE element
+
+    Returns:
+        Price in Kreuzer, or None if no amount with a known unit was found
+    """
+    tokens = []
+    for lone_half, number, half, word in _PRIZE_TOKEN_RE.findall(prize):
+        if lone_half:
+            tokens.append(("number", 0.5))
+        elif number:
+            tokens.append(("number", int(number) + (0.5 if half else 0)))
+        elif word.lower() in PRIZE_UNITS_IN_KREUZER:
+            tokens.append(("unit", PRIZE_UNITS_IN_KREUZER[word.lower()]))
+
+    total, found, i = 0.0, False, 0
+    while i < len(tokens) - 1:
+        (kind, value), (next_kind, next_value) = tokens[i], tokens[i + 1]
+        if kind != next_kind:
+            total += value * next_value
+            found = True
+            i += 2
+        else:
+            i += 1
+    return total if found else None
+
+
+def parse_year(year: str) -> Optional[int]:
+    """
+    Extract a four-digit year from a YEAR text, None if there is none.
+    """
+    match = _YEAR_RE.search(year)
+    return int(match.group(1)) if match else None
+
+
+def flatten_bibls(record: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Flatten the BIBL entries of a consolidated record.
+
+    Args:
+        record: Consolidated record with json_representation
+
+    Yields:
+        One dictionary per BIBL with ad id, bibl index and the BIBL_FIELDS;
+        repeated tags are joined with ' ; ', missing tags are empty strings
+    """
+    representation = record.get("json_representation") or {}
+    item = representation.get("item")
+    if not isinstance(item, dict):
+        return
+    bibls = item.get("bibl", [])
+    if not isinstance(bibls, list):
+        bibls = [bibls]
+
+    for index, bibl in enumerate(bibls):
+        row = {"ad_id": record["id"], "bibl_index": index}
+        for field in BIBL_FIELDS:
+            value = bibl.get(field, "") if isinstance(bibl, dict) else ""
+            if isinstance(value, list):
+                value = " ; ".join(v for v in value if isinstance(v, str))
+            row[field] = value if isinstance(value, str) else ""
+        yield row
+
+
+def iter_consolidated_file(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the records of consolidated_data.jsonl, or of a consolidated_data.json array.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def main(stream: bool = False, workers: int = 1, columns_dir: Optional[str] = None,
+         search_index_path: Optional[str] = None, skip_known_faulty: bool = False):
     """
     Main function to run the consolidation process.
+
+    Args:
+        stream: Write JSON Lines and CSV while consolidating instead of
+            building the whole dataset in memory first
+        workers: Number of processes for the XML-to-JSON conversion
+        columns_dir: If given, also export the flattened BIBL fields
+            as memory-mappable columns to this directory (needs NumPy)
+        search_index_path: If given, also build the BIBL search index
+            (see search_index.py) in this SQLite file
+        skip_known_faulty: Do not re-parse faulty records without a
+            correction, see consolidate_record
     """
     # Define paths
     tsv_path = "data/all_bib_items_annotated.tsv"
     faulty_lines_path = "data/incorrect_tags.txt"
     corrections_dir = "output/content"
+    corrections_store_path = "output/corrections.sqlite"
     output_json_path = "output/consolidated_data.json"
     output_csv_path = "output/consolidated_data.csv"
+    output_jsonl_path = "output/consolidated_data.jsonl"
 
     print("Starting data consolidation...")
 
@@ -293,13 +773,30 @@ def main():
 
     print(f"Found {faulty_lines_count} lines in {faulty_lines_path}")
 
-    # Create consolidated dataset
-    consolidated = create_consolidated_dataset(tsv_path, faulty_lines_path, corrections_dir)
+    # Prefer the single-file result store if the corrections were written to one
+    if Path(corrections_store_path).exists():
+        corrections_dir = corrections_store_path
+
+    with metrics.timer("consolidate") as stage:
+        if stream:
+            records = iter_consolidated_records(tsv_path, corrections_dir, workers=workers,
+                                                skip_known_faulty=skip_known_faulty)
+            stats = save_consolidated_streaming(records, output_jsonl_path, output_csv_path)
+            total_count, faulty_count, corrected_count = stats["total"], stats["faulty"], stats["corrected"]
+        else:
+            # Create consolidated dataset
+            consolidated = create_consolidated_dataset(tsv_path, faulty_lines_path, corrections_dir,
+                                                       workers=workers, skip_known_faulty=skip_known_faulty)
+            total_count = len(consolidated)
+            faulty_count = sum(1 for r in consolidated if r["is_faulty"])
+            corrected_count = sum(1 for r in consolidated if r.get("has_correction", False))
+        stage.items = total_count
+    metrics.count("records", total_count)
+    metrics.count("records_faulty", faulty_count)
+    metrics.count("records_corrected", corrected_count)
 
     print(f"\n=== Summary ===")
-    print(f"Total records processed: {len(consolidated)}")
-    faulty_count = sum(1 for r in consolidated if r["is_faulty"])
-    corrected_count = sum(1 for r in consolidated if r.get("has_correction", False))
+    print(f"Total records processed: {total_count}")
     print(f"Faulty records (quality_xml_well_formed=FALSE): {faulty_count}")
     print(f"Faulty records with valid LLM corrections: {corrected_count}")
     print(f"Faulty records without corrections: {faulty_count - corrected_count}")
@@ -309,14 +806,90 @@ def main():
         print(f"Note: {missing} correction files were missing or had invalid JSON")
 
     # Save outputs
-    save_consolidated_json(consolidated, output_json_path)
-    print(f"Saved JSON output to: {output_json_path}")
+    if stream:
+        print(f"Saved JSON Lines output to: {output_jsonl_path}")
+    else:
+        with metrics.timer("save") as stage:
+            stage.items = total_count
+            save_consolidated_json(consolidated, output_json_path)
+            print(f"Saved JSON output to: {output_json_path}")
 
-    save_consolidated_csv(consolidated, output_csv_path)
+            save_consolidated_csv(consolidated, output_csv_path)
     print(f"Saved CSV output to: {output_csv_path}")
 
+    if columns_dir:
+        from bibl_columns import write_bibl_columns
+        consolidated_path = output_jsonl_path if stream else output_json_path
+        with metrics.timer("bibl_columns") as stage:
+            rows = stage.items = write_bibl_columns(iter_consolidated_file(consolidated_path), columns_dir)
+        print(f"Saved {rows} BIBL rows as columns to: {columns_dir}")
+
+    if search_index_path:
+        from search_index import build_index
+        consolidated_path = output_jsonl_path if stream else output_json_path
+        with metrics.timer("search_index") as stage:
+            count = stage.items = build_index(iter_consolidated_file(consolidated_path), search_index_path)
+        print(f"Indexed {count} BIBL entries in: {search_index_path}")
+
     print("Consolidation complete!")
 
 
+def rebuild(record_ids: List[str], output_path: str):
+    """
+    Rebuild the consolidated records with the given ids and save them as JSON.
+
+    Args:
+        record_ids: Ids of the records to rebuild
+        output_path: Path to output JSON file
+    """
+    tsv_path = "data/all_bib_items_annotated.tsv"
+    corrections_dir = "output/content"
+    corrections_store_path = "output/corrections.sqlite"
+
+    if Path(corrections_store_path).exists():
+        corrections_dir = corrections_store_path
+
+    with metrics.timer("rebuild") as stage:
+        records = rebuild_records(tsv_path, record_ids, corrections_dir)
+        stage.items = len(records)
+    save_consolidated_json(records, output_path)
+    print(f"Rebuilt {len(records)} of {len(record_ids)} records, saved to: {output_path}")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Consolidate the annotated data with the LLM corrections.")
+    parser.add_argument("--stream", action="store_true",
+                        help="write JSON Lines and CSV incrementally with constant memory")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes for the XML-to-JSON conversion (0 = all cores)")
+    parser.add_argument("--skip-known-faulty", action="store_true",
+                        help="do not re-parse faulty records without a correction; their json_representation "
+                             "holds the error message of the evaluation instead")
+    parser.add_argument("--columns", metavar="DIR",
+                        help="also export the flattened BIBL fields as NumPy columns to DIR")
+    parser.add_argument("--search-index", metavar="PATH",
+                        help="also build the BIBL search index in the SQLite file PATH")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="print records per second of the consolidation variants instead")
+    parser.add_argument("--ids", nargs="+", metavar="ID", default=[],
+                        help="only rebuild the records with these ids, without a full scan")
+    parser.add_argument("--ids-file", metavar="PATH",
+                        help="only rebuild the records with the ids in this file, one per line")
+    parser.add_argument("--rebuild-output", metavar="PATH", default="output/rebuilt_records.json",
+                        help="JSON file for the records rebuilt with --ids or --ids-file")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    workers = args.workers or multiprocessing.cpu_count()
+    record_ids = list(args.ids)
+    if args.ids_file:
+        with open(args.ids_file, 'r', encoding='utf-8') as f:
+            record_ids += [line.strip() for line in f if line.strip()]
+    if args.benchmark:
+        benchmark_consolidation("data/all_bib_items_annotated.tsv", "output/content", max(workers, 2))
+    elif record_ids:
+        with metrics.session(args, "format_output"):
+            rebuild(record_ids, args.rebuild_output)
+    else:
+        with metrics.session(args, "format_output"):
+            main(stream=args.stream, workers=workers, columns_dir=args.columns,
+                 search_index_path=args.search_index, skip_known_faulty=args.skip_known_faulty)
\ No newline at end of file
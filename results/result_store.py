@@ -0,0 +1,159 @@
+"""
+Storage backends for the LLM corrections, keyed by line number in incorrect_tags.txt.
+
+FileResultStore is the original layout with two JSON files per line
+(output/raw/line_N.json and output/content/line_N.json).
+SqliteResultStore keeps all results in a single SQLite file, which needs
+far fewer files and syscalls and gives indexed lookups by line number.
+
+Both stores can be converted into each other:
+    python result_store.py output/corrections.sqlite output_files
+    python result_store.py output output/corrections.sqlite
+"""
+
+import json
+import os
+import re
+import sqlite3
+import sys
+from typing import Any, Dict, Iterator, Optional, Set, Tuple
+
+_FILENAME_RE = re.compile(r"line_(\d+)\.json$")
+
+
+class FileResultStore:
+    """
+    One raw and one content JSON file per line, in the raw/ and content/
+    subdirectories of output_dir.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        os.makedirs(os.path.join(output_dir, "raw"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "content"), exist_ok=True)
+
+    def _path(self, kind: str, line: int) -> str:
+        return os.path.join(self.output_dir, kind, f"line_{line}.json")
+
+    def _lines_in(self, kind: str) -> Set[int]:
+        lines = set()
+        for filename in os.listdir(os.path.join(self.output_dir, kind)):
+            match = _FILENAME_RE.match(filename)
+            if match:
+                lines.add(int(match.group(1)))
+        return lines
+
+    def processed_lines(self) -> Set[int]:
+        """ line numbers that have both a raw and a content file. """
+        return self._lines_in("raw") & self._lines_in("content")
+
+    def put(self, line: int, raw: Dict[str, Any], content: Dict[str, Any]):
+        with(open(self._path("raw", line), "w", encoding="utf-8")) as f_out:
+            json.dump(raw, f_out,
+                      indent=4, ensure_ascii=False)
+
+        with(open(self._path("content", line), "w", encoding="utf-8")) as f_out:
+            json.dump(content, f_out,
+                      indent=4, ensure_ascii=False)
+
+    def _load(self, kind: str, line: int) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(kind, line), 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+                return json.loads(content) if content else None
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get_content(self, line: int) -> Optional[Dict[str, Any]]:
+        return self._load("content", line)
+
+    def get_raw(self, line: int) -> Optional[Dict[str, Any]]:
+        return self._load("raw", line)
+
+    def items(self) -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any]]]:
+        """ yields (line, raw, content) for all processed lines in line order. """
+        for line in sorted(self.processed_lines()):
+            raw, content = self.get_raw(line), self.get_content(line)
+            if raw is not None and content is not None:
+                yield line, raw, content
+
+    def close(self):
+        pass
+
+
+class SqliteResultStore:
+    """ all results in one SQLite table, with the line number as primary key. """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "line INTEGER PRIMARY KEY, raw TEXT NOT NULL, content TEXT NOT NULL)"
+        )
+        self.connection.commit()
+
+    def processed_lines(self) -> Set[int]:
+        return {row[0] for row in self.connection.execute("SELECT line FROM results")}
+
+    def put(self, line: int, raw: Dict[str, Any], content: Dict[str, Any]):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results (line, raw, content) VALUES (?, ?, ?)",
+            (line, json.dumps(raw, ensure_ascii=False), json.dumps(content, ensure_ascii=False))
+        )
+        self.connection.commit()
+
+    def _load(self, column: str, line: int) -> Optional[Dict[str, Any]]:
+        row = self.connection.execute(
+            f"SELECT {column} FROM results WHERE line = ?", (line,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_content(self, line: int) -> Optional[Dict[str, Any]]:
+        return self._load("content", line)
+
+    def get_raw(self, line: int) -> Optional[Dict[str, Any]]:
+        return self._load("raw", line)
+
+    def items(self) -> Iterator[Tuple[int, Dict[str, Any], Dict[str, Any]]]:
+        for line, raw, content in self.connection.execute(
+                "SELECT line, raw, content FROM results ORDER BY line"):
+            yield line, json.loads(raw), json.loads(content)
+
+    def close(self):
+        self.connection.close()
+
+
+def open_store(path: str):
+    """ opens a SqliteResultStore for .sqlite/.db paths, a FileResultStore for directories. """
+    if path.endswith((".sqlite", ".db")):
+        return SqliteResultStore(path)
+    return FileResultStore(path)
+
+
+def copy_results(source_path: str, target_path: str) -> int:
+    """
+    Copies all results from one store into another, e.g. to export a SQLite
+    store back to the per-file layout. Returns the number of copied lines.
+    """
+    source, target = open_store(source_path), open_store(target_path)
+    copied = 0
+    for line, raw, content in source.items():
+        target.put(line, raw, content)
+        copied += 1
+    source.close()
+    target.close()
+    return copied
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python result_store.py SOURCE TARGET")
+        sys.exit(1)
+    count = copy_results(sys.argv[1], sys.argv[2])
+    print(f"Copied {count} results from {sys.argv[1]} to {sys.argv[2]}")
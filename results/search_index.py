@@ -0,0 +1,215 @@
+"""
+Inverted search index over the BIBL entries of the consolidated data.
+
+The index is a SQLite file with one row per BIBL (ad id, bibl index, the BIBL
+fields, the parsed year and the price in Kreuzer) and a postings table from
+(field, folded token) to BIBL, so queries only touch the matching entries.
+AUTHOR, TITLE and PLACE are tokenized with case and old-orthography folding,
+so 'Eydgnoßschafft' matches 'Eidgnossschafft' and 'Zürich' matches 'Zuerich';
+YEAR and PRIZE (normalized to Kreuzer) have range indexes.
+
+Usage:
+    python search_index.py build output/consolidated_data.jsonl output/search_index.sqlite
+    python search_index.py query output/search_index.sqlite --author moreri
+    python search_index.py query output/search_index.sqlite --place zürich --year 1740-1760 --prize 0-60
+"""
+
+import argparse
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from format_output import BIBL_FIELDS, flatten_bibls, iter_consolidated_file, normalize_prize, parse_year
+
+SEARCH_FIELDS = ["author", "title", "place"]
+
+# applied in order, after lowercasing and removing diacritics
+_FOLDINGS = [("ae", "a"), ("oe", "o"), ("ue", "u"), ("th", "t"), ("y", "i")]
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def fold(text: str) -> str:
+    """
+    Fold case and old orthography, e.g. 'Eydgnoßschafft' -> 'eidgnossschafft'.
+    """
+    text = text.lower().replace("ß", "ss")
+    text = "".join(char for char in unicodedata.normalize("NFKD", text)
+                   if not unicodedata.combining(char))
+    for old, new in _FOLDINGS:
+        text = text.replace(old, new)
+    return text
+
+
+def tokenize(text: str) -> List[str]:
+    """ folded tokens of a text, without single characters and numbers. """
+    return [token for token in _TOKEN_RE.findall(fold(text))
+            if len(token) > 1 and not token.isdigit()]
+
+
+def build_index(records: Iterable[Dict[str, Any]], index_path: str) -> int:
+    """
+    Build the search index from consolidated records.
+
+    Args:
+        records: Consolidated records, e.g. format_output.iter_consolidated_file
+        index_path: Path of the SQLite index file, replaced if it exists
+
+    Returns:
+        Number of indexed BIBL entries
+    """
+    connection = sqlite3.connect(index_path)
+    connection.executescript(f"""
+        DROP TABLE IF EXISTS bibls;
+        DROP TABLE IF EXISTS postings;
+        CREATE TABLE bibls (
+            id INTEGER PRIMARY KEY, ad_id TEXT, bibl_index INTEGER,
+            {", ".join(f"{field} TEXT" for field in BIBL_FIELDS)},
+            year_value INTEGER, prize_kreuzer REAL
+        );
+        CREATE TABLE postings (
+            field TEXT, token TEXT, bibl INTEGER,
+            PRIMARY KEY (field, token, bibl)
+        ) WITHOUT ROWID;
+    """)
+
+    count = 0
+    for record in records:
+        for row in flatten_bibls(record):
+            count += 1
+            connection.execute(
+                f"INSERT INTO bibls VALUES (?, ?, ?, {', '.join('?' for _ in BIBL_FIELDS)}, ?, ?)",
+                [count, row["ad_id"], row["bibl_index"]] + [row[field] for field in BIBL_FIELDS]
+                + [parse_year(row["year"]), normalize_prize(row["prize"])]
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO postings VALUES (?, ?, ?)",
+                [(field, token, count) for field in SEARCH_FIELDS for token in tokenize(row[field])]
+            )
+
+    connection.executescript("""
+        CREATE INDEX bibls_year ON bibls (year_value);
+        CREATE INDEX bibls_prize ON bibls (prize_kreuzer);
+        CREATE INDEX bibls_ad ON bibls (ad_id);
+    """)
+    connection.commit()
+    connection.close()
+    return count
+
+
+def search(
+    index_path: str,
+    author: Optional[str] = None,
+    title: Optional[str] = None,
+    place: Optional[str] = None,
+    year_range: Optional[Tuple[Optional[int], Optional[int]]] = None,
+    prize_range: Optional[Tuple[Optional[float], Optional[float]]] = None,
+    limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Find BIBL entries matching all given conditions.
+
+    Args:
+        index_path: Path of the SQLite index built by build_index
+        author, title, place: Text whose folded tokens must all occur in the field
+        year_range: Inclusive (min, max) year, either bound may be None
+        prize_range: Inclusive (min, max) price in Kreuzer, either bound may be None
+        limit: Maximum number of results
+
+    Returns:
+        Matching entries with ad_id, bibl_index and the BIBL fields, in index order
+
+    Raises:
+        ValueError: If a given text has no searchable tokens, e.g. 'J.' or '1783',
+            since the condition could not be checked and would be dropped
+    """
+    token_queries, parameters = [], []
+    for field, text in (("author", author), ("title", title), ("place", place)):
+        if text is None:
+            continue
+        tokens = tokenize(text)
+        if not tokens:
+            raise ValueError(f"--{field} '{text}' has no searchable words "
+                             "(single characters and numbers are not indexed)")
+        for token in tokens:
+            token_queries.append("SELECT bibl FROM postings WHERE field = ? AND token = ?")
+            parameters += [field, token]
+
+    conditions = []
+    if token_queries:
+        conditions.append(f"id IN ({' INTERSECT '.join(token_queries)})")
+    for column, value_range in (("year_value", year_range), ("prize_kreuzer", prize_range)):
+        if value_range is None:
+            continue
+        low, high = value_range
+        if low is not None:
+            conditions.append(f"{column} >= ?")
+            parameters.append(low)
+        if high is not None:
+            conditions.append(f"{column} <= ?")
+            parameters.append(high)
+
+    query = f"SELECT ad_id, bibl_index, {', '.join(BIBL_FIELDS)} FROM bibls"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY id"
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+
+    connection = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        columns = ["ad_id", "bibl_index"] + BIBL_FIELDS
+        return [dict(zip(columns, row)) for row in connection.execute(query, parameters)]
+    finally:
+        connection.close()
+
+
+def _parse_range(text: Optional[str], convert) -> Optional[Tuple[Any, Any]]:
+    """ parses 'min-max', 'min-' or '-max'. """
+    if not text:
+        return None
+    low, _, high = text.partition("-")
+    return (convert(low) if low else None, convert(high) if high else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the BIBL search index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="build the index from consolidated data")
+    build_parser.add_argument("consolidated", help="consolidated_data.json or .jsonl")
+    build_parser.add_argument("index")
+
+    query_parser = subparsers.add_parser("query", help="query the index")
+    query_parser.add_argument("index")
+    query_parser.add_argument("--author")
+    query_parser.add_argument("--title")
+    query_parser.add_argument("--place")
+    query_parser.add_argument("--year", help="year range, e.g. 1740-1760")
+    query_parser.add_argument("--prize", help="price range in Kreuzer, e.g. 0-60")
+    query_parser.add_argument("--limit", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        count = build_index(iter_consolidated_file(args.consolidated), args.index)
+        print(f"Indexed {count} BIBL entries in {args.index}")
+        return
+
+    start = time.perf_counter()
+    try:
+        results = search(args.index, args.author, args.title, args.place,
+                         _parse_range(args.year, int), _parse_range(args.prize, float), args.limit)
+    except ValueError as e:
+        sys.exit(f"ERROR: {e}")
+    elapsed = time.perf_counter() - start
+    for result in results:
+        fields = ", ".join(f"{field}: {result[field]}" for field in BIBL_FIELDS if result[field])
+        print(f"{result['ad_id']} [{result['bibl_index']}] {fields}")
+    print(f"{len(results)} entries in {len(set(r['ad_id'] for r in results))} ads ({elapsed * 1000:.2f} ms)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,552 @@
+"""
+Runs the evaluation, correction and consolidation on shards of the annotated
+TSV, e.g. on several machines, and merges the results.
+
+The records are assigned to N shards by a hash of their id, so the
+assignment does not depend on the order of the rows, the machine or the
+Python version, and records with the same id end up on the same shard:
+
+    split   input TSV -> WORKDIR/shard_K/data/input.tsv, WORKDIR/ids.txt (the input order)
+    node    on each machine, for its shard directory:
+            evaluate_tsv.py     data/input.tsv -> data/all_bib_items_annotated.tsv
+                                (the evaluated ground data, where format_output.py reads it)
+            the faulty rows     -> data/incorrect_tags.txt
+            correction script   -> output/content, output/raw (or output/corrections.sqlite)
+            format_output.py    -> output/consolidated_data.json/.csv (.jsonl/.csv with --stream)
+            with the metrics of every step in metrics/<step>.json
+    merge   the shard directories -> WORKDIR/merged, in the same layout
+    verify  compares the merged result with the result of a single-node run
+
+`evaluate` runs the first two steps of a node on any TSV; pipeline.py uses it
+as its evaluate stage.
+
+A shard keeps the input order of its records, so the merge walks the ids of
+the input and takes the next row from the shard of each id; a record missing
+from its shard, e.g. in a truncated file, is an error. Rows without an
+annotation column, which evaluate_tsv.py skips, are left out by the split.
+The correction of the Nth faulty record of a shard is stored as line N of the
+shard; the merge renumbers it to the line of the record in the merged
+incorrect_tags.txt.
+The merged metrics sum the counters and stage times of the shards (see
+metrics.merge_reports). Merged and single-node results are the same except
+for timings and the raw responses (timestamps), so verify compares the data
+files byte by byte, the corrections by content and the data counters of the
+metrics; failed_lines.json depends on the errors of the individual requests
+and is merged, but not compared. For the same reason, `local` runs the stub
+client without simulated errors (--stub-error-rate 0) unless a rate is given,
+since a line that fails all retries in one run only would be a difference.
+
+Test locally with N shards as separate processes and a single-node run:
+    python shard.py local results/data/all_bib_items_annotated.tsv /tmp/shards --shards 4 \\
+        --correction-args="--stub --stub-latency 0.01 --concurrency 8 --no-cache"
+
+On several machines (with a shared or copied WORKDIR):
+    python shard.py split input.tsv WORKDIR --shards 8
+    python shard.py node WORKDIR --shard 3          # on each machine, K = 0..7
+    python shard.py merge WORKDIR
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import metrics
+from evaluate_tsv import ANNOTATION_COL_INDEX
+
+# format_output and result_store live in results/
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, "results"))
+from format_output import is_faulty_record, save_consolidated_json  # noqa: E402
+from result_store import open_store  # noqa: E402
+
+EVALUATE_SCRIPT = os.path.join(ROOT, "evaluate_tsv.py")
+CORRECTION_SCRIPT = os.path.join(ROOT, "results", "correction_of_results", "correction_of_malformed_xml_with_LLM.py")
+CONSOLIDATION_SCRIPT = os.path.join(ROOT, "results", "format_output.py")
+
+# paths in a shard directory, the layout of results/
+INPUT_TSV = os.path.join("data", "input.tsv")
+EVALUATED_TSV = os.path.join("data", "all_bib_items_annotated.tsv")
+FAULTY_LINES = os.path.join("data", "incorrect_tags.txt")
+CORRECTIONS_STORE = os.path.join("output", "corrections.sqlite")
+FAILURES = os.path.join("output", "failed_lines.json")
+CONSOLIDATED = [os.path.join("output", f"consolidated_data.{extension}") for extension in ("json", "jsonl", "csv")]
+METRICS_DIR = "metrics"
+# counters that depend on the data only, so the merge must reproduce them
+DATA_COUNTERS = ["rows_analyzed", "rows_not_well_formed", "rows_overlapping_tags",
+                 "records", "records_faulty", "records_corrected"]
+
+
+def shard_of(record_id: str, shards: int) -> int:
+    """ the shard of a record id, stable across machines and runs unlike hash(). """
+    digest = hashlib.blake2b(record_id.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shards
+
+
+def shard_dir(workdir: str, shard: int) -> str:
+    return os.path.join(workdir, f"shard_{shard:02d}")
+
+
+def load_manifest(workdir: str) -> Dict[str, Any]:
+    with open(os.path.join(workdir, "manifest.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_ids(workdir: str) -> Iterator[str]:
+    """ the record ids of the input in input order. """
+    with open(os.path.join(workdir, "ids.txt"), "r", encoding="utf-8") as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+def split_tsv(input_path: str, workdir: str, shards: int) -> List[int]:
+    """
+    Splits the annotated TSV into shards by record id; rows without an
+    annotation column are left out, as in evaluate_tsv.py.
+
+    Args:
+        input_path: Annotated TSV with the record id in the first column
+        workdir: Directory for the shard directories, ids.txt and manifest.json
+        shards: Number of shards
+
+    Returns:
+        Number of rows of every shard
+    """
+    counts = [0] * shards
+    files = []
+    try:
+        for shard in range(shards):
+            os.makedirs(os.path.join(shard_dir(workdir, shard), "data"), exist_ok=True)
+            files.append(open(os.path.join(shard_dir(workdir, shard), INPUT_TSV), "w", encoding="utf-8", newline=""))
+        writers = [csv.writer(f, delimiter="\t") for f in files]
+        with open(input_path, "r", encoding="utf-8", newline="") as infile, \
+                open(os.path.join(workdir, "ids.txt"), "w", encoding="utf-8") as ids_file:
+            reader = csv.reader(infile, delimiter="\t")
+            header = next(reader, [])
+            for writer in writers:
+                writer.writerow(header)
+            for row in reader:
+                if len(row) <= ANNOTATION_COL_INDEX:
+                    continue
+                shard = shard_of(row[0], shards)
+                writers[shard].writerow(row)
+                ids_file.write(row[0] + "\n")
+                counts[shard] += 1
+    finally:
+        for f in files:
+            f.close()
+
+    with open(os.path.join(workdir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump({"input": os.path.abspath(input_path), "shards": shards, "rows": counts,
+                   "created": datetime.now().isoformat(timespec="seconds")}, f, indent=2)
+    return counts
+
+
+def write_faulty_lines(evaluated_tsv_path: str, faulty_lines_path: str) -> int:
+    """ writes the XML of the faulty records, one per line, like incorrect_tags.txt; returns their number. """
+    count = 0
+    with open(evaluated_tsv_path, "r", encoding="utf-8", newline="") as infile, \
+            open(faulty_lines_path, "w", encoding="utf-8") as outfile:
+        for record in csv.DictReader(infile, delimiter="\t"):
+            if is_faulty_record(record):
+                outfile.write(list(record.values())[ANNOTATION_COL_INDEX] + "\n")
+                count += 1
+    return count
+
+
+def _run(command: List[str], cwd: str, log) -> bool:
+    log.write(f"$ {shlex.join(command)}\n")
+    log.flush()
+    process = subprocess.run([sys.executable] + command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    return process.returncode == 0
+
+
+def evaluate(input_path: str, evaluated_tsv_path: str, faulty_lines_path: str, workers: int = 1,
+             metrics_path: Optional[str] = None, cwd: str = ".", log=sys.stdout) -> Optional[int]:
+    """
+    Evaluates the annotated TSV with evaluate_tsv.py and writes its faulty records
+    to faulty_lines_path (see write_faulty_lines); paths are relative to cwd.
+
+    Returns:
+        Number of faulty records, None if the evaluation failed
+    """
+    command = [EVALUATE_SCRIPT, input_path, evaluated_tsv_path, "--stream", "--workers", str(workers)]
+    if metrics_path:
+        command += ["--metrics", metrics_path]
+    # evaluate_tsv.py reports errors without an exit code, so its output is checked as well
+    if not (_run(command, cwd, log) and os.path.exists(os.path.join(cwd, evaluated_tsv_path))):
+        return None
+    faulty = write_faulty_lines(os.path.join(cwd, evaluated_tsv_path), os.path.join(cwd, faulty_lines_path))
+    log.write(f"{faulty} faulty records written to {faulty_lines_path}\n")
+    return faulty
+
+
+def run_node(directory: str, correction_args: Sequence[str] = ("--concurrency", "8"), workers: int = 1,
+             stream: bool = False) -> bool:
+    """
+    Runs the evaluation, correction and consolidation on one shard directory.
+
+    Args:
+        directory: Shard directory written by split_tsv
+        correction_args: Further arguments of the correction script, e.g. the concurrency
+        workers: Worker processes of the evaluation and consolidation
+        stream: Consolidate to JSON Lines and CSV instead of JSON and CSV
+
+    Returns:
+        True if every step succeeded; the output of the steps is in node.log
+    """
+    metrics_dir = os.path.join(directory, METRICS_DIR)
+    os.makedirs(metrics_dir, exist_ok=True)
+    os.makedirs(os.path.join(directory, "output"), exist_ok=True)
+    with open(os.path.join(directory, "node.log"), "w", encoding="utf-8") as log:
+        if evaluate(INPUT_TSV, EVALUATED_TSV, FAULTY_LINES, workers, os.path.join(METRICS_DIR, "evaluate.json"),
+                    directory, log) is None:
+            return False
+        if not _run([CORRECTION_SCRIPT, "--output-dir", "output", "--metrics", os.path.join(METRICS_DIR, "correct.json")]
+                    + list(correction_args), directory, log):
+            return False
+        return _run([CONSOLIDATION_SCRIPT, "--workers", str(workers),
+                     "--metrics", os.path.join(METRICS_DIR, "consolidate.json")] + (["--stream"] if stream else []),
+                    directory, log)
+
+
+def merge_in_order(record_ids: Iterable[str], shards: int, streams: Sequence[Iterable[Any]],
+                   key: Callable[[Any], str]) -> Iterator[Tuple[int, Any]]:
+    """
+    Merges the items of the shards into input order, as (shard, item).
+
+    Every stream holds the items of one shard in input order, identified by
+    key(item). Raises ValueError if the item of an id is missing from its
+    shard, e.g. in a truncated file, or if a stream has items left, i.e.
+    items that are not in the input or out of order.
+    """
+    iterators = [iter(stream) for stream in streams]
+    pending = [next(iterator, None) for iterator in iterators]
+    for record_id in record_ids:
+        shard = shard_of(record_id, shards)
+        if pending[shard] is None or key(pending[shard]) != record_id:
+            raise ValueError(f"shard {shard}: record {record_id} is missing")
+        yield shard, pending[shard]
+        pending[shard] = next(iterators[shard], None)
+    for shard, item in enumerate(pending):
+        if item is not None:
+            raise ValueError(f"shard {shard}: record {key(item)} is not in the input order")
+
+
+def _tsv_rows(path: str) -> Iterator[List[str]]:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        yield from csv.reader(f, delimiter="\t")
+
+
+def _shard_store_path(directory: str) -> str:
+    """ the result store the correction script wrote in a shard directory. """
+    store_path = os.path.join(directory, CORRECTIONS_STORE)
+    return store_path if os.path.exists(store_path) else os.path.join(directory, "output")
+
+
+def merge_tsv(workdir: str, shards: int, output_path: str) -> List[List[int]]:
+    """
+    Merges the evaluated TSV files of the shards.
+
+    Returns, for every shard, the line in the merged incorrect_tags.txt of the
+    shard's faulty records, so that line_numbers[shard][n - 1] is the merged
+    line of line n of the shard.
+    """
+    streams = [_tsv_rows(os.path.join(shard_dir(workdir, shard), EVALUATED_TSV)) for shard in range(shards)]
+    headers = [next(stream, []) for stream in streams]
+    if any(header != headers[0] for header in headers):
+        raise ValueError("the evaluated TSV files of the shards have different columns")
+
+    line_numbers = [[] for _ in range(shards)]
+    faulty = 0
+    with open(output_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(headers[0])
+        for shard, row in merge_in_order(read_ids(workdir), shards, streams, key=lambda row: row[0]):
+            writer.writerow(row)
+            if is_faulty_record(dict(zip(headers[0], row))):
+                faulty += 1
+                line_numbers[shard].append(faulty)
+    return line_numbers
+
+
+def merge_corrections(workdir: str, shards: int, line_numbers: List[List[int]], output_dir: str) -> int:
+    """ copies the corrections and failures of the shards to their merged line numbers; returns the count. """
+    sqlite = any(os.path.exists(os.path.join(shard_dir(workdir, shard), CORRECTIONS_STORE))
+                 for shard in range(shards))
+    target = open_store(os.path.join(output_dir, CORRECTIONS_STORE) if sqlite else os.path.join(output_dir, "output"))
+    copied = 0
+    failures = {}
+    for shard in range(shards):
+        directory = shard_dir(workdir, shard)
+        source = open_store(_shard_store_path(directory))
+        for line, raw, content in source.items():
+            target.put(line_numbers[shard][line - 1], raw, content)
+            copied += 1
+        source.close()
+        failures_path = os.path.join(directory, FAILURES)
+        if os.path.exists(failures_path):
+            with open(failures_path, "r", encoding="utf-8") as f:
+                for line, error in json.load(f).items():
+                    failures[line_numbers[shard][int(line) - 1]] = error
+    target.close()
+    with open(os.path.join(output_dir, FAILURES), "w", encoding="utf-8") as f:
+        json.dump(dict(sorted(failures.items())), f, indent=4, ensure_ascii=False)
+    return copied
+
+
+def _json_records(path: str) -> Iterator[Dict[str, Any]]:
+    with open(path, "r", encoding="utf-8") as f:
+        yield from json.load(f)
+
+
+def _jsonl_lines(path: str) -> Iterator[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        yield from f
+
+
+def _csv_rows(path: str) -> Iterator[List[str]]:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        yield from csv.reader(f)
+
+
+def merge_consolidated(workdir: str, shards: int, output_dir: str) -> List[str]:
+    """ merges the consolidated JSON, JSON Lines and CSV files the shards have; returns the merged paths. """
+    merged = []
+    for path in CONSOLIDATED:
+        shard_paths = [os.path.join(shard_dir(workdir, shard), path) for shard in range(shards)]
+        # format_output.py writes no CSV file for a shard without records;
+        # the merge fails if such a shard should have had records
+        existing = [shard_path for shard_path in shard_paths if os.path.exists(shard_path)]
+        if not existing:
+            continue
+        output_path = os.path.join(output_dir, path)
+        if path.endswith(".json"):
+            records = merge_in_order(read_ids(workdir), shards, [_json_records(p) if p in existing else []
+                                                                 for p in shard_paths],
+                                     key=lambda record: record["id"])
+            save_consolidated_json([record for _, record in records], output_path)
+        elif path.endswith(".jsonl"):
+            lines = merge_in_order(read_ids(workdir), shards, [_jsonl_lines(p) if p in existing else []
+                                                               for p in shard_paths],
+                                   key=lambda line: json.loads(line)["id"])
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.writelines(line for _, line in lines)
+        else:
+            streams = [_csv_rows(p) if p in existing else iter([]) for p in shard_paths]
+            header = [row for row in (next(stream, None) for stream in streams) if row][0]
+            rows = list(merge_in_order(read_ids(workdir), shards, streams, key=lambda row: row[0]))
+            if rows:
+                with open(output_path, "w", encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(header)
+                    writer.writerows(row for _, row in rows)
+        merged.append(output_path)
+    return merged
+
+
+def merge_metrics(workdir: str, shards: int, output_dir: str) -> List[str]:
+    """ merges the metrics file of every step over the shards; returns the merged paths. """
+    os.makedirs(os.path.join(output_dir, METRICS_DIR), exist_ok=True)
+    merged = []
+    names = sorted({name for shard in range(shards)
+                    for name in os.listdir(os.path.join(shard_dir(workdir, shard), METRICS_DIR))
+                    if name.endswith(".json")})
+    for name in names:
+        reports = []
+        for shard in range(shards):
+            path = os.path.join(shard_dir(workdir, shard), METRICS_DIR, name)
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    reports.append(json.load(f))
+        output_path = os.path.join(output_dir, METRICS_DIR, name)
+        with open(output_path, "w", encoding="utf-8") as f:
+            json.dump(metrics.merge_reports(reports, script=reports[0].get("script"), shards=len(reports),
+                                            finished=datetime.now().isoformat()),
+                      f, indent=2, ensure_ascii=False, default=str)
+        merged.append(output_path)
+    return merged
+
+
+def merge_shards(workdir: str, output_dir: Optional[str] = None) -> str:
+    """
+    Merges the results of all shards into output_dir (default WORKDIR/merged),
+    in the layout of a shard directory. Returns output_dir.
+    """
+    shards = load_manifest(workdir)["shards"]
+    output_dir = output_dir or os.path.join(workdir, "merged")
+    os.makedirs(os.path.join(output_dir, "data"), exist_ok=True)
+    os.makedirs(os.path.join(output_dir, "output"), exist_ok=True)
+
+    line_numbers = merge_tsv(workdir, shards, os.path.join(output_dir, EVALUATED_TSV))
+    faulty = write_faulty_lines(os.path.join(output_dir, EVALUATED_TSV), os.path.join(output_dir, FAULTY_LINES))
+    print(f"Merged the evaluated TSV files of {shards} shards, {faulty} faulty records")
+    copied = merge_corrections(workdir, shards, line_numbers, output_dir)
+    print(f"Merged {copied} corrections")
+    for path in merge_consolidated(workdir, shards, output_dir) + merge_metrics(workdir, shards, output_dir):
+        print(f"Merged {path}")
+    return output_dir
+
+
+def _same_file(first: str, second: str) -> bool:
+    with open(first, "rb") as f1, open(second, "rb") as f2:
+        while True:
+            block1, block2 = f1.read(1 << 20), f2.read(1 << 20)
+            if block1 != block2:
+                return False
+            if not block1:
+                return True
+
+
+def verify(merged_dir: str, reference_dir: str) -> List[str]:
+    """
+    Compares a merged result with the result of a single-node run.
+
+    Returns:
+        Descriptions of the differences, empty if the results are the same
+    """
+    differences = []
+    for path in [EVALUATED_TSV, FAULTY_LINES] + CONSOLIDATED:
+        merged_path, reference_path = os.path.join(merged_dir, path), os.path.join(reference_dir, path)
+        if os.path.exists(merged_path) != os.path.exists(reference_path):
+            differences.append(f"{path}: only in {merged_dir if os.path.exists(merged_path) else reference_dir}")
+        elif os.path.exists(merged_path) and not _same_file(merged_path, reference_path):
+            differences.append(f"{path}: contents differ")
+
+    merged_store, reference_store = open_store(_shard_store_path(merged_dir)), open_store(_shard_store_path(reference_dir))
+    merged_corrections = {line: content for line, _, content in merged_store.items()}
+    reference_corrections = {line: content for line, _, content in reference_store.items()}
+    merged_store.close()
+    reference_store.close()
+    if merged_corrections.keys() != reference_corrections.keys():
+        differences.append(f"corrections: {len(merged_corrections)} lines, expected {len(reference_corrections)}")
+    differences += [f"correction of line {line} differs" for line in sorted(merged_corrections)
+                    if line in reference_corrections and merged_corrections[line] != reference_corrections[line]]
+
+    for name in sorted(os.listdir(os.path.join(reference_dir, METRICS_DIR))):
+        merged_path = os.path.join(merged_dir, METRICS_DIR, name)
+        if not os.path.exists(merged_path):
+            differences.append(f"metrics/{name}: missing")
+            continue
+        with open(merged_path, "r", encoding="utf-8") as f1, \
+                open(os.path.join(reference_dir, METRICS_DIR, name), "r", encoding="utf-8") as f2:
+            merged_counters, reference_counters = json.load(f1)["counters"], json.load(f2)["counters"]
+        differences += [f"metrics/{name}: {counter} is {merged_counters.get(counter)}, "
+                        f"expected {reference_counters.get(counter)}"
+                        for counter in DATA_COUNTERS
+                        if merged_counters.get(counter) != reference_counters.get(counter)]
+    return differences
+
+
+def run_local(input_path: str, workdir: str, shards: int, correction_args: Sequence[str], workers: int = 1,
+              stream: bool = False) -> List[str]:
+    """
+    Runs every shard as a separate process, merges the shards and compares the
+    result with a single-node run on the whole input in WORKDIR/single.
+    The stub client runs without simulated errors unless correction_args set
+    --stub-error-rate. Returns the differences found by verify.
+    """
+    if "--stub" in correction_args and "--stub-error-rate" not in correction_args:
+        correction_args = list(correction_args) + ["--stub-error-rate", "0"]
+    counts = split_tsv(input_path, workdir, shards)
+    print(f"Split {sum(counts)} rows into {shards} shards: {counts}")
+
+    start = time.monotonic()
+    node_args = ["--workers", str(workers), f"--correction-args={shlex.join(correction_args)}"]
+    node_args += ["--stream"] if stream else []
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "node", workdir, "--shard", str(shard)]
+                                  + node_args)
+                 for shard in range(shards)]
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError(f"shards {failed} failed, see {shard_dir(workdir, failed[0])}/node.log")
+    print(f"Ran {shards} shards in {time.monotonic() - start:.1f}s")
+    merged_dir = merge_shards(workdir)
+
+    start = time.monotonic()
+    single_dir = os.path.join(workdir, "single")
+    os.makedirs(os.path.join(single_dir, "data"), exist_ok=True)
+    with open(input_path, "rb") as source, open(os.path.join(single_dir, INPUT_TSV), "wb") as target:
+        target.write(source.read())
+    if not run_node(single_dir, correction_args, workers, stream):
+        raise RuntimeError(f"the single-node run failed, see {single_dir}/node.log")
+    print(f"Ran the single-node reference in {time.monotonic() - start:.1f}s")
+    return verify(merged_dir, single_dir)
+
+
+def _report(differences: List[str]):
+    for difference in differences:
+        print(f"DIFFERENCE: {difference}")
+    print("The merged result matches the single-node run." if not differences else
+          f"{len(differences)} differences to the single-node run.")
+    sys.exit(1 if differences else 0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shard the corpus by record id and merge the shard results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    split_parser = commands.add_parser("split", help="split the annotated TSV into shards")
+    split_parser.add_argument("input")
+    split_parser.add_argument("workdir")
+    split_parser.add_argument("--shards", type=int, required=True)
+
+    evaluate_parser = commands.add_parser("evaluate", help="evaluate an annotated TSV and write its faulty records")
+    evaluate_parser.add_argument("input", help="TSV with the record id and the annotation")
+    evaluate_parser.add_argument("output", help="the evaluated TSV, e.g. results/data/all_bib_items_annotated.tsv")
+    evaluate_parser.add_argument("faulty_lines", help="the faulty records, e.g. results/data/incorrect_tags.txt")
+    evaluate_parser.add_argument("--workers", type=int, default=1, help="worker processes of the evaluation")
+    evaluate_parser.add_argument("--metrics", metavar="PATH", help="JSON file for the metrics of the evaluation")
+
+    node_parser = commands.add_parser("node", help="evaluate, correct and consolidate one shard")
+    node_parser.add_argument("workdir")
+    node_parser.add_argument("--shard", type=int, required=True)
+
+    merge_parser = commands.add_parser("merge", help="merge the results of all shards")
+    merge_parser.add_argument("workdir")
+    merge_parser.add_argument("--output-dir", help="defaults to WORKDIR/merged")
+
+    verify_parser = commands.add_parser("verify", help="compare a merged result with a single-node run")
+    verify_parser.add_argument("merged_dir")
+    verify_parser.add_argument("reference_dir")
+
+    local_parser = commands.add_parser("local", help="run N shards as local processes, merge and verify")
+    local_parser.add_argument("input")
+    local_parser.add_argument("workdir")
+    local_parser.add_argument("--shards", type=int, required=True)
+
+    for command_parser in (node_parser, local_parser):
+        command_parser.add_argument("--correction-args", default="--concurrency 8",
+                                    help="arguments of the correction script, e.g. '--stub --concurrency 8'")
+        command_parser.add_argument("--workers", type=int, default=1,
+                                    help="worker processes of the evaluation and consolidation")
+        command_parser.add_argument("--stream", action="store_true",
+                                    help="consolidate to JSON Lines and CSV instead of JSON and CSV")
+    args = parser.parse_args()
+
+    if args.command == "split":
+        counts = split_tsv(args.input, args.workdir, args.shards)
+        print(f"Split {sum(counts)} rows into {args.shards} shards: {counts}")
+    elif args.command == "evaluate":
+        if evaluate(args.input, args.output, args.faulty_lines, args.workers, args.metrics) is None:
+            sys.exit(f"ERROR: the evaluation of {args.input} failed")
+    elif args.command == "node":
+        directory = shard_dir(args.workdir, args.shard)
+        if not run_node(directory, shlex.split(args.correction_args), args.workers, args.stream):
+            print(f"Shard {args.shard} failed, see {directory}/node.log")
+            sys.exit(1)
+        print(f"Shard {args.shard} done")
+    elif args.command == "merge":
+        merge_shards(args.workdir, args.output_dir)
+    elif args.command == "verify":
+        _report(verify(args.merged_dir, args.reference_dir))
+    else:
+        _report(run_local(args.input, args.workdir, args.shards, shlex.split(args.correction_args),
+                          args.workers, args.stream))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the scripts import each other from the repository root and from results/
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "results")]
@@ -0,0 +1,51 @@
+import csv
+import json
+
+import pytest
+
+from format_output import build_correction_index, load_correction_index, normalize_prize
+
+
+def write_ground_data(path, rows):
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t")
+        writer.writerow(["id", "annotation", "quality_xml_well_formed"])
+        writer.writerows(rows)
+
+
+def test_correction_index_with_repeated_faulty_id(tmp_path):
+    tsv_path = str(tmp_path / "all_bib_items_annotated.tsv")
+    write_ground_data(tsv_path, [
+        ["a", "<ITEM>", "FALSE"],
+        ["b", "<ITEM>", "FALSE"],
+        ["ok", "<ITEM></ITEM>", "TRUE"],
+        ["b", "<ITEM>", "FALSE"],
+        ["c", "<ITEM>", "FALSE"],
+    ])
+
+    # line N of incorrect_tags.txt is the Nth faulty record, the last one wins for a repeated id
+    assert build_correction_index(tsv_path) == {"a": 1, "b": 3, "c": 4}
+
+
+def test_correction_index_sidecar_without_version_is_rebuilt(tmp_path):
+    tsv_path = str(tmp_path / "all_bib_items_annotated.tsv")
+    write_ground_data(tsv_path, [["a", "<ITEM>", "FALSE"], ["a", "<ITEM>", "FALSE"], ["b", "<ITEM>", "FALSE"]])
+    stat = (tmp_path / "all_bib_items_annotated.tsv").stat()
+    with open(tsv_path + ".corrections.json", "w", encoding="utf-8") as f:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "index": {"a": 2, "b": 2}}, f)
+
+    assert load_correction_index(tsv_path) == {"a": 2, "b": 3}
+    assert load_correction_index(tsv_path) == {"a": 2, "b": 3}
+
+
+@pytest.mark.parametrize("prize, kreuzer", [
+    ("54 kr.", 54), ("fl. 1. 36 kr.", 96), ("à 36. kr.", 36), ("xr. 12.", 12), ("7 Btz.", 28),
+    ("fl. 2. kr. 30.", 150), ("fl. 1½", 90), ("fl. 1. 1/2", 90), ("fl. 1 1/2", 90), ("1/2 fl.", 30),
+])
+def test_normalize_prize(prize, kreuzer):
+    assert normalize_prize(prize) == kreuzer
+
+
+@pytest.mark.parametrize("prize", ["", "gratis", "1746"])
+def test_prize_without_unit(prize):
+    assert normalize_prize(prize) is None
@@ -0,0 +1,24 @@
+import random
+
+import pytest
+
+from fuzzy_match import QGramIndex, match_values, similarity
+
+
+def test_values_without_shared_qgrams_are_candidates():
+    # the count filter bound is 0 at this length and threshold, and no q-gram is shared
+    assert similarity("xbcx", "ybcy") == 0.5
+    assert QGramIndex(["ybcy"]).candidates("xbcx", 0.5) == [0]
+    assert match_values(["ybcy"], ["xbcx"], [0.5]) == {0.5: [("ybcy", "xbcx")]}
+
+
+@pytest.mark.parametrize("threshold", [0.3, 0.5, 0.67, 0.8, 0.95])
+def test_candidates_include_every_match(threshold):
+    rng = random.Random(threshold)
+    values = ["".join(rng.choice("abcd") for _ in range(rng.randint(1, 8))) for _ in range(200)]
+    index = QGramIndex(values)
+    for value in values[:50]:
+        candidates = set(index.candidates(value, threshold))
+        for position, other in enumerate(values):
+            if similarity(value, other) >= threshold:
+                assert position in candidates, (value, other)
@@ -0,0 +1,29 @@
+import pytest
+
+from search_index import build_index, search
+
+
+def consolidated_record(ad_id, bibls):
+    return {"id": ad_id, "json_representation": {"item": {"bibl": bibls}}}
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / "search_index.sqlite")
+    build_index([
+        consolidated_record("ad1", [{"author": "J. Moreri", "title": "Dictionaire", "year": "1783"}]),
+        consolidated_record("ad2", [{"author": "Simlers", "title": "Regiment", "place": "Zürich"}]),
+    ], path)
+    return path
+
+
+def test_search_by_author(index_path):
+    assert [result["ad_id"] for result in search(index_path, author="moreri")] == ["ad1"]
+
+
+@pytest.mark.parametrize("filters", [{"author": "J."}, {"title": "1783"}, {"place": ""},
+                                     {"author": "moreri", "title": "1783"}])
+def test_filter_without_searchable_tokens_is_rejected(index_path, filters):
+    # without the check, the filter was dropped and the whole index returned
+    with pytest.raises(ValueError):
+        search(index_path, **filters)
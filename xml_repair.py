@@ -0,0 +1,183 @@
+"""
+Deterministic repair of malformed inline XML annotations.
+
+Most annotations flagged as malformed by evaluate_tsv.py have mechanical defects:
+an unclosed <BIBL>, a missing </ITEM>, inner tags crossing a BIBL boundary,
+a tag without its closing '>', a stray closing tag or a stray '&' or '<'.
+repair_annotation fixes these patterns, re-validates the result with
+evaluate_tsv.analyze_annotations and returns a correction in the same
+shape as the LLM corrections ('fixed_xml', 'number_of_fixes', 'explanation').
+Annotations it cannot fix with few enough changes, or with markup the rules
+do not know (e.g. <BR/> or tags with attributes), are left for the LLM.
+"""
+
+import re
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from evaluate_tsv import ANNOTATION_TAGS, analyze_annotations
+
+# tag names the annotation model used instead of ours
+TAG_SYNONYMS = {"PRICE": "PRIZE"}
+
+_TAG_RE = re.compile(r"<(/?)([A-Za-z]+)\s*>")
+# not a tag with attributes or a self-closing tag, which are left alone
+_UNTERMINATED_TAG_RE = re.compile(r"<(/?)([A-Za-z]+)(?![A-Za-z]|\s*/?>|\s+[A-Za-z_:][\w:.-]*\s*=)")
+_STRAY_AMPERSAND_RE = re.compile(r"&(?!(?:amp|lt|gt|quot|apos|#\d+|#x[0-9a-fA-F]+);)")
+# a '<' that cannot start markup
+_STRAY_LESS_THAN_RE = re.compile(r"<(?![A-Za-z_:/!?])")
+_MARKUP_RE = re.compile(r"<[A-Za-z_:/!?]")
+
+
+def _known_tag(name: str) -> Optional[str]:
+    name = name.upper()
+    name = TAG_SYNONYMS.get(name, name)
+    return name if name in ANNOTATION_TAGS else None
+
+
+def _terminate_tags(xml_string: str, fixes: List[str]) -> str:
+    """ adds the missing '>' to tags like '<TITLEEine Bibel' or '</BIBL Text'. """
+    def replace(match):
+        word = match.group(2)
+        for tag in sorted(ANNOTATION_TAGS + tuple(TAG_SYNONYMS), key=len, reverse=True):
+            if word.upper().startswith(tag):
+                fixes.append(f"Added the missing '>' to <{match.group(1)}{word[:len(tag)]}.")
+                return f"<{match.group(1)}{word[:len(tag)]}>{word[len(tag):]}"
+        return match.group(0)
+    return _UNTERMINATED_TAG_RE.sub(replace, xml_string)
+
+
+def _escape_text(text: str, fixes: List[str], unknown_markup: List[str]) -> str:
+    """ escapes '&' and a '<' that cannot start markup in text content; other markup is kept and recorded. """
+    escaped = _STRAY_AMPERSAND_RE.sub("&amp;", text)
+    if escaped != text:
+        fixes.append("Escaped a stray '&'.")
+    if _STRAY_LESS_THAN_RE.search(escaped):
+        fixes.append("Escaped a stray '<'.")
+        escaped = _STRAY_LESS_THAN_RE.sub("&lt;", escaped)
+    unknown_markup.extend(match.group(0) for match in _MARKUP_RE.finditer(escaped))
+    return escaped
+
+
+def repair_xml(xml_string: str) -> Dict[str, Any]:
+    """
+    Rebalances the tags of an annotation string.
+
+    ITEM is made the single root element. An opening BIBL closes a BIBL that is
+    still open, an inner tag that is opened again closes the open one, a closing
+    tag closes all tags opened after it, and closing tags without a matching
+    opening tag are dropped. Unknown tags are removed, known misnamed tags renamed.
+
+    Args:
+        xml_string: annotation string as written by the annotation model
+
+    Returns:
+        Dictionary with 'fixed_xml', 'number_of_fixes' and 'explanation'
+    """
+    fixed_xml, fixes, _, _ = _repair(xml_string)
+    return _correction(fixed_xml, fixes)
+
+
+def _correction(fixed_xml: str, fixes: List[str]) -> Dict[str, Any]:
+    """ correction dictionary in the shape of the LLM corrections. """
+    explanation = " ".join(message if count == 1 else f"{message[:-1]} ({count}x)."
+                           for message, count in Counter(fixes).items())
+    return {
+        "fixed_xml": fixed_xml,
+        "number_of_fixes": len(fixes),
+        "explanation": explanation or "No fixes needed."
+    }
+
+
+def _repair(xml_string: str):
+    """
+    Returns the repaired string, the list of fixes, the number of structural
+    fixes, i.e. fixes other than renaming tags and escaping characters, and
+    the markup left in the text that the rules do not know.
+    """
+    fixes: List[str] = []
+    unknown_markup: List[str] = []
+    xml_string = _terminate_tags(xml_string.strip(), fixes)
+
+    output: List[str] = []
+    stack: List[str] = []
+    item_tags = []
+
+    def close(tag):
+        while stack:
+            open_tag = stack.pop()
+            output.append(f"</{open_tag}>")
+            if open_tag == tag:
+                return
+
+    # renamed tags and escaped characters are counted separately
+    cosmetic = 0
+    position = 0
+    for match in _TAG_RE.finditer(xml_string):
+        output.append(_escape_text(xml_string[position:match.start()], fixes, unknown_markup))
+        position = match.end()
+        closing, name = match.group(1), match.group(2)
+        tag = _known_tag(name)
+
+        if tag is None:
+            fixes.append(f"Removed the unknown tag <{closing}{name}>.")
+            continue
+        if tag != name:
+            fixes.append(f"Renamed <{closing}{name}> to <{closing}{tag}>.")
+            cosmetic += 1
+        if tag == "ITEM":
+            item_tags.append((closing, match.start(), match.end()))
+            continue
+
+        if not closing:
+            if tag == "BIBL" and "BIBL" in stack:
+                fixes.append("Closed an unclosed <BIBL> before the next one.")
+                close("BIBL")
+            elif tag in stack:
+                fixes.append(f"Closed an unclosed <{tag}> before the next one.")
+                close(tag)
+            stack.append(tag)
+            output.append(f"<{tag}>")
+        elif tag in stack:
+            if stack[-1] != tag:
+                crossing = ", ".join(f"<{t}>" for t in reversed(stack[stack.index(tag) + 1:]))
+                fixes.append(f"Closed {crossing} before </{tag}>.")
+            close(tag)
+        else:
+            fixes.append(f"Removed the stray closing tag </{tag}>.")
+    output.append(_escape_text(xml_string[position:], fixes, unknown_markup))
+    cosmetic += sum(1 for fix in fixes if fix.startswith("Escaped"))
+
+    if stack:
+        fixes.append("Closed " + ", ".join(f"<{t}>" for t in reversed(stack)) + " at the end.")
+        close(stack[0])
+
+    if [closing for closing, _, _ in item_tags] != ["", "/"] \
+            or item_tags[0][1] != 0 or item_tags[-1][2] != len(xml_string):
+        fixes.append("Wrapped the whole ad in a single <ITEM> element.")
+    fixed_xml = "<ITEM>" + "".join(output).strip() + "</ITEM>"
+    return fixed_xml, fixes, len(fixes) - cosmetic, unknown_markup
+
+
+def repair_annotation(xml_string: str, max_fixes: int = 3) -> Optional[Dict[str, Any]]:
+    """
+    Repairs an annotation string and validates the result.
+
+    Args:
+        xml_string: annotation string as written by the annotation model
+        max_fixes: annotations needing more structural fixes (not counting
+            renamed tags and escaped characters) are considered too broken
+            for a mechanical repair
+
+    Returns:
+        Correction dictionary as returned by repair_xml, or None if the
+        annotation could not be repaired and should be sent to the LLM
+    """
+    fixed_xml, fixes, structural_fixes, unknown_markup = _repair(xml_string)
+    if structural_fixes > max_fixes or unknown_markup:
+        return None
+
+    analysis = analyze_annotations(fixed_xml)
+    if not analysis["xml_well_formed"] or analysis["has_overlapping_tags"]:
+        return None
+    return _correction(fixed_xml, fixes)